@@ -1,9 +1,13 @@
 import image
 import lcd
+import machine
 import network
+import select
 import sensor
 import socket
+import struct
 import time
+import ubinascii
 import ujson
 
 from fpioa_manager import fm
@@ -26,6 +30,51 @@ wifi_ssid = 0
 wifi_password = 0
 server_ip = 0
 server_port = 3456
+# Only connecting and identifying to the server may wait, commands are then polled without waiting
+HANDSHAKE_TIMEOUT_S = 5
+
+# Frame protocol, must be kept in sync with `mark_app/protocol.py`
+# magic | version | kind | sequence number | capture timestamp (ms) | payload length
+FRAME_HEADER = ">2sBBIII"
+FRAME_MAGIC = b"MK"
+FRAME_VERSION = 1
+FRAME_KIND_JPEG = 0
+FRAME_KIND_HELLO = 1
+FRAME_KIND_ACK = 2
+frame_seq = 0
+
+# Command protocol, must be kept in sync with `mark_app/protocol.py`
+# magic | version | kind | sequence number | send timestamp (ms) | payload length
+COMMAND_HEADER = ">2sBBIIH"
+COMMAND_HEADER_SIZE = 14
+COMMAND_MAGIC = b"MC"
+COMMAND_KIND_KEYS = 0
+COMMAND_KIND_HINT = 1
+# Stop moving if no command is received for this long, e.g. when the link stalls
+COMMAND_TIMEOUT_MS = 500
+command_buffer = b""
+last_command_ms = 0
+
+# Bits of the keys in a keys command
+KEY_FORWARD = 1 << 0
+KEY_LEFT = 1 << 1
+KEY_BACKWARD = 1 << 2
+KEY_RIGHT = 1 << 3
+KEY_TILT_UP = 1 << 4
+KEY_TILT_DOWN = 1 << 5
+KEY_PAN_LEFT = 1 << 6
+KEY_PAN_RIGHT = 1 << 7
+KEY_GRIPPER_OPEN = 1 << 8
+KEY_GRIPPER_CLOSE = 1 << 9
+keys = 0
+
+# Camera feed settings, adjusted by the hints of the server within these bounds
+MIN_QUALITY = 10
+MAX_QUALITY = 90
+MAX_FRAME_INTERVAL_MS = 1000
+jpeg_quality = 30
+frame_interval_ms = 0
+last_frame_ms = 0
 
 # Camera angles
 pan_angle = 90
@@ -110,48 +159,37 @@ def _connect_to_wifi():
     )
 
 
-def _handle_message(data):
+def _apply_keys():
     global pan_angle
     global tilt_angle
     global gripper_angle
 
-    if data == b"":
-        # No command, stop any movement
-        Maix_motor.motor_run(0, 0, 0)
-        return
-    elif data == b"\x01":
-        # Forward
+    if keys & KEY_FORWARD:
         Maix_motor.motor_motion(2, 1, 0)
-    elif data == b"\x02":
-        # Left
-        Maix_motor.motor_motion(1, 4, 0)
-    elif data == b"\x03":
-        # Backward
+    elif keys & KEY_BACKWARD:
         Maix_motor.motor_motion(2, 2, 0)
-    elif data == b"\x04":
-        # Right
+    elif keys & KEY_LEFT:
+        Maix_motor.motor_motion(1, 4, 0)
+    elif keys & KEY_RIGHT:
         Maix_motor.motor_motion(1, 3, 0)
-    elif data == b"\x05":
-        # Camera up
+    else:
+        # No movement key pressed, stop any movement
+        Maix_motor.motor_run(0, 0, 0)
+
+    angles = (pan_angle, tilt_angle, gripper_angle)
+
+    if keys & KEY_TILT_UP:
         tilt_angle = tilt_angle + 5
-    elif data == b"\x06":
-        # Camera down
+    if keys & KEY_TILT_DOWN:
         tilt_angle = tilt_angle - 5
-    elif data == b"\x07":
-        # Camera left
+    if keys & KEY_PAN_LEFT:
         pan_angle = pan_angle + 5
-    elif data == b"\x08":
-        # Camera right
+    if keys & KEY_PAN_RIGHT:
         pan_angle = pan_angle - 5
-    elif data == b"\t":
-        # Open gripper
+    if keys & KEY_GRIPPER_OPEN:
         gripper_angle = gripper_angle + 5
-    elif data == b"\n":
-        # Close gripper
+    if keys & KEY_GRIPPER_CLOSE:
         gripper_angle = gripper_angle - 5
-    else:
-        # Unrecognized command, no-op
-        return
 
     # Constraint movements of the camera
     pan_angle = min(pan_angle, 180)
@@ -161,58 +199,136 @@ def _handle_message(data):
     gripper_angle = min(gripper_angle, 180)
     gripper_angle = max(gripper_angle, 0)
 
-    Maix_motor.servo_angle(1, pan_angle)
-    Maix_motor.servo_angle(2, tilt_angle)
-    Maix_motor.servo_angle(3, gripper_angle)
+    if angles != (pan_angle, tilt_angle, gripper_angle):
+        Maix_motor.servo_angle(1, pan_angle)
+        Maix_motor.servo_angle(2, tilt_angle)
+        Maix_motor.servo_angle(3, gripper_angle)
 
 
-def _send_buffer(sock, data, buf_size):
-    # Sends data to the given socket in chunks of `buf_size`
-    block = int(len(data) / buf_size)
-    send_len = 0
+def _send_buffer(sock, data):
+    # Sends the whole of `data` to the given socket, since a single `send` may only send part of it
+    sock.sendall(data)
 
-    for i in range(block):
-        send_len += sock.send(data[i * buf_size:(i + 1) * buf_size])
+    return len(data)
 
-    # Always send the last block in cases where `data` can't be divided exactly by `buf_size`
-    send_len += sock.send(data[block * buf_size:])
 
-    return send_len
+def _send_camera_feed(sock):
+    global frame_seq
+    global last_frame_ms
 
+    # Keep the frame rate hinted by the server
+    if time.ticks_diff(time.ticks_ms(), last_frame_ms) < frame_interval_ms:
+        return
 
-def _send_camera_feed(sock):
     # Capture image from the camera feed
     img = sensor.snapshot()
+    timestamp = time.ticks_ms()
+    last_frame_ms = timestamp
     img.replace(vflip=True, hmirror=False, transpose=True)
     lcd.display(img)
 
-    # Attempt to transmit compressed image
-    img = img.compress(quality=30)
-    send_len = _send_buffer(sock, img.to_bytes(), 2048)
+    # Attempt to transmit compressed image, prefixed by its header so the server doesn't have to scan for JPEG markers
+    img = img.compress(quality=jpeg_quality)
+    data = img.to_bytes()
+    header = struct.pack(
+        FRAME_HEADER, FRAME_MAGIC, FRAME_VERSION, FRAME_KIND_JPEG, frame_seq, timestamp & 0xFFFFFFFF, len(data)
+    )
+    frame_seq = (frame_seq + 1) & 0xFFFFFFFF
+
+    _send_buffer(sock, header)
+    send_len = _send_buffer(sock, data)
 
     if send_len == 0:
         lcd.draw_string(lcd.width() // 2 - 68, lcd.height() // 2 - 4, "Video feed transmission failed", lcd.WHITE, lcd.RED)
         raise Exception("Video feed transmission failed")
 
 
+def _send_hello(sock):
+    # Identify this robot to the server, so several robots can be connected at the same time
+    robot_id = ubinascii.hexlify(machine.unique_id())
+    header = struct.pack(FRAME_HEADER, FRAME_MAGIC, FRAME_VERSION, FRAME_KIND_HELLO, 0, 0, len(robot_id))
+    _send_buffer(sock, header + robot_id)
+
+
+def _send_ack(sock, seq, timestamp):
+    payload = struct.pack(">II", seq, timestamp)
+    header = struct.pack(FRAME_HEADER, FRAME_MAGIC, FRAME_VERSION, FRAME_KIND_ACK, seq, time.ticks_ms(), len(payload))
+    _send_buffer(sock, header + payload)
+
+
+def _apply_hint(payload):
+    global jpeg_quality
+    global frame_interval_ms
+
+    quality, interval = struct.unpack(">BH", payload)
+    jpeg_quality = min(max(quality, MIN_QUALITY), MAX_QUALITY)
+    frame_interval_ms = min(interval, MAX_FRAME_INTERVAL_MS)
+
+
 def _receive_message(sock):
-    data = sock.recv(1)
-    _handle_message(data)
+    global command_buffer
+    global keys
+    global last_command_ms
+
+    # Drain every command received since the last frame, without waiting for new ones
+    while True:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            break
+        data = sock.recv(512)
+        if not data:
+            break
+        command_buffer += data
+
+    # Every command carries the full state of the keys, so only the newest one is applied
+    newest = None
+    while len(command_buffer) >= COMMAND_HEADER_SIZE:
+        magic, _, kind, seq, timestamp, length = struct.unpack(COMMAND_HEADER, command_buffer[:COMMAND_HEADER_SIZE])
+        if magic != COMMAND_MAGIC:
+            # Out of sync, skip ahead
+            command_buffer = command_buffer[1:]
+            continue
+        if len(command_buffer) < COMMAND_HEADER_SIZE + length:
+            break
+
+        payload = command_buffer[COMMAND_HEADER_SIZE:COMMAND_HEADER_SIZE + length]
+        command_buffer = command_buffer[COMMAND_HEADER_SIZE + length:]
+        if kind == COMMAND_KIND_KEYS:
+            newest = (struct.unpack(">H", payload)[0], seq, timestamp)
+        elif kind == COMMAND_KIND_HINT:
+            _apply_hint(payload)
+
+    if newest is not None:
+        keys = newest[0]
+        last_command_ms = time.ticks_ms()
+        # Let the server know which command was applied, so it can measure the round trip
+        _send_ack(sock, newest[1], newest[2])
+    elif time.ticks_diff(time.ticks_ms(), last_command_ms) > COMMAND_TIMEOUT_MS:
+        keys = 0
+
+    _apply_keys()
 
 
 def _connect_to_server():
+    global command_buffer
+
     sock = socket.socket()
+    # Drop any partial command left over from the previous connection
+    command_buffer = b""
 
     try:
         print("Attempting to connect to server: (" + server_ip + ":" + str(server_port) + ")")
+        sock.settimeout(HANDSHAKE_TIMEOUT_S)
         sock.connect((server_ip, server_port))
+        _send_hello(sock)
     except Exception as e:
         print("Caught exception when connecting to the server:", e)
         sock.close()
         return None
 
     print("Successfully connected to server")
-    sock.settimeout(0.1)
+    # Commands are polled by `_receive_message`, so from now on only sending the camera feed may block
+    sock.settimeout(None)
 
     return sock
 
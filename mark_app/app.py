@@ -1,4 +1,6 @@
 """Main app for controlling M.A.R.K. and recording data."""
+import argparse
+import functools
 import io
 import logging
 import queue
@@ -8,8 +10,8 @@ import time
 
 # For buttons to render properly in MacOS, we need to import `ttk`
 # See: https://stackoverflow.com/q/59006014
-from tkinter import Canvas, Frame, Label, Tk, Toplevel, filedialog, messagebox, ttk
-from typing import Any, List
+from tkinter import BooleanVar, Canvas, Frame, Label, StringVar, Tk, Toplevel, filedialog, messagebox, ttk
+from typing import Any, Dict, List, Tuple
 
 import numpy as np
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
@@ -17,25 +19,46 @@ from matplotlib.figure import Figure
 from PIL import Image, ImageTk
 
 from common import MESSAGE_TYPE
-from controller import KeyboardController
-from recorder import Recorder
+from dispatcher import STOP_CHECK_INTERVAL_S, Dispatcher
+from engine import Engine
+from mailboxes import POLICY, Mailbox
+from protocol import Frame as CameraFrame
+from recorder import RECORDING_FORMAT, RECORDING_MODE
 from server import Server
+from stats import registry
 
 PANEL_SIZE = (500, 450)
+# How much of a session is kept when only keeping its last minutes
+ROLLING_RECORDING_S = 5 * 60
+# How often the Tk main loop handles the status messages of the robots
+STATUS_POLL_INTERVAL_MS = 100
 
 
 class App:
-    def __init__(self, root: Tk) -> None:
-        # Queue to receive status messages from M.A.R.K.
-        self._status_queue = queue.Queue()
-        # Queue to receive camera feed data from M.A.R.K.
-        self._camera_queue = queue.Queue()
-        # Queue to receive controller feed data
-        self._controller_queue = queue.Queue()
+    """The M.A.R.K. app
+
+    :param root: The root window
+    :type root: Tk
+    :param engine: The engine controlling M.A.R.K. and recording data, which is started by the app, either an `Engine`
+        or an `EngineProcess`
+    :type engine: Engine
+    :param max_display_fps: The maximum number of camera frames displayed per second, defaults to 30
+    :type max_display_fps: float
+    """
+
+    def __init__(self, root: Tk, engine: Engine, max_display_fps: float = 30.0) -> None:
+        self._engine = engine
+        self._server = engine.server
+        self._controller = engine.controller
+        self._recorder = engine.recorder
 
         self._root = root
         self._root.columnconfigure(0, weight=1)
 
+        # Ids of the robots currently connected
+        self._robots = set()
+        self._max_display_fps = max_display_fps
+
         self._build_connection_status_frame()
 
         self._feed_frame = Frame(self._root)
@@ -55,17 +78,20 @@ class App:
 
         self._build_reset_button()
 
-        self._start_server()
-        self._start_controller()
+        # Update the UI based on status events from M.A.R.K.
+        self._subscribe_to_status()
+        self._engine.start()
         self._start_camera_handler()
         self._start_controller_handler()
-        self._start_recorder()
 
-        # Update the UI based on status events from M.A.R.K.
-        self._update_status()
+        self._update_stats()
 
     def close(self) -> None:
-        self._server.close()
+        # Threads are stopped in order, so none of them is left waiting on one that already stopped
+        self._camera_handler.close()
+        self._controller_dispatcher.close()
+        # Any session being recorded is saved before closing
+        self._engine.close()
         self._root.destroy()
 
     def _build_connection_status_frame(self) -> None:
@@ -75,6 +101,9 @@ class App:
         self._status_fixed_label.grid(row=0, column=0)
         self._status_label = Label(self._status_frame, text="Offline", fg="red", font="Roboto 14 bold")
         self._status_label.grid(row=0, column=1)
+        # Live statistics of the camera feed and the commands
+        self._stats_label = Label(self._status_frame, text="", font="Roboto 10")
+        self._stats_label.grid(row=1, column=0, columnspan=2)
 
     def _build_camera_feed_panel(self) -> None:
         self._camera_label = Label(self._feed_frame, text="Camera Feed", font="Roboto 14 bold")
@@ -98,6 +127,7 @@ class App:
 
     def _build_recording_frame(self) -> None:
         self._build_recording_directory_button()
+        self._build_recording_format_selector()
         self._build_start_stop_recording_button()
 
     def _build_recording_directory_button(self) -> None:
@@ -119,6 +149,41 @@ class App:
         )
         self._recording_dir_label.grid(row=0, column=1, padx=8)
 
+    def _build_recording_format_selector(self) -> None:
+        # Images are saved as received by default, which is the cheapest format by far
+        self._recording_format = StringVar(value=RECORDING_FORMAT.JPEG)
+        self._recording_format_selector = ttk.Combobox(
+            self._recording_qr_reset_frame,
+            textvariable=self._recording_format,
+            values=[RECORDING_FORMAT.JPEG, RECORDING_FORMAT.PNG, RECORDING_FORMAT.NPY],
+            state="readonly",
+            width=6,
+        )
+        self._recording_format_selector.grid(row=1, column=0, pady=4)
+
+        # Long sessions are better saved to a few large shards than to thousands of small files
+        self._recording_sharded = BooleanVar(value=False)
+        self._recording_sharded_button = ttk.Checkbutton(
+            self._recording_qr_reset_frame, text="Shards", variable=self._recording_sharded
+        )
+        self._recording_sharded_button.grid(row=1, column=1, sticky="W", padx=8)
+
+        # Records every frame as it arrives, instead of the latest one every 200 ms
+        self._recording_every_frame = BooleanVar(value=False)
+        self._recording_every_frame_button = ttk.Checkbutton(
+            self._recording_qr_reset_frame, text="Every frame", variable=self._recording_every_frame
+        )
+        self._recording_every_frame_button.grid(row=1, column=1, sticky="E", padx=8)
+
+        # Keeps the session in memory and only saves its last minutes once stopped, like a dashcam
+        self._recording_rolling = BooleanVar(value=False)
+        self._recording_rolling_button = ttk.Checkbutton(
+            self._recording_qr_reset_frame,
+            text=f"Last {ROLLING_RECORDING_S // 60} min",
+            variable=self._recording_rolling,
+        )
+        self._recording_rolling_button.grid(row=1, column=2)
+
     def _build_start_stop_recording_button(self) -> None:
         self._record_button = ttk.Button(
             self._recording_qr_reset_frame,
@@ -134,16 +199,31 @@ class App:
 
         if not self._is_recording:
             self._record_button.config(text="Stop")
+            # The format can't change in the middle of a session
+            self._recording_format_selector.config(state="disabled")
+            self._recording_sharded_button.config(state="disabled")
+            self._recording_every_frame_button.config(state="disabled")
+            self._recording_rolling_button.config(state="disabled")
             self._is_recording = True
             self._start_recording()
         else:
             self._record_button.config(text="Record")
+            self._recording_format_selector.config(state="readonly")
+            self._recording_sharded_button.config(state="normal")
+            self._recording_every_frame_button.config(state="normal")
+            self._recording_rolling_button.config(state="normal")
             self._is_recording = False
             self._stop_recording()
 
     def _start_recording(self) -> None:
         logging.info(f"Starting recording of camera images and controller values, saving to {self._recording_dir}")
-        self._recorder.start_recording(self._recording_dir)
+        self._recorder.start_recording(
+            self._recording_dir,
+            self._recording_format.get(),
+            self._recording_sharded.get(),
+            RECORDING_MODE.FRAMES if self._recording_every_frame.get() else RECORDING_MODE.TIMER,
+            keep_last_s=ROLLING_RECORDING_S if self._recording_rolling.get() else None,
+        )
 
     def _stop_recording(self) -> None:
         logging.info("Stopping recording of camera images and controller values")
@@ -175,212 +255,330 @@ class App:
         self._reset_button = ttk.Button(self._recording_qr_reset_frame, text="Reset", command=_reset)
         self._reset_button.grid(row=0, column=4, padx=88)
 
-    def _start_server(self) -> None:
-        self._server = Server(port=1060, status_queue=self._status_queue, camera_queue=self._camera_queue)
-        # We set the server as a daemon so that it can be killed when the app is closed
-        self._server.daemon = True
-        self._server.start()
-
-    def _start_controller(self) -> None:
-        self._controller = KeyboardController(message_queue=self._controller_queue)
-        # We set the server as a daemon so that it can be killed when the app is closed
-        self._controller.daemon = True
-        self._controller.start()
-
     def _start_camera_handler(self) -> None:
         self._camera_handler = _CameraHandler(
-            message_queue=self._camera_queue,
+            message_queue=self._engine.camera_queue,
             root=self._root,
             camera_feed=self._camera_feed,
             camera_feed_image=self._camera_feed_image,
+            server=self._server,
+            max_fps=self._max_display_fps,
         )
-        # We set the handler as a daemon so that it can be killed when the app is closed
-        self._camera_handler.daemon = True
+        # The handler is stopped when the app is closed
         self._camera_handler.start()
 
     def _start_controller_handler(self) -> None:
         self._controller_handler = _ControllerHandler(
-            message_queue=self._controller_queue,
+            root=self._root,
             controller_canvas=self._controller_canvas,
             controller_plot=self._controller_plot,
-            server=self._server,
-            controller=self._controller,
+            keys=self._controller.keys(),
+        )
+        self._controller_dispatcher = Dispatcher(self._engine.controller_queue, name="ControllerDispatcher")
+        self._controller_dispatcher.subscribe(MESSAGE_TYPE.CONTROLLER_FEED_RECEIVED, self._controller_handler.put)
+        # The dispatcher is stopped when the app is closed
+        self._controller_dispatcher.start()
+
+    def _subscribe_to_status(self) -> None:
+        # Tk can only be used from the main loop, so the dispatcher only queues messages and the main loop polls them.
+        # Every message counts, so none of them is dropped
+        self._status_messages: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        for message_type in (MESSAGE_TYPE.CONNECTED, MESSAGE_TYPE.DISCONNECTED):
+            self._engine.status_dispatcher.subscribe(message_type, functools.partial(self._queue_status, message_type))
+        self._root.after(0, self._poll_status)
+
+    def _queue_status(self, message_type: str, robot_id: str) -> None:
+        # Runs on the status dispatcher
+        self._status_messages.put((message_type, robot_id))
+
+    def _poll_status(self) -> None:
+        # Runs on the Tk main loop
+        while True:
+            try:
+                message_type, robot_id = self._status_messages.get_nowait()
+            except queue.Empty:
+                break
+            self._handle_message(message_type, robot_id)
+
+        self._root.after(STATUS_POLL_INTERVAL_MS, self._poll_status)
+
+    def _update_stats(self) -> None:
+        # The engine may run in another process, so its statistics are read from it rather than from the registry
+        stats = self._engine.stats()
+
+        def p95(name: str) -> str:
+            stat = stats.get(name)
+            return "-" if stat is None or not stat["count"] else f"{stat['p95']:.0f} ms"
+
+        def rate(name: str) -> float:
+            return stats.get(name, {}).get("rate", 0.0)
+
+        self._stats_label.config(
+            text=(
+                f"{rate('camera.frames'):.1f} FPS, {rate('camera.bytes') / 1000.0:.0f} KB/s, "
+                f"{self._engine.camera_queue.dropped} dropped | "
+                f"p95 transport {p95('camera.transport_ms')}, reassembly {p95('camera.reassembly_ms')}, "
+                f"decode {p95('camera.decode_ms')}, display {p95('camera.display_ms')}, "
+                f"save {p95('recorder.save_ms')} | key to wire {p95('commands.key_to_wire_ms')}, "
+                f"command RTT {p95('commands.rtt_ms')}"
+            )
         )
-        # We set the handler as a daemon so that it can be killed when the app is closed
-        self._controller_handler.daemon = True
-        self._controller_handler.start()
-
-    def _start_recorder(self) -> None:
-        # Sample data every 200 ms
-        self._recorder = Recorder(self._server, self._controller, sample_rate_ms=200)
-        # We set the handler as a daemon so that it can be killed when the app is closed
-        self._recorder.daemon = True
-        self._recorder.start()
-
-    def _update_status(self) -> None:
-        if not self._status_queue.empty():
-            message_type, data = self._status_queue.get()
-            self._handle_message(message_type, data)
 
-        # Check for messages in the queue every 100ms
-        self._root.after(100, self._update_status)
+        # Refresh the statistics every second
+        self._root.after(1000, self._update_stats)
 
-    def _handle_message(self, message_type: str, _: Any) -> None:
+    def _handle_message(self, message_type: str, robot_id: str) -> None:
         if message_type is MESSAGE_TYPE.CONNECTED:
-            self._status_label.config(text="Online", fg="green", font="Roboto 14 bold")
+            self._robots.add(robot_id)
         elif message_type is MESSAGE_TYPE.DISCONNECTED:
-            self._status_label.config(text="Offline", fg="red", font="Roboto 14 bold")
+            self._robots.discard(robot_id)
         else:
             raise ValueError(f"Unknown status message type: {message_type}")
 
+        if not self._robots:
+            self._status_label.config(text="Offline", fg="red", font="Roboto 14 bold")
+        elif len(self._robots) == 1:
+            self._status_label.config(text="Online", fg="green", font="Roboto 14 bold")
+        else:
+            self._status_label.config(text=f"Online ({len(self._robots)} robots)", fg="green", font="Roboto 14 bold")
+
 
 class _CameraHandler(threading.Thread):
-    """Handles the camera feed and displays it in the camera feed panel.
+    """Decodes the camera feed and displays it in the camera feed panel.
+
+    Frames are decoded on this thread, at most `max_fps` times per second, while the decoded images are displayed by
+    the Tk main loop, which is the only thread allowed to touch widgets. Frames that arrive faster than that replace
+    each other in the mailbox, so only the latest one is ever decoded, and frames that are already too old by the time
+    they are picked up are skipped.
 
-    :param message_queue: The queue that receives images from the server
-    :type message_queue: queue.Queue
+    :param message_queue: The mailbox that receives images from the server
+    :type message_queue: Mailbox
     :param root: The root window
     :type root: Tk
     :param camera_feed: The canvas that displays the camera feed
     :type camera_feed: Canvas
     :param camera_feed_image: The image that is displayed in the camera feed
     :type camera_feed_image: Any
+    :param server: The server, to only display the most recently connected robot
+    :type server: Server
+    :param max_fps: The maximum number of frames displayed per second, defaults to 30
+    :type max_fps: float
+    :param max_age_ms: Frames older than this when they are picked up are skipped, defaults to 500
+    :type max_age_ms: float
     """
 
-    def __init__(self, message_queue: queue.Queue, root: Tk, camera_feed: Canvas, camera_feed_image: Any) -> None:
+    def __init__(
+        self,
+        message_queue: Mailbox,
+        root: Tk,
+        camera_feed: Canvas,
+        camera_feed_image: Any,
+        server: Server,
+        max_fps: float = 30.0,
+        max_age_ms: float = 500.0,
+    ) -> None:
         super().__init__()
 
         self._message_queue = message_queue
         self._root = root
         self._camera_feed = camera_feed
         self._camera_feed_image = camera_feed_image
+        self._server = server
+        self._period = 1.0 / max_fps
+        self._max_age_ms = max_age_ms
+        # Only the latest decoded image is kept for the main loop, along with the time its frame was received
+        self._images = Mailbox(POLICY.KEEP_LATEST)
+        self._stopped = threading.Event()
+
+        self._root.after(0, self._display)
 
     def run(self) -> None:
-        while True:
-            if self._message_queue.empty():
-                # Add some delay to the thread so we don't perform busy waiting and consume CPU
-                # This avoids some flickering in the images when the server takes some time to send the next image
-                time.sleep(0.1)
+        while not self._stopped.is_set():
+            try:
+                message_type, data = self._message_queue.get(timeout=STOP_CHECK_INTERVAL_S)
+            except queue.Empty:
                 continue
-            message_type, data = self._message_queue.get()
+            decoded_at = time.monotonic()
             self._handle_message(message_type, data)
+            # Frames received in the meantime replace each other, so the next one decoded is the latest
+            self._stopped.wait(max(decoded_at + self._period - time.monotonic(), 0))
+
+    def close(self) -> None:
+        """Stops decoding frames"""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
 
-    def _handle_message(self, message_type: str, data: Any) -> None:
+    def _handle_message(self, message_type: str, frame: CameraFrame) -> None:
         if message_type is MESSAGE_TYPE.CAMERA_FEED_RECEIVED:
+            start = time.monotonic()
+            age_ms = (start - frame.received_at) * 1000.0
+            registry.histogram("camera.queue_ms").observe(age_ms)
+            if age_ms > self._max_age_ms:
+                registry.counter("camera.stale").inc()
+                return
+
+            # Frames of several robots would flicker in turns, so only the most recently connected one is displayed
+            robots = self._server.robots()
+            if robots and frame.robot_id != robots[-1]:
+                return
+
             try:
+                img = Image.open(io.BytesIO(frame.data))
+                # JPEGs larger than the panel are decoded at a fraction of their size directly, scaling them while
+                # decoding, which is much cheaper than decoding them whole and resizing them
+                img.draft("RGB", PANEL_SIZE)
                 # Resize image to fit our canvas
-                img = Image.open(io.BytesIO(data)).resize(PANEL_SIZE)
-                # Display the received image in the camera feed
-                self._root.camera_image = camera_image = ImageTk.PhotoImage(img)
-                self._camera_feed.itemconfig(self._camera_feed_image, image=camera_image)
+                img = img.resize(PANEL_SIZE)
             except:
                 # Ignore any corrupted images
-                pass
+                return
+            registry.histogram("camera.decode_ms").observe((time.monotonic() - start) * 1000.0)
+
+            self._images.put((img, frame.received_at))
         else:
             raise ValueError(f"Unknown camera message type: {message_type}")
 
+    def _display(self) -> None:
+        # Runs on the Tk main loop
+        try:
+            img, received_at = self._images.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            # Display the received image in the camera feed
+            self._root.camera_image = camera_image = ImageTk.PhotoImage(img)
+            self._camera_feed.itemconfig(self._camera_feed_image, image=camera_image)
+            # Time from the moment the frame was received until it was displayed
+            registry.histogram("camera.display_ms").observe((time.monotonic() - received_at) * 1000.0)
 
-class _ControllerHandler(threading.Thread):
-    """Handles the controller feed, displays it in the controller feed panel and sends commands to M.A.R.K.
+        self._root.after(max(int(self._period * 1000), 1), self._display)
 
-    :param message_queue: The queue that receives controller feed
-    :type message_queue: queue.Queue
+
+class _ControllerHandler:
+    """Handles the controller feed and displays it in the controller feed panel.
+
+    Controller values are appended to a ring buffer as they arrive, by whichever thread dispatches them, while the plot
+    is redrawn by the Tk main loop at most `max_fps` times per second, and only if new values arrived. Redrawing only
+    updates the data of the lines and blits them over a cached background, so its cost doesn't depend on how fast keys
+    are pressed.
+
+    :param root: The root window
+    :type root: Tk
     :param controller_canvas: The canvas that displays the controller feed
     :type controller_canvas: FigureCanvasTkAgg
     :param controller_plot: The plot that is displayed in the controller feed
     :type controller_plot: Any
-    :param server: The server that sends commands to M.A.R.K.
-    :type server: Server
-    :param controller: The controller that reads the keyboard input
-    :type controller: KeyboardController
+    :param keys: The keys of the controller, one line each
+    :type keys: List[str]
+    :param max_fps: The maximum number of redraws per second, defaults to 10
+    :type max_fps: float
     """
 
     def __init__(
         self,
-        message_queue: queue.Queue,
+        root: Tk,
         controller_canvas: FigureCanvasTkAgg,
         controller_plot: Any,
-        server: Server,
-        controller: KeyboardController,
+        keys: List[str],
+        max_fps: float = 10.0,
     ) -> None:
-
-        super().__init__()
-
-        self._message_queue = message_queue
+        self._root = root
         self._controller_canvas = controller_canvas
         self._controller_plot = controller_plot
-        self._server = server
-        self._controller = controller
-        self._plot_queue = _PlotQueue(max_size=50)
+        self._plot_buffer = _PlotBuffer(max_size=50, num_keys=len(keys))
+        self._period_ms = max(int(1000 / max_fps), 1)
+
+        # Lines are created once and only their data changes afterwards. They are animated, so they are left out of
+        # full draws and only drawn on top of the background when blitting
+        self._lines = [
+            self._controller_plot.plot(self._plot_buffer.get()[:, i], linewidth=2, label=key, animated=True)[0]
+            for i, key in enumerate(keys)
+        ]
+        self._controller_plot.set_xlim(0, self._plot_buffer.max_size - 1)
+        # Keys being held are reported as 2
+        self._controller_plot.set_ylim(-0.1, 2.1)
+        self._controller_plot.legend(loc="upper left", fontsize=8)
+        self._background = None
+        # The background is captured again after every full draw, e.g. when the window is resized
+        self._controller_canvas.mpl_connect("draw_event", self._on_draw)
+        self._controller_canvas.draw()
 
-    def run(self) -> None:
-        while True:
-            if self._message_queue.empty():
-                # Add some delay to the thread so we don't perform busy waiting and consume CPU
-                time.sleep(0.1)
-                continue
-            message_type, data = self._message_queue.get()
-            self._handle_message(message_type, data)
+        self._root.after(self._period_ms, self._redraw)
 
-    def _handle_message(self, message_type: str, data: Any) -> None:
-        if message_type is MESSAGE_TYPE.CONTROLLER_FEED_RECEIVED:
-            # Plot the received data in the controller feed
-            self._plot_queue.put(list(data.values()))
-            self._update_controller_plot(list(data.keys()))
-            # Send the controller feed to M.A.R.K. as commands
-            self._send_controller_feed(data)
-        else:
-            raise ValueError(f"Unknown controller message type: {message_type}")
+    def put(self, data: Dict[str, int]) -> None:
+        """Plots controller values in the controller feed, on the next redraw
 
-    def _update_controller_plot(self, keys: List[str]) -> None:
-        data = np.array(self._plot_queue.get())
+        :param data: The value of each key of the controller
+        :type data: Dict[str, int]
+        """
+        self._plot_buffer.put(list(data.values()))
 
-        self._controller_plot.clear()
+    def _on_draw(self, event: Any) -> None:
+        self._background = self._controller_canvas.copy_from_bbox(self._controller_plot.bbox)
+        self._blit()
 
-        for i, key in enumerate(keys):
-            self._controller_plot.plot(data[:, i], linewidth=2, label=key)
+    def _redraw(self) -> None:
+        # Runs on the Tk main loop
+        if self._plot_buffer.changed and self._background is not None:
+            self._blit()
 
-        self._controller_plot.legend(loc="upper left", fontsize=8)
-        self._controller_canvas.draw()
+        self._root.after(self._period_ms, self._redraw)
 
-    def _send_controller_feed(self, keys: dict[str, int]) -> None:
-        # Only send the commands that are active
-        for key, value in keys.items():
-            if value == 0:
-                continue
-            # We send the command as a byte array of length 1 (e.g. 1 = b"\x01")
-            self._server.send_to_mark(int.to_bytes(self._controller.key_to_command(key), 1, "big"))
+    def _blit(self) -> None:
+        data = self._plot_buffer.get()
+        self._controller_canvas.restore_region(self._background)
+        for i, line in enumerate(self._lines):
+            line.set_ydata(data[:, i])
+            self._controller_plot.draw_artist(line)
+        self._controller_canvas.blit(self._controller_plot.bbox)
 
 
-class _PlotQueue:
-    """A queue to manage the plot data.
+class _PlotBuffer:
+    """A preallocated ring buffer of the latest controller values.
 
-    :param max_size: The maximum number of elements to store in the queue.
+    :param max_size: The maximum number of values to keep per key
     :type max_size: int
+    :param num_keys: The number of keys of the controller
+    :type num_keys: int
     """
 
-    def __init__(self, max_size: int) -> None:
-        self._queue = []
-        self._max_size = max_size
+    def __init__(self, max_size: int, num_keys: int) -> None:
+        self.max_size = max_size
+        # Values are stored twice, so the latest `max_size` values are always a contiguous view
+        self._values = np.zeros((2 * max_size, num_keys), dtype=np.uint8)
+        self._next = 0
+        # Whether values were put since the buffer was last read
+        self.changed = False
+        self._lock = threading.Lock()
 
     def put(self, data: List[int]) -> None:
-        self._queue.append(data)
-
-        if len(self._queue) > self._max_size:
-            self._queue.pop(0)
-
-    def get(self) -> List[int]:
-        return self._queue
-
-
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-
+        with self._lock:
+            self._values[self._next] = data
+            self._values[self._next + self.max_size] = data
+            self._next = (self._next + 1) % self.max_size
+            self.changed = True
+
+    def get(self) -> np.ndarray:
+        with self._lock:
+            self.changed = False
+            # Oldest value first
+            return self._values[self._next : self._next + self.max_size].copy()
+
+
+def run_gui(engine: Engine, max_display_fps: float = 30.0) -> None:
+    """Runs the app until its window is closed
+
+    :param engine: The engine, not started yet
+    :type engine: Engine
+    :param max_display_fps: The maximum number of camera frames displayed per second, defaults to 30
+    :type max_display_fps: float
+    """
     window = Tk()
     window.title("M.A.R.K.")
     window.geometry("1200x600")
 
-    app = App(window)
+    app = App(window, engine, max_display_fps=max_display_fps)
 
     def on_close():
         if messagebox.askokcancel("Quit", "Are you sure you want to quit?"):
@@ -389,3 +587,28 @@ if __name__ == "__main__":
 
     window.protocol("WM_DELETE_WINDOW", on_close)
     window.mainloop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Runs the M.A.R.K. app")
+    parser.add_argument("--metrics-port", type=int, help="Publish statistics for Prometheus on this port, e.g. 9100")
+    parser.add_argument("--capture-dir", help="Capture the raw stream received from M.A.R.K. to this directory")
+    parser.add_argument(
+        "--max-display-fps", type=float, default=30.0, help="Display at most this many frames per second"
+    )
+    parser.add_argument(
+        "--multiprocess",
+        action="store_true",
+        help="Run the engine in its own process, so recording doesn't stutter the GUI",
+    )
+    args = parser.parse_args()
+
+    if args.multiprocess:
+        from engine_process import EngineProcess
+
+        engine = EngineProcess(metrics_port=args.metrics_port, capture_dir=args.capture_dir)
+    else:
+        engine = Engine(metrics_port=args.metrics_port, capture_dir=args.capture_dir)
+    run_gui(engine, args.max_display_fps)
@@ -0,0 +1,345 @@
+"""Benchmarks the server with simulated M.A.R.K. clients, no hardware needed."""
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Type
+
+from PIL import Image
+
+from capture import replay
+from common import MESSAGE_TYPE
+from engine import Engine
+from protocol import encode_frame_header, encode_hello
+from recorder import RECORDING_FORMAT, RECORDING_MODE
+from server import SelectorServer, Server
+from stats import registry
+
+SERVER_BACKENDS = {"threads": Server, "selectors": SelectorServer}
+# Interval of the simulated GUI loop, in seconds
+UI_TICK_S = 0.01
+
+
+def run_scale_test(
+    num_clients: int, num_frames: int, frame_size: int, port: int, server_class: Type[Server] = Server
+) -> Dict[str, float]:
+    """Connects `num_clients` simulated robots to a server and streams `num_frames` frames from each of them
+
+    The simulated robots run in their own processes, so the CPU usage reported is the one of the server alone (plus
+    the consumer of the camera queue).
+
+    :param num_clients: The number of simulated robots
+    :type num_clients: int
+    :param num_frames: The number of frames sent by each robot
+    :type num_frames: int
+    :param frame_size: The size of each frame in bytes
+    :type frame_size: int
+    :param port: The port of the server
+    :type port: int
+    :param server_class: The server backend to benchmark, defaults to `Server`
+    :type server_class: Type[Server]
+    :return: The aggregate throughput measured by the server
+    :rtype: Dict[str, float]
+    """
+    status_queue = queue.Queue()
+    camera_queue = queue.Queue()
+    server = server_class(port=port, status_queue=status_queue, camera_queue=camera_queue)
+    server.daemon = True
+    server.start()
+    # Give the server some time to start listening
+    time.sleep(0.2)
+
+    # Fake JPEG payload, its content is irrelevant for the server
+    payload = b"\xFF\xD8" + os.urandom(frame_size - 4) + b"\xFF\xD9"
+    ready = multiprocessing.Barrier(num_clients + 1)
+    clients = [
+        multiprocessing.Process(
+            target=_simulated_robot, args=(port, f"robot-{i}", payload, num_frames, ready), daemon=True
+        )
+        for i in range(num_clients)
+    ]
+    for client in clients:
+        client.start()
+
+    ready.wait()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    frames_per_robot = {}
+
+    for _ in range(num_clients * num_frames):
+        _, frame = camera_queue.get(timeout=30)
+        frames_per_robot[frame.robot_id] = frames_per_robot.get(frame.robot_id, 0) + 1
+
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    connected = [data for message_type, data in _drain(status_queue) if message_type is MESSAGE_TYPE.CONNECTED]
+    server.close()
+    for client in clients:
+        client.join()
+
+    assert len(connected) == num_clients, f"Expected {num_clients} robots, got {len(connected)}"
+    assert all(count == num_frames for count in frames_per_robot.values()), "Frames were routed to the wrong robot"
+
+    return {
+        "backend": server_class.__name__,
+        "clients": num_clients,
+        "fps": num_clients * num_frames / elapsed,
+        "mb_per_s": num_clients * num_frames * frame_size / elapsed / 1e6,
+        "cpu_percent": 100.0 * cpu / elapsed,
+    }
+
+
+def run_replay_test(
+    path: str, port: int, server_class: Type[Server] = Server, realtime: bool = False, decode: bool = False
+) -> Dict[str, float]:
+    """Replays a capture of the stream of M.A.R.K. into a server, and measures how fast frames come out of it
+
+    Since captures keep the exact chunks received in the field, this is a repeatable test of frame reassembly, and
+    optionally of decoding, without any hardware.
+
+    :param path: The path of the capture file
+    :type path: str
+    :param port: The port of the server
+    :type port: int
+    :param server_class: The server backend to benchmark, defaults to `Server`
+    :type server_class: Type[Server]
+    :param realtime: Whether to replay the capture with its original timing, defaults to False
+    :type realtime: bool
+    :param decode: Whether to also decode every frame, as the camera feed panel does, defaults to False
+    :type decode: bool
+    :return: The throughput measured by the server, and the number of reassembly errors
+    :rtype: Dict[str, float]
+    """
+    status_queue = queue.Queue()
+    camera_queue = queue.Queue()
+    server = server_class(port=port, status_queue=status_queue, camera_queue=camera_queue)
+    server.daemon = True
+    server.start()
+    # Give the server some time to start listening
+    time.sleep(0.2)
+
+    frames = 0
+    nbytes = 0
+    start = last_frame = time.perf_counter()
+    cpu_start = time.process_time()
+    errors_start = _reassembly_errors()
+    sent = {}
+    sender = threading.Thread(target=lambda: sent.update(replay(path, port=port, realtime=realtime)), daemon=True)
+    sender.start()
+
+    # The replay is over once all chunks were sent and no frame came out of the server for a while
+    while True:
+        try:
+            _, frame = camera_queue.get(timeout=1)
+        except queue.Empty:
+            if not sender.is_alive():
+                break
+            continue
+        if decode:
+            Image.open(io.BytesIO(frame.data)).load()
+        frames += 1
+        nbytes += len(frame.data)
+        last_frame = time.perf_counter()
+
+    elapsed = max(last_frame - start, 1e-9)
+    cpu = time.process_time() - cpu_start
+    server.close()
+
+    return {
+        "backend": server_class.__name__,
+        "chunks": sent.get("chunks", 0),
+        "frames": frames,
+        "errors": _reassembly_errors() - errors_start,
+        "fps": frames / elapsed,
+        "mb_per_s": nbytes / elapsed / 1e6,
+        "cpu_percent": 100.0 * cpu / elapsed,
+    }
+
+
+def run_ui_test(
+    engine_class: Callable[..., Engine],
+    num_clients: int,
+    fps: float,
+    duration_s: float,
+    port: int,
+    recording_format: str = RECORDING_FORMAT.PNG,
+) -> Dict[str, float]:
+    """Runs a GUI-like loop while simulated robots stream to an engine that records every frame
+
+    Every `UI_TICK_S`, the loop takes the latest frame from the camera queue and decodes it at the size of the panel,
+    as the GUI does. How late each tick runs is how much the GUI stutters.
+
+    :param engine_class: The engine to benchmark, `Engine` or `EngineProcess`
+    :type engine_class: Callable[..., Engine]
+    :param num_clients: The number of simulated robots
+    :type num_clients: int
+    :param fps: The frame rate of each robot
+    :type fps: float
+    :param duration_s: How long to record for, in seconds
+    :type duration_s: float
+    :param port: The port of the server
+    :type port: int
+    :param recording_format: The format in which frames are recorded, defaults to `RECORDING_FORMAT.PNG`
+    :type recording_format: str
+    :return: The percentiles of the lateness of the GUI loop, and the frames displayed and recorded
+    :rtype: Dict[str, float]
+    """
+    engine = engine_class(port=port)
+    engine.start()
+    # Give the server some time to start listening
+    time.sleep(0.2)
+
+    # A gradient with some noise, which is costly to encode as a PNG and of a realistic size as a JPEG
+    gradient = Image.linear_gradient("L").resize((640, 480))
+    image = Image.blend(gradient, Image.effect_noise((640, 480), 64), 0.3).convert("RGB")
+    payload = io.BytesIO()
+    image.save(payload, format="JPEG", quality=50)
+    num_frames = int(fps * duration_s)
+    ready = multiprocessing.Barrier(num_clients + 1)
+    clients = [
+        multiprocessing.Process(
+            target=_simulated_robot,
+            args=(port, f"robot-{i}", payload.getvalue(), num_frames, ready, 1.0 / fps),
+            daemon=True,
+        )
+        for i in range(num_clients)
+    ]
+    for client in clients:
+        client.start()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        engine.recorder.start_recording(output_dir, recording_format, mode=RECORDING_MODE.FRAMES)
+        ready.wait()
+
+        lags_ms = []
+        displayed = 0
+        start = time.monotonic()
+        while time.monotonic() - start < duration_s:
+            # Like `Tk.after`, the next tick is scheduled once the previous one is done
+            scheduled = time.monotonic() + UI_TICK_S
+            time.sleep(UI_TICK_S)
+            lags_ms.append((time.monotonic() - scheduled) * 1000.0)
+            try:
+                _, frame = engine.camera_queue.get_nowait()
+            except queue.Empty:
+                continue
+            img = Image.open(io.BytesIO(frame.data))
+            img.draft("RGB", (500, 450))
+            img.resize((500, 450))
+            displayed += 1
+
+        engine.recorder.stop_recording()
+        # The session is saved once the engine is closed, and the images recorded are counted on disk, as the
+        # statistics of the engine may live in another process
+        engine.close()
+        samples = sum(name.endswith(f".{recording_format}") for _, _, names in os.walk(output_dir) for name in names)
+
+    for client in clients:
+        client.join()
+
+    lags_ms.sort()
+    return {
+        "engine": engine_class.__name__,
+        "p50_ms": lags_ms[len(lags_ms) // 2],
+        "p99_ms": lags_ms[int(len(lags_ms) * 0.99)],
+        "max_ms": lags_ms[-1],
+        "displayed_fps": displayed / duration_s,
+        "samples": samples,
+    }
+
+
+def _reassembly_errors() -> int:
+    errors = registry.get("camera.reassembly_errors")
+    return 0 if errors is None else errors.total
+
+
+def _simulated_robot(
+    port: int, robot_id: str, payload: bytes, num_frames: int, ready: multiprocessing.Barrier, interval_s: float = 0.0
+) -> None:
+    sock = socket.create_connection((socket.gethostbyname(socket.gethostname()), port))
+    sock.sendall(encode_hello(robot_id))
+    ready.wait()
+
+    next_frame = time.monotonic()
+    for seq in range(num_frames):
+        sock.sendall(encode_frame_header(seq, int(time.monotonic() * 1000), len(payload)) + payload)
+        # Frames are sent as fast as possible unless an interval is given
+        next_frame += interval_s
+        time.sleep(max(next_frame - time.monotonic(), 0))
+
+    # Wait for the server to close the connection once the benchmark is done
+    sock.recv(1)
+    sock.close()
+
+
+def _drain(message_queue: queue.Queue) -> List:
+    messages = []
+    while not message_queue.empty():
+        messages.append(message_queue.get())
+    return messages
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16], help="Number of simulated robots")
+    parser.add_argument("--frames", type=int, default=200, help="Frames sent by each robot")
+    parser.add_argument("--frame-size", type=int, default=20_000, help="Size of each frame in bytes")
+    parser.add_argument(
+        "--backends", nargs="+", default=list(SERVER_BACKENDS.keys()), choices=SERVER_BACKENDS.keys(), help="Servers"
+    )
+    parser.add_argument("--port", type=int, default=1160, help="First port to use, each run uses the next one")
+    parser.add_argument("--replay", help="Replay this capture instead of simulating robots")
+    parser.add_argument("--realtime", action="store_true", help="Replay the capture with its original timing")
+    parser.add_argument("--decode", action="store_true", help="Also decode the frames of the replayed capture")
+    parser.add_argument(
+        "--ui",
+        action="store_true",
+        help="Measure how much recording stutters the GUI, with the engine in or out of process",
+    )
+    parser.add_argument("--fps", type=float, default=30.0, help="With --ui, frame rate of each robot")
+    parser.add_argument("--duration", type=float, default=10.0, help="With --ui, how long to record for in seconds")
+    args = parser.parse_args()
+
+    if args.ui:
+        print(
+            f"{'engine':>14} {'clients':>8} {'lag p50':>8} {'lag p99':>8} {'lag max':>8} {'shown/s':>8} {'samples':>8}"
+        )
+        # Only imported when needed, as shared memory requires Python 3.8+
+        from engine_process import EngineProcess
+
+        port = args.port
+        for engine_class in (Engine, EngineProcess):
+            for num_clients in args.clients:
+                result = run_ui_test(engine_class, num_clients, args.fps, args.duration, port)
+                port += 1
+                print(
+                    f"{result['engine']:>14} {num_clients:>8} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f}"
+                    f" {result['max_ms']:>8.1f} {result['displayed_fps']:>8.1f} {result['samples']:>8}"
+                )
+    elif args.replay:
+        print(f"{'backend':>14} {'chunks':>8} {'frames':>8} {'errors':>7} {'frames/s':>10} {'MB/s':>8} {'CPU %':>7}")
+        for i, backend in enumerate(args.backends):
+            result = run_replay_test(args.replay, args.port + i, SERVER_BACKENDS[backend], args.realtime, args.decode)
+            print(
+                f"{result['backend']:>14} {result['chunks']:>8} {result['frames']:>8} {result['errors']:>7}"
+                f" {result['fps']:>10.1f} {result['mb_per_s']:>8.1f} {result['cpu_percent']:>7.1f}"
+            )
+    else:
+        print(f"{'backend':>14} {'clients':>8} {'frames/s':>10} {'MB/s':>8} {'CPU %':>7}")
+        port = args.port
+        for backend in args.backends:
+            for num_clients in args.clients:
+                result = run_scale_test(num_clients, args.frames, args.frame_size, port, SERVER_BACKENDS[backend])
+                port += 1
+                print(
+                    f"{result['backend']:>14} {result['clients']:>8} {result['fps']:>10.1f}"
+                    f" {result['mb_per_s']:>8.1f} {result['cpu_percent']:>7.1f}"
+                )
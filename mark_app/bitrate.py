@@ -0,0 +1,142 @@
+"""Defines the feedback loop that adapts the quality and frame rate of the camera feed to the link."""
+import time
+from typing import NamedTuple, Optional, Tuple
+
+
+class BitrateConfig(NamedTuple):
+    """The configuration of the adaptive bitrate controller"""
+
+    # Frame rate that the controller tries to hold
+    target_fps: float = 10.0
+    # Bounds and initial value of the JPEG quality
+    min_quality: int = 10
+    max_quality: int = 90
+    initial_quality: int = 30
+    # Quality added on every window where the target frame rate is held
+    quality_step: int = 5
+    # Factor by which the quality is reduced on every window where the target frame rate is missed
+    quality_backoff: float = 0.7
+    # Bounds of the interval between frames, the lower one being raised to match `target_fps`
+    min_interval_ms: int = 0
+    max_interval_ms: int = 1000
+    # Length of the window over which the link is measured
+    window_s: float = 1.0
+    # Number of consecutive good windows needed before stepping the quality or frame rate back up
+    recovery_windows: int = 2
+
+
+class BitrateController:
+    """Measures the camera feed of a robot and decides the quality and frame interval it should use.
+
+    It follows an additive increase, multiplicative decrease scheme: while the target frame rate is held the quality
+    is slowly raised, and as soon as it is missed, frames stall or the stream gets corrupted the quality is cut. Once
+    the quality hits its lower bound, the frame interval is increased instead, and restored once the link recovers.
+
+    :param config: The configuration of the controller, defaults to `BitrateConfig()`
+    :type config: BitrateConfig
+    """
+
+    def __init__(self, config: BitrateConfig = BitrateConfig()) -> None:
+        self._config = config
+        self._target_interval_ms = max(int(1000.0 / config.target_fps), config.min_interval_ms)
+        self.quality = config.initial_quality
+        self.frame_interval_ms = self._target_interval_ms
+        # Throughput measured over the last window, in bytes per second
+        self.throughput = 0.0
+        # Link measurements over the current window
+        self._window_start = None
+        self._frames = 0
+        self._bytes = 0
+        self._max_gap_s = 0.0
+        self._missing = 0
+        self._last_arrival = None
+        self._last_seq = None
+        self._errors = 0
+        self._last_errors = 0
+        self._good_windows = 0
+
+    def on_frame(self, seq: Optional[int], nbytes: int, errors: int, now: Optional[float] = None) -> None:
+        """Records the arrival of a frame
+
+        :param seq: The sequence number of the frame
+        :type seq: Optional[int]
+        :param nbytes: The size of the frame in bytes
+        :type nbytes: int
+        :param errors: The total number of reassembly errors of the stream so far
+        :type errors: int
+        :param now: The arrival time as given by `time.monotonic()`, defaults to now
+        :type now: Optional[float]
+        """
+        now = time.monotonic() if now is None else now
+        if self._window_start is None:
+            self._window_start = now
+            self._errors = errors
+
+        self._frames += 1
+        self._bytes += nbytes
+        if self._last_arrival is not None:
+            self._max_gap_s = max(self._max_gap_s, now - self._last_arrival)
+        if self._last_seq is not None and seq is not None:
+            # Sequence numbers wrap around, and anything that looks like going backwards is ignored
+            missing = (seq - self._last_seq - 1) & 0xFFFFFFFF
+            if missing < 0x80000000:
+                self._missing += missing
+        self._last_arrival = now
+        self._last_seq = seq
+        self._last_errors = errors
+
+    def update(self, now: Optional[float] = None) -> Optional[Tuple[int, int]]:
+        """Evaluates the link once the current window is over
+
+        It should be called both for every frame and on a timer, since no frame arrives while the feed is stalled.
+
+        :param now: The current time as given by `time.monotonic()`, defaults to now
+        :type now: Optional[float]
+        :return: The new quality and frame interval in milliseconds if they changed, `None` otherwise
+        :rtype: Optional[Tuple[int, int]]
+        """
+        now = time.monotonic() if now is None else now
+        if self._window_start is None or now - self._window_start < self._config.window_s:
+            return None
+
+        config = self._config
+        elapsed = now - self._window_start
+        if self._last_arrival is not None:
+            # A stall that is still going on counts as much as one that is over, so it is noticed while it lasts
+            self._max_gap_s = max(self._max_gap_s, now - self._last_arrival)
+        fps = self._frames / elapsed
+        self.throughput = self._bytes / elapsed
+        expected_fps = min(config.target_fps, 1000.0 / max(self.frame_interval_ms, 1))
+        # A stall is a gap between frames much longer than the interval we asked for
+        stalled = self._max_gap_s * 1000.0 > 3 * max(self.frame_interval_ms, 1000.0 / config.target_fps)
+        corrupted = self._last_errors > self._errors or self._missing > 0
+        quality, frame_interval_ms = self.quality, self.frame_interval_ms
+
+        if fps < 0.9 * expected_fps or stalled or corrupted:
+            self._good_windows = 0
+            if quality > config.min_quality:
+                quality = max(int(quality * config.quality_backoff), config.min_quality)
+            else:
+                frame_interval_ms = min(int(frame_interval_ms * 1.5) + 1, config.max_interval_ms)
+        else:
+            self._good_windows += 1
+            if self._good_windows >= config.recovery_windows:
+                self._good_windows = 0
+                if frame_interval_ms > self._target_interval_ms:
+                    # Recover the frame rate before spending the headroom on quality
+                    frame_interval_ms = max(int(frame_interval_ms / 1.5), self._target_interval_ms)
+                else:
+                    quality = min(quality + config.quality_step, config.max_quality)
+
+        self._window_start = now
+        self._frames = 0
+        self._bytes = 0
+        self._max_gap_s = 0.0
+        self._missing = 0
+        self._errors = self._last_errors
+
+        if (quality, frame_interval_ms) == (self.quality, self.frame_interval_ms):
+            return None
+
+        self.quality, self.frame_interval_ms = quality, frame_interval_ms
+        return quality, frame_interval_ms
@@ -0,0 +1,170 @@
+"""Captures the raw byte streams received from M.A.R.K., and replays them into a server."""
+import argparse
+import logging
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, ByteString, Dict, Iterator, Optional, Tuple, Union
+
+# Every capture starts with a magic and a version
+CAPTURE_MAGIC = b"MKCAP"
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct(">5sB")
+# Each chunk is stored as it was received: seconds since the first chunk, length and then the bytes themselves
+CHUNK_HEADER = struct.Struct(">dI")
+CAPTURE_SUFFIX = ".mkcap"
+
+
+class CaptureWriter:
+    """Writes the chunks received from a connection to a capture file, along with their timing.
+
+    Chunks are kept exactly as received, so that a replay reproduces the packet boundaries seen in the field.
+
+    :param path: The path of the capture file
+    :type path: Union[str, Path]
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self._file = open(self.path, "wb")
+        self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+        self._start = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_connection(cls, capture_dir: Union[str, Path], peer_host: str) -> "CaptureWriter":
+        """Creates a capture file for a new connection
+
+        :param capture_dir: The directory where captures are saved to
+        :type capture_dir: Union[str, Path]
+        :param peer_host: The address of the robot, which is part of the file name
+        :type peer_host: str
+        :return: The writer of the capture
+        :rtype: CaptureWriter
+        """
+        capture_dir = Path(capture_dir)
+        capture_dir.mkdir(parents=True, exist_ok=True)
+        name = f"{peer_host}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')}{CAPTURE_SUFFIX}"
+
+        return cls(capture_dir.joinpath(name))
+
+    def write(self, data: ByteString, now: Optional[float] = None) -> None:
+        """Writes a chunk
+
+        :param data: The bytes of the chunk
+        :type data: ByteString
+        :param now: The time at which the chunk was received as given by `time.monotonic()`, defaults to now
+        :type now: Optional[float]
+        """
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._start is None:
+                self._start = now
+            self._file.write(CHUNK_HEADER.pack(now - self._start, len(data)))
+            self._file.write(data)
+
+    def close(self) -> None:
+        """Closes the capture file"""
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path: Union[str, Path]) -> Iterator[Tuple[float, bytes]]:
+    """Reads the chunks of a capture file
+
+    A capture that was cut short, e.g. because the app crashed, is read up to its last complete chunk.
+
+    :param path: The path of the capture file
+    :type path: Union[str, Path]
+    :return: The seconds since the first chunk and the bytes of each chunk, in order
+    :rtype: Iterator[Tuple[float, bytes]]
+    """
+    with open(path, "rb") as f:
+        magic, version = CAPTURE_HEADER.unpack(_read_exactly(f, CAPTURE_HEADER.size))
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise ValueError(f"{path} is not a capture file")
+
+        while True:
+            header = _read_exactly(f, CHUNK_HEADER.size)
+            if header is None:
+                return
+            offset, length = CHUNK_HEADER.unpack(header)
+            data = _read_exactly(f, length)
+            if data is None:
+                return
+            yield offset, data
+
+
+def replay(
+    path: Union[str, Path], host: Optional[str] = None, port: int = 1060, realtime: bool = True
+) -> Dict[str, float]:
+    """Replays a capture into a server, as if it was M.A.R.K.
+
+    :param path: The path of the capture file
+    :type path: Union[str, Path]
+    :param host: The address of the server, defaults to the address of this host as used by `Server`
+    :type host: Optional[str]
+    :param port: The port of the server, defaults to 1060
+    :type port: int
+    :param realtime: Whether to send the chunks with their original timing, or as fast as possible otherwise,
+        defaults to True
+    :type realtime: bool
+    :return: The number of chunks and bytes sent, and how long it took
+    :rtype: Dict[str, float]
+    """
+    host = socket.gethostbyname(socket.gethostname()) if host is None else host
+    sock = socket.create_connection((host, port))
+    # Commands sent by the server must be drained, otherwise it could end up blocked sending them
+    threading.Thread(target=_drain, args=(sock,), daemon=True).start()
+
+    chunks = 0
+    nbytes = 0
+    start = time.monotonic()
+    try:
+        for offset, data in read_capture(path):
+            if realtime:
+                time.sleep(max(start + offset - time.monotonic(), 0))
+            sock.sendall(data)
+            chunks += 1
+            nbytes += len(data)
+    finally:
+        elapsed = time.monotonic() - start
+        sock.close()
+
+    return {"chunks": chunks, "bytes": nbytes, "seconds": elapsed}
+
+
+def _read_exactly(f: BinaryIO, size: int) -> Optional[bytes]:
+    data = f.read(size)
+    return data if len(data) == size else None
+
+
+def _drain(sock: socket.socket) -> None:
+    try:
+        while sock.recv(4096):
+            pass
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Replays a capture of the stream of M.A.R.K. into a running app")
+    parser.add_argument("capture", help="The capture file, as saved with `python app.py --capture-dir`")
+    parser.add_argument("--host", help="The address of the server, defaults to this host")
+    parser.add_argument("--port", type=int, default=1060, help="The port of the server")
+    parser.add_argument("--max-speed", action="store_true", help="Send as fast as possible instead of in real time")
+    args = parser.parse_args()
+
+    result = replay(args.capture, args.host, args.port, realtime=not args.max_speed)
+    print(
+        f"Sent {result['chunks']} chunks ({result['bytes'] / 1e6:.1f} MB) in {result['seconds']:.2f} s, "
+        f"{result['bytes'] / max(result['seconds'], 1e-9) / 1e6:.1f} MB/s"
+    )
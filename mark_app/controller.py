@@ -1,11 +1,16 @@
 """Defines the interface for a keyboard controller."""
 import queue
 import threading
+import time
 from typing import Dict, List
 
 from inputs import get_key
 
 from common import MESSAGE_TYPE
+from key_events import KeyEventRing
+from protocol import encode_keys_command, encode_legacy_keys_command
+from server import Server
+from stats import registry
 
 
 # Modified from: https://github.com/kevinhughes27/TensorKart/blob/master/utils.py#L41
@@ -35,6 +40,12 @@ class KeyboardController(threading.Thread):
         }
         # Key to its command code
         self._key_to_command = {key: index + 1 for index, key in enumerate(self._keys.keys())}
+        # Every transition of the keys, so that taps shorter than the sample rate of the recorder aren't lost
+        self.events = KeyEventRing()
+        self._pressed = 0
+        # Set on every transition, so commands can be sent as soon as a key changes, along with the time it changed
+        self.changed = threading.Event()
+        self.changed_at = 0.0
 
     def run(self) -> None:
         while True:
@@ -45,10 +56,9 @@ class KeyboardController(threading.Thread):
                         continue
 
                     # For some reason, key D = KEY_RESERVED
-                    if event.code == "KEY_RESERVED":
-                        self._keys["KEY_D"] = event.state
-                    else:
-                        self._keys[event.code] = event.state
+                    key = "KEY_D" if event.code == "KEY_RESERVED" else event.code
+                    self._keys[key] = event.state
+                    self._log_transition(key, event.state)
 
                     # Send the message only if the key is pressed
                     if event.state != 1:
@@ -58,6 +68,16 @@ class KeyboardController(threading.Thread):
                 # Ignore any errors from `inputs` library
                 pass
 
+    def _log_transition(self, key: str, state: int) -> None:
+        # Keys being held are reported again with state 2, which isn't a transition
+        bit = 1 << (self._key_to_command[key] - 1)
+        pressed = (self._pressed | bit) if state else (self._pressed & ~bit)
+        if pressed != self._pressed:
+            self._pressed = pressed
+            self.changed_at = time.monotonic()
+            self.events.append(self.changed_at, self._key_to_command[key] - 1, bool(state), pressed)
+            self.changed.set()
+
     def keys(self) -> List[str]:
         """Returns the supported keys
 
@@ -74,6 +94,15 @@ class KeyboardController(threading.Thread):
         """
         return self._keys.copy()
 
+    def read_bitmask(self) -> int:
+        """Reads the latest controller values as a bitmask
+
+        :return: A bitmask where bit `i` is set if the key with command code `i + 1` is pressed
+        :rtype: int
+        """
+        keys = self._keys.copy()
+        return sum(1 << (self._key_to_command[key] - 1) for key, value in keys.items() if value)
+
     def key_to_command(self, key: str) -> int:
         """Converts a key to its command code.
 
@@ -83,3 +112,63 @@ class KeyboardController(threading.Thread):
         :rtype: int
         """
         return self._key_to_command[key]
+
+
+class CommandSender(threading.Thread):
+    """Sends the full state of the controller to M.A.R.K. at a fixed rate, and right away whenever a key changes.
+
+    Since every command carries the state of all keys, M.A.R.K. only needs to apply the latest one it received, and
+    releasing a key is sent as any other change. Commands sent at the fixed rate keep M.A.R.K. up to date even if a
+    command is lost. Robots running older versions of `remote.py` are only sent the keys just pressed, one byte each.
+
+    :param server: The server that sends commands to M.A.R.K.
+    :type server: Server
+    :param controller: The controller that reads the keyboard input
+    :type controller: KeyboardController
+    :param rate_hz: The number of commands sent per second
+    :type rate_hz: float
+    """
+
+    def __init__(self, server: Server, controller: KeyboardController, rate_hz: float) -> None:
+        super().__init__()
+
+        self._server = server
+        self._controller = controller
+        self._period = 1.0 / rate_hz
+        self._seq = 0
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        next_tick = time.monotonic()
+        changed_at = None
+        pressed = 0
+
+        while not self._stopped.is_set():
+            keys = self._controller.read_bitmask()
+            command = encode_keys_command(self._seq, int(time.monotonic() * 1000), keys)
+            # Older versions of `remote.py` move one step per byte received, so like the app used to, they are only
+            # sent the keys that were just pressed
+            self._server.send_command(command, encode_legacy_keys_command(keys & ~pressed))
+            pressed = keys
+            self._seq += 1
+            registry.counter("commands.sent").inc()
+            if changed_at is not None:
+                # Time from a key changing until its command was sent
+                registry.histogram("commands.key_to_wire_ms").observe((time.monotonic() - changed_at) * 1000.0)
+                changed_at = None
+
+            now = time.monotonic()
+            if now >= next_tick:
+                # Schedule ticks from the previous one instead of from now, so the rate doesn't drift
+                next_tick += self._period * (int((now - next_tick) / self._period) + 1)
+            # Wait for the next tick, unless a key changes before
+            if self._controller.changed.wait(next_tick - now):
+                self._controller.changed.clear()
+                changed_at = self._controller.changed_at
+
+    def close(self) -> None:
+        """Stops sending commands"""
+        self._stopped.set()
+        self._controller.changed.set()
+        if self.is_alive():
+            self.join()
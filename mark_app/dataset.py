@@ -0,0 +1,260 @@
+"""Loads recorded sessions as memory-mapped NumPy arrays, ready to be batched for training."""
+import argparse
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from labels import LABELS_FILE, read_labels
+from shards import METADATA_FILE, ShardReader
+
+CACHE_DIR = "cache"
+CACHE_VERSION = 1
+# Default size of the cached frames, as (width, height)
+DEFAULT_FRAME_SIZE = (160, 144)
+
+
+class Dataset:
+    """The frames and labels of a recorded session, backed by memory-mapped arrays.
+
+    Frames are stored as a `uint8` array of shape (samples, height, width, 3) and labels as a `uint8` array of shape
+    (samples, keys), where each column tells whether a key of the controller was pressed. Samples are cached in a
+    fixed random order, so contiguous slices are already shuffled and batches are views into the cache, not copies.
+
+    :param frames: The frames of the session
+    :type frames: np.ndarray
+    :param labels: The labels of the session
+    :type labels: np.ndarray
+    :param indices: The index of each sample in the session, since the cache is shuffled
+    :type indices: np.ndarray
+    :param keys: The keys of the controller, in the order of the columns of the labels
+    :type keys: List[str]
+    """
+
+    def __init__(self, frames: np.ndarray, labels: np.ndarray, indices: np.ndarray, keys: List[str]) -> None:
+        self.frames = frames
+        self.labels = labels
+        self.indices = indices
+        self.keys = keys
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def batches(
+        self, batch_size: int, shuffle: bool = True, drop_last: bool = False, seed: Optional[int] = None
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Iterates over the mini-batches of an epoch
+
+        :param batch_size: The number of samples per batch
+        :type batch_size: int
+        :param shuffle: Whether to visit the batches in a different random order on every epoch, defaults to True
+        :type shuffle: bool
+        :param drop_last: Whether to skip the last batch if it is smaller than `batch_size`, defaults to False
+        :type drop_last: bool
+        :param seed: The seed of the order of the batches, defaults to None
+        :type seed: Optional[int]
+        :return: The frames and labels of each batch, as views into the cache
+        :rtype: Iterator[Tuple[np.ndarray, np.ndarray]]
+        """
+        starts = np.arange(0, len(self), batch_size)
+        if drop_last and len(self) % batch_size:
+            starts = starts[:-1]
+        if shuffle:
+            np.random.default_rng(seed).shuffle(starts)
+
+        for start in starts:
+            yield self.frames[start : start + batch_size], self.labels[start : start + batch_size]
+
+
+def load_session(
+    session_dir: Union[str, Path], frame_size: Tuple[int, int] = DEFAULT_FRAME_SIZE, workers: int = 4, seed: int = 0
+) -> Dataset:
+    """Loads a recorded session, building its cache first if it is missing or older than the session
+
+    Sessions with loose images, whether labelled by a label log or a csv file, and sharded sessions are supported,
+    whatever the format of their images.
+
+    :param session_dir: The directory of the session, as created by `Recorder.start_recording`
+    :type session_dir: Union[str, Path]
+    :param frame_size: The size to which frames are resized, as (width, height), defaults to `DEFAULT_FRAME_SIZE`
+    :type frame_size: Tuple[int, int]
+    :param workers: The number of threads decoding frames while building the cache, defaults to 4
+    :type workers: int
+    :param seed: The seed of the order of the samples in the cache, defaults to 0
+    :type seed: int
+    :return: The dataset of the session
+    :rtype: Dataset
+    """
+    session_dir = Path(session_dir)
+    cache_dir = session_dir.joinpath(CACHE_DIR)
+    name = f"{frame_size[0]}x{frame_size[1]}"
+    manifest_path = cache_dir.joinpath(f"{name}.json")
+    source_mtime = session_mtime(session_dir)
+
+    manifest = None
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    if manifest is None or manifest["version"] != CACHE_VERSION or manifest["source_mtime"] < source_mtime:
+        manifest = _build_cache(session_dir, cache_dir, name, frame_size, workers, seed, source_mtime)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    return Dataset(
+        np.load(cache_dir.joinpath(f"{name}_frames.npy"), mmap_mode="r"),
+        np.load(cache_dir.joinpath(f"{name}_labels.npy"), mmap_mode="r"),
+        np.load(cache_dir.joinpath(f"{name}_indices.npy"), mmap_mode="r"),
+        manifest["keys"],
+    )
+
+
+def _build_cache(
+    session_dir: Path,
+    cache_dir: Path,
+    name: str,
+    frame_size: Tuple[int, int],
+    workers: int,
+    seed: int,
+    source_mtime: float,
+) -> dict:
+    keys, read_image, labels, close = open_session(session_dir)
+    cache_dir.mkdir(exist_ok=True)
+    order = np.random.default_rng(seed).permutation(len(labels))
+
+    # Arrays are written to temporary files first, so a cache cut short is never mistaken for a complete one
+    frames_path = cache_dir.joinpath(f"{name}_frames.npy")
+    frames = np.lib.format.open_memmap(
+        str(frames_path) + ".tmp", mode="w+", dtype=np.uint8, shape=(len(order), frame_size[1], frame_size[0], 3)
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        decoded = executor.map(lambda index: decode_frame(read_image(index), frame_size), order)
+        for position, frame in enumerate(decoded):
+            frames[position] = frame
+    close()
+    frames.flush()
+    del frames
+    os.replace(str(frames_path) + ".tmp", frames_path)
+
+    np.save(cache_dir.joinpath(f"{name}_labels.npy"), labels[order])
+    np.save(cache_dir.joinpath(f"{name}_indices.npy"), order.astype(np.uint32))
+
+    return {"version": CACHE_VERSION, "keys": keys, "samples": len(order), "source_mtime": source_mtime}
+
+
+def is_session(directory: Union[str, Path]) -> bool:
+    """Tells whether a directory holds a recording session
+
+    :param directory: The directory
+    :type directory: Union[str, Path]
+    :return: Whether the directory holds a session, either sharded or with loose images
+    :rtype: bool
+    """
+    return any(Path(directory).joinpath(name).exists() for name in (METADATA_FILE, LABELS_FILE, "data.csv"))
+
+
+def open_session(
+    session_dir: Path,
+) -> Tuple[List[str], Callable[[int], Union[Path, bytes]], np.ndarray, Callable[[], None]]:
+    """Opens a recording session
+
+    :param session_dir: The directory of the session
+    :type session_dir: Path
+    :return: The keys of the controller, a function that returns the image of a sample (either its bytes or its
+        path), the labels of all samples as a `uint8` array of shape (samples, keys), and a function closing the
+        session
+    :rtype: Tuple[List[str], Callable[[int], Union[Path, bytes]], np.ndarray, Callable[[], None]]
+    """
+    if session_dir.joinpath(METADATA_FILE).exists():
+        reader = ShardReader(session_dir)
+        controller = [list(reader.controller(i).values()) for i in range(len(reader))]
+        labels = np.array(controller, dtype=np.uint8).reshape(-1, len(reader.keys))
+        return reader.keys, lambda index: reader[index].data, _pressed(labels), reader.close
+
+    if session_dir.joinpath(LABELS_FILE).exists():
+        labels = read_labels(session_dir.joinpath(LABELS_FILE))
+        images = [session_dir.joinpath(f"{frame}.{labels.recording_format}") for frame in labels.frame]
+        pressed = (labels.keys_pressed[:, None] >> np.arange(len(labels.keys), dtype=np.uint16)) & 1
+        return labels.keys, images.__getitem__, pressed.astype(np.uint8), lambda: None
+
+    # Sessions recorded before labels were logged in binary
+    with open(session_dir.joinpath("data.csv"), newline="") as f:
+        rows = list(csv.reader(f))
+    keys = rows[0][1:]
+    # Images are referenced by absolute path, which breaks once sessions are moved around
+    images = [Path(row[0]) if Path(row[0]).exists() else session_dir.joinpath(Path(row[0]).name) for row in rows[1:]]
+    labels = np.array([[int(value) for value in row[1:]] for row in rows[1:]], dtype=np.uint8).reshape(-1, len(keys))
+
+    return keys, images.__getitem__, _pressed(labels), lambda: None
+
+
+def _pressed(labels: np.ndarray) -> np.ndarray:
+    # Keys being held are reported as 2 by `inputs`, which is still a pressed key
+    return (labels != 0).astype(np.uint8)
+
+
+def decode_frame(image: Union[Path, bytes], frame_size: Tuple[int, int]) -> np.ndarray:
+    """Decodes an image in any recording format, and resizes it
+
+    :param image: The path or the bytes of the image
+    :type image: Union[Path, bytes]
+    :param frame_size: The size of the frame, as (width, height)
+    :type frame_size: Tuple[int, int]
+    :return: The frame, as a `uint8` array of shape (height, width, 3)
+    :rtype: np.ndarray
+    """
+    if isinstance(image, Path):
+        if image.suffix == ".npy":
+            return _resize(Image.fromarray(np.load(image)), frame_size)
+        with open(image, "rb") as f:
+            image = f.read()
+
+    if image.startswith(b"\x93NUMPY"):
+        return _resize(Image.fromarray(np.load(io.BytesIO(image))), frame_size)
+
+    decoded = Image.open(io.BytesIO(image))
+    # JPEGs can be decoded at a fraction of their size directly, which is much faster than decoding them whole
+    decoded.draft("RGB", frame_size)
+    return _resize(decoded, frame_size)
+
+
+def _resize(image: Image.Image, frame_size: Tuple[int, int]) -> np.ndarray:
+    return np.asarray(image.convert("RGB").resize(frame_size, Image.BILINEAR), dtype=np.uint8)
+
+
+def session_mtime(session_dir: Path) -> float:
+    """Returns when a session was last modified
+
+    :param session_dir: The directory of the session
+    :type session_dir: Path
+    :return: The latest modification time of the files of the session, ignoring its cache
+    :rtype: float
+    """
+    return max(
+        (entry.stat().st_mtime for entry in os.scandir(session_dir) if entry.is_file()),
+        default=0.0,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the cache of recorded sessions, and measures an epoch")
+    parser.add_argument("sessions", nargs="+", help="The directories of the sessions")
+    parser.add_argument("--size", type=int, nargs=2, default=DEFAULT_FRAME_SIZE, help="Width and height of frames")
+    parser.add_argument("--batch-size", type=int, default=64, help="The number of samples per batch")
+    args = parser.parse_args()
+
+    for session in args.sessions:
+        start = time.perf_counter()
+        dataset = load_session(session, tuple(args.size))
+        loaded = time.perf_counter()
+        # Reading every byte of every batch, as a training step would
+        for frames, _ in dataset.batches(args.batch_size):
+            frames.max()
+        epoch = time.perf_counter()
+        print(f"{session}: {len(dataset)} samples, loaded in {loaded - start:.2f} s, epoch in {epoch - loaded:.3f} s")
@@ -0,0 +1,88 @@
+"""Defines a dispatcher that fans the messages of a queue out to several subscribers."""
+import logging
+import queue
+import threading
+from typing import Any, Callable, Dict, List
+
+# How long consumers block waiting for a message before checking whether they should stop, which only bounds how
+# long stopping takes, as messages are handled as soon as they arrive
+STOP_CHECK_INTERVAL_S = 0.5
+
+
+class Dispatcher(threading.Thread):
+    """Consumes a queue and calls the subscribers of each message as soon as it arrives.
+
+    Messages are `(message_type, data)` tuples, as put by the server and the controller, and every subscriber of a
+    message type is called with its data, in the order in which they subscribed. Subscribers run on the dispatcher
+    thread, so they should be quick, and an exception raised by one of them doesn't keep the others from being called.
+
+    :param message_queue: The queue to consume, either a `queue.Queue` or a `Mailbox`
+    :type message_queue: queue.Queue
+    :param name: The name of the thread, defaults to "Dispatcher"
+    :type name: str
+    """
+
+    def __init__(self, message_queue: queue.Queue, name: str = "Dispatcher") -> None:
+        super().__init__(name=name)
+
+        self._message_queue = message_queue
+        # Subscribers are copied on write, so messages can be dispatched without holding the lock
+        self._subscribers: Dict[str, List[Callable[[Any], None]]] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def subscribe(self, message_type: str, callback: Callable[[Any], None]) -> None:
+        """Calls `callback` with the data of every message of `message_type`
+
+        :param message_type: The type of the messages, one of `MESSAGE_TYPE`
+        :type message_type: str
+        :param callback: The function called with the data of each message
+        :type callback: Callable[[Any], None]
+        """
+        with self._lock:
+            self._subscribers = {
+                **self._subscribers,
+                message_type: self._subscribers.get(message_type, []) + [callback],
+            }
+
+    def unsubscribe(self, message_type: str, callback: Callable[[Any], None]) -> None:
+        """Stops calling `callback` with the messages of `message_type`
+
+        :param message_type: The type of the messages
+        :type message_type: str
+        :param callback: The function passed to `subscribe`
+        :type callback: Callable[[Any], None]
+        """
+        with self._lock:
+            self._subscribers = {
+                **self._subscribers,
+                message_type: [c for c in self._subscribers.get(message_type, []) if c != callback],
+            }
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                message_type, data = self._message_queue.get(timeout=STOP_CHECK_INTERVAL_S)
+            except queue.Empty:
+                continue
+
+            subscribers = self._subscribers.get(message_type)
+            if not subscribers:
+                logging.warning("No subscriber for message type %s", message_type)
+                continue
+
+            for callback in subscribers:
+                try:
+                    callback(data)
+                except Exception:
+                    logging.exception("Subscriber of %s failed", message_type)
+
+    def close(self, timeout: float = STOP_CHECK_INTERVAL_S * 2) -> None:
+        """Stops dispatching, once the message being dispatched has been handled
+
+        :param timeout: The maximum time to wait for the thread to stop, defaults to twice `STOP_CHECK_INTERVAL_S`
+        :type timeout: float
+        """
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,205 @@
+"""Runs the server, the controller and the recorder of the app, with or without its GUI."""
+import argparse
+import logging
+import queue
+import signal
+import threading
+from typing import Dict, Optional
+
+from bitrate import BitrateConfig
+from common import MESSAGE_TYPE
+from controller import CommandSender, KeyboardController
+from dispatcher import Dispatcher
+from mailboxes import POLICY, Mailbox
+from recorder import RECORDING_FORMAT, RECORDING_MODE, Recorder
+from server import Server
+from stats import registry
+
+# Number of commands sent to M.A.R.K. per second
+COMMAND_RATE_HZ = 20
+
+
+class Engine:
+    """Everything the app needs to control M.A.R.K. and record data, without any GUI.
+
+    The GUI is built on top of the engine, consuming the queues it exposes, while data-collection boxes without a
+    display run the engine alone.
+
+    :param port: The port on which M.A.R.K. connects, defaults to 1060
+    :type port: int
+    :param sample_rate_ms: The rate at which the recorder samples data in milliseconds, defaults to 200
+    :type sample_rate_ms: int
+    :param metrics_port: If given, the port on which statistics are published for Prometheus, defaults to None
+    :type metrics_port: Optional[int]
+    :param capture_dir: If given, the raw stream received from M.A.R.K. is captured to this directory, defaults to None
+    :type capture_dir: Optional[str]
+    """
+
+    def __init__(
+        self,
+        port: int = 1060,
+        sample_rate_ms: int = 200,
+        metrics_port: Optional[int] = None,
+        capture_dir: Optional[str] = None,
+    ) -> None:
+        # Queue to receive status messages from M.A.R.K.
+        self.status_queue = queue.Queue()
+        # Mailbox to receive camera feed data from M.A.R.K., only the latest frame is kept so that the feed never
+        # lags behind when decoding is slower than the frame rate
+        self.camera_queue = Mailbox(POLICY.KEEP_LATEST)
+        # Mailbox to receive controller feed data, bounded since nothing consumes it without the GUI
+        self.controller_queue = Mailbox(POLICY.KEEP_LATEST, maxsize=256)
+
+        self.server = Server(
+            port=port,
+            status_queue=self.status_queue,
+            camera_queue=self.camera_queue,
+            # Adapt the quality and frame rate of the camera feed to the link
+            bitrate_config=BitrateConfig(target_fps=10),
+            capture_dir=capture_dir,
+        )
+        self.controller = KeyboardController(message_queue=self.controller_queue)
+        self.command_sender = CommandSender(self.server, self.controller, rate_hz=COMMAND_RATE_HZ)
+        self.recorder = Recorder(self.server, self.controller, sample_rate_ms=sample_rate_ms)
+        # Status messages are fanned out to whoever subscribes, e.g. the GUI
+        self.status_dispatcher = Dispatcher(self.status_queue, name="StatusDispatcher")
+        self.status_dispatcher.subscribe(MESSAGE_TYPE.CONNECTED, self._on_connected)
+        self.status_dispatcher.subscribe(MESSAGE_TYPE.DISCONNECTED, self._on_disconnected)
+        # Registered here rather than by the GUI, so that they are published when running headless too
+        registry.gauge("queue.status", self.status_queue.qsize)
+        registry.gauge("queue.camera", self.camera_queue.qsize)
+        registry.gauge("queue.controller", self.controller_queue.qsize)
+        registry.gauge("camera.dropped", lambda: self.camera_queue.dropped)
+
+        self.metrics_server = None
+        if metrics_port is not None:
+            # Only imported when needed, as the HTTP server takes a good part of the startup
+            from metrics import MetricsServer
+
+            self.metrics_server = MetricsServer(metrics_port)
+
+    def start(self) -> None:
+        """Starts accepting M.A.R.K., reading the keyboard and sending commands"""
+        # The server, the controller and the metrics server block on I/O that can't be interrupted, so they are
+        # daemons, while the other threads are stopped by `close`
+        self.server.daemon = True
+        self.server.start()
+        self.controller.daemon = True
+        self.controller.start()
+        self.command_sender.start()
+        self.recorder.start()
+        self.status_dispatcher.start()
+        if self.metrics_server is not None:
+            self.metrics_server.daemon = True
+            self.metrics_server.start()
+
+    def close(self) -> None:
+        """Stops the engine, saving the session being recorded if any"""
+        # Threads are stopped in order, so none of them is left waiting on one that already stopped
+        self.status_dispatcher.close()
+        self.command_sender.close()
+        self.recorder.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.server.close()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns the statistics of the engine
+
+        :return: The snapshot of each statistic, by name
+        :rtype: Dict[str, Dict[str, float]]
+        """
+        return registry.snapshot()
+
+    def _on_connected(self, robot_id: str) -> None:
+        logging.info("M.A.R.K. %s connected", robot_id)
+        registry.counter("robots.connections").inc()
+
+    def _on_disconnected(self, robot_id: str) -> None:
+        logging.info("M.A.R.K. %s disconnected", robot_id)
+        registry.counter("robots.disconnections").inc()
+
+
+def run_headless(engine: Engine, output_dir: str, recording_format: str, sharded: bool, mode: str) -> None:
+    """Records until the process is interrupted or terminated
+
+    :param engine: The engine, not started yet
+    :type engine: Engine
+    :param output_dir: The directory where sessions are saved to
+    :type output_dir: str
+    :param recording_format: The format in which camera images are saved, one of `RECORDING_FORMAT`
+    :type recording_format: str
+    :param sharded: Whether to save samples to shards
+    :type sharded: bool
+    :param mode: When samples are recorded, one of `RECORDING_MODE`
+    :type mode: str
+    """
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopped.set())
+
+    engine.start()
+    engine.recorder.start_recording(output_dir, recording_format, sharded, mode)
+    logging.info("Recording to %s, press Ctrl+C to stop", output_dir)
+
+    while not stopped.wait(60.0):
+        logging.info("Recorded %s samples so far", registry.counter("recorder.samples").total)
+
+    engine.close()
+    logging.info("Recorded %s samples", registry.counter("recorder.samples").total)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Runs the M.A.R.K. app, with or without its GUI")
+    parser.add_argument("--port", type=int, default=1060, help="Port on which M.A.R.K. connects")
+    parser.add_argument("--output", help="Directory where sessions are saved to, required without the GUI")
+    parser.add_argument("--sample-rate-ms", type=int, default=200, help="Rate at which samples are recorded")
+    parser.add_argument(
+        "--format",
+        default=RECORDING_FORMAT.JPEG,
+        choices=[RECORDING_FORMAT.JPEG, RECORDING_FORMAT.PNG, RECORDING_FORMAT.NPY],
+        help="Format in which camera images are saved",
+    )
+    parser.add_argument("--sharded", action="store_true", help="Save samples to shards instead of one file per image")
+    parser.add_argument("--every-frame", action="store_true", help="Record every frame instead of sampling on a timer")
+    parser.add_argument("--metrics-port", type=int, help="Publish statistics for Prometheus on this port, e.g. 9100")
+    parser.add_argument("--capture-dir", help="Capture the raw stream received from M.A.R.K. to this directory")
+    parser.add_argument("--gui", action="store_true", help="Run the GUI, recording only when asked to")
+    parser.add_argument("--max-display-fps", type=float, default=30.0, help="With the GUI, display at most this FPS")
+    parser.add_argument(
+        "--multiprocess",
+        action="store_true",
+        help="With the GUI, run the engine in its own process, so recording doesn't stutter the GUI",
+    )
+    args = parser.parse_args()
+
+    if not args.gui and args.output is None:
+        parser.error("--output is required without the GUI")
+
+    engine_kwargs = dict(
+        port=args.port,
+        sample_rate_ms=args.sample_rate_ms,
+        metrics_port=args.metrics_port,
+        capture_dir=args.capture_dir,
+    )
+    if args.gui:
+        # The GUI, Tk and matplotlib are only imported when needed, since importing them takes most of the startup
+        from app import run_gui
+
+        if args.multiprocess:
+            from engine_process import EngineProcess
+
+            run_gui(EngineProcess(**engine_kwargs), args.max_display_fps)
+        else:
+            run_gui(Engine(**engine_kwargs), args.max_display_fps)
+    else:
+        engine = Engine(**engine_kwargs)
+        run_headless(
+            engine,
+            args.output,
+            args.format,
+            args.sharded,
+            RECORDING_MODE.FRAMES if args.every_frame else RECORDING_MODE.TIMER,
+        )
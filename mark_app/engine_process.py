@@ -0,0 +1,470 @@
+"""Runs the engine in its own process, passing frames through shared memory and everything else through a pipe."""
+import functools
+import logging
+import multiprocessing
+import multiprocessing.synchronize
+import queue
+import signal
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional, Tuple
+
+from common import MESSAGE_TYPE
+from dispatcher import STOP_CHECK_INTERVAL_S, Dispatcher
+from engine import Engine
+from mailboxes import POLICY, Mailbox
+from protocol import Frame
+from stats import registry
+
+# Number of frames the shared memory holds, the reader only ever takes the latest one so a few are enough for it to
+# never be lapped while copying
+FRAME_SLOTS = 4
+# Frames larger than this are dropped and counted in `ipc.oversized`, M.A.R.K. sends frames of about 20 KB
+MAX_FRAME_BYTES = 1024 * 1024
+# Frames of robots whose id is longer than this once encoded are dropped and counted in `ipc.oversized` too
+MAX_ROBOT_ID_BYTES = 64
+# Interval between the statistics sent by the engine process, in seconds
+STATS_INTERVAL_S = 1.0
+# Maximum time to wait for the engine process to start, or to hear from it while it stops, in seconds
+PROCESS_TIMEOUT_S = 10.0
+
+# Sequence number of the latest frame written, the number of slots and the maximum size of a frame
+_RING_HEADER = struct.Struct("<QII")
+# Sequence numbers of the frame in a slot, set before and after the frame is written
+_SLOT_SEQ = struct.Struct("<Q")
+# Kind, sequence number, timestamp, length, started and received times and robot id of the frame in a slot. Sequence
+# numbers and timestamps are -1 for legacy frames, which have none
+_SLOT_META = struct.Struct(f"<Bqqldd{MAX_ROBOT_ID_BYTES}s")
+_SLOT_HEADER_SIZE = 2 * _SLOT_SEQ.size + _SLOT_META.size
+
+
+class ENGINE_MESSAGE:
+    """Defines the messages exchanged with the engine process, on top of `MESSAGE_TYPE`"""
+
+    # Sent by the engine process once started, with the keys of the controller
+    READY = "READY"
+    # Sent by the engine process every `STATS_INTERVAL_S`, with the snapshot of its statistics
+    STATS = "STATS"
+    START_RECORDING = "START_RECORDING"
+    STOP_RECORDING = "STOP_RECORDING"
+    CLOSE_CONNECTION = "CLOSE_CONNECTION"
+    SHUTDOWN = "SHUTDOWN"
+    # Sent by the engine process once stopped, after saving the session being recorded if any
+    CLOSED = "CLOSED"
+
+
+class FrameSlots:
+    """A ring of frames in shared memory, written by a single process and read by another without any lock.
+
+    Each slot is stamped with the sequence number of its frame before and after the frame is written. A reader copies
+    the frame out and only keeps it if both stamps match the frame it expected, so a frame overwritten while being
+    read is discarded instead of being torn. The reader only takes the latest frame, so slow readers skip frames
+    rather than lag behind.
+
+    :param name: The name of the shared memory to attach to, defaults to None to create it
+    :type name: Optional[str]
+    :param slots: The number of slots when creating the shared memory, defaults to `FRAME_SLOTS`
+    :type slots: int
+    :param max_frame_bytes: The maximum size of a frame when creating the shared memory, defaults to `MAX_FRAME_BYTES`
+    :type max_frame_bytes: int
+    """
+
+    def __init__(self, name: Optional[str] = None, slots: int = FRAME_SLOTS, max_frame_bytes: int = MAX_FRAME_BYTES):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=_RING_HEADER.size + slots * (_SLOT_HEADER_SIZE + max_frame_bytes)
+            )
+            _RING_HEADER.pack_into(self._shm.buf, 0, 0, slots, max_frame_bytes)
+        else:
+            self._shm = shared_memory.SharedMemory(name)
+
+        self._buf = self._shm.buf
+        self._seq, self._slots, self._max_frame_bytes = _RING_HEADER.unpack_from(self._buf, 0)
+        # Frames of several robots are received on different threads, which take turns writing
+        self._write_lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        """The name of the shared memory, to attach to it from another process"""
+        return self._shm.name
+
+    def write(self, frame: Frame) -> bool:
+        """Writes a frame to the next slot
+
+        :param frame: The frame
+        :type frame: Frame
+        :return: Whether the frame was written, frames larger than the slots or whose robot id is longer than
+            `MAX_ROBOT_ID_BYTES` aren't
+        :rtype: bool
+        """
+        length = len(frame.data)
+        # Longer ids would be cut by the slot, possibly in the middle of a character
+        robot_id = (frame.robot_id or "").encode()
+        if length > self._max_frame_bytes or len(robot_id) > MAX_ROBOT_ID_BYTES:
+            registry.counter("ipc.oversized").inc()
+            return False
+
+        with self._write_lock:
+            seq = self._seq + 1
+            offset = self._offset(seq)
+            data_offset = offset + _SLOT_HEADER_SIZE
+            _SLOT_SEQ.pack_into(self._buf, offset, seq)
+            _SLOT_META.pack_into(
+                self._buf,
+                offset + 2 * _SLOT_SEQ.size,
+                frame.kind,
+                -1 if frame.seq is None else frame.seq,
+                -1 if frame.timestamp_ms is None else frame.timestamp_ms,
+                length,
+                frame.started_at or 0.0,
+                frame.received_at or 0.0,
+                robot_id,
+            )
+            self._buf[data_offset : data_offset + length] = frame.data
+            _SLOT_SEQ.pack_into(self._buf, offset + _SLOT_SEQ.size, seq)
+            # Only published once the slot is complete
+            _RING_HEADER.pack_into(self._buf, 0, seq, self._slots, self._max_frame_bytes)
+            self._seq = seq
+        return True
+
+    def read_latest(self, after_seq: int = 0) -> Optional[Tuple[int, Frame]]:
+        """Reads the latest frame, if it is newer than `after_seq`
+
+        :param after_seq: The sequence number of the last frame read, defaults to 0
+        :type after_seq: int
+        :return: The sequence number of the frame and the frame, or `None` if there is no newer frame
+        :rtype: Optional[Tuple[int, Frame]]
+        """
+        while True:
+            seq = _RING_HEADER.unpack_from(self._buf, 0)[0]
+            if seq <= after_seq:
+                return None
+
+            offset = self._offset(seq)
+            data_offset = offset + _SLOT_HEADER_SIZE
+            (written,) = _SLOT_SEQ.unpack_from(self._buf, offset + _SLOT_SEQ.size)
+            kind, frame_seq, timestamp_ms, length, started_at, received_at, robot_id = _SLOT_META.unpack_from(
+                self._buf, offset + 2 * _SLOT_SEQ.size
+            )
+            data = bytearray(self._buf[data_offset : data_offset + min(length, self._max_frame_bytes)])
+            (started,) = _SLOT_SEQ.unpack_from(self._buf, offset)
+            if written == started == seq:
+                return seq, Frame(
+                    kind,
+                    None if frame_seq < 0 else frame_seq,
+                    None if timestamp_ms < 0 else timestamp_ms,
+                    data,
+                    robot_id.rstrip(b"\x00").decode() or None,
+                    started_at or None,
+                    received_at or None,
+                )
+
+            # The slot was overwritten while being read, the frame that overwrote it is the latest one now
+            registry.counter("ipc.torn").inc()
+
+    def close(self) -> None:
+        """Detaches from the shared memory"""
+        self._shm.close()
+
+    def unlink(self) -> None:
+        """Destroys the shared memory, once every process detached from it"""
+        self._shm.unlink()
+
+    def _offset(self, seq: int) -> int:
+        return _RING_HEADER.size + (seq % self._slots) * (_SLOT_HEADER_SIZE + self._max_frame_bytes)
+
+
+class _Channel:
+    """Sends messages through one end of a pipe from several threads"""
+
+    def __init__(self, conn: Connection) -> None:
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, message_type: str, *args: Any) -> None:
+        with self._lock:
+            try:
+                self._conn.send((message_type, *args))
+            except (BrokenPipeError, EOFError, OSError):
+                logging.warning("Dropped %s, the other process is gone", message_type)
+
+
+def _run_engine(
+    conn: Connection,
+    slots_name: str,
+    frame_ready: multiprocessing.synchronize.Event,
+    engine_kwargs: Dict[str, Any],
+    log_level: int,
+) -> None:
+    # Ctrl+C is sent to the whole process group, but the engine is stopped by the GUI, which saves the session first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=log_level)
+
+    engine = Engine(**engine_kwargs)
+    slots = FrameSlots(slots_name)
+    channel = _Channel(conn)
+
+    def on_frame(frame: Frame) -> None:
+        if slots.write(frame):
+            frame_ready.set()
+
+    engine.server.subscribe(on_frame)
+    for message_type in (MESSAGE_TYPE.CONNECTED, MESSAGE_TYPE.DISCONNECTED):
+        engine.status_dispatcher.subscribe(message_type, functools.partial(channel.send, message_type))
+    controller_dispatcher = Dispatcher(engine.controller_queue, name="ControllerDispatcher")
+    controller_dispatcher.subscribe(
+        MESSAGE_TYPE.CONTROLLER_FEED_RECEIVED,
+        functools.partial(channel.send, MESSAGE_TYPE.CONTROLLER_FEED_RECEIVED),
+    )
+
+    engine.start()
+    controller_dispatcher.start()
+    channel.send(ENGINE_MESSAGE.READY, engine.controller.keys())
+
+    gui_alive = True
+    while True:
+        try:
+            if not conn.poll(STATS_INTERVAL_S):
+                channel.send(ENGINE_MESSAGE.STATS, registry.snapshot())
+                continue
+            message_type, *args = conn.recv()
+        except (EOFError, OSError):
+            logging.warning("The GUI process is gone, stopping the engine")
+            gui_alive = False
+            break
+
+        if message_type == ENGINE_MESSAGE.SHUTDOWN:
+            break
+
+        try:
+            if message_type == ENGINE_MESSAGE.START_RECORDING:
+                recording_args, recording_kwargs = args
+                engine.recorder.start_recording(*recording_args, **recording_kwargs)
+            elif message_type == ENGINE_MESSAGE.STOP_RECORDING:
+                engine.recorder.stop_recording()
+            elif message_type == ENGINE_MESSAGE.CLOSE_CONNECTION:
+                engine.server.close(*args)
+            else:
+                logging.warning("Unknown engine message type: %s", message_type)
+        except Exception:
+            logging.exception("Failed to handle %s", message_type)
+
+    def close() -> None:
+        controller_dispatcher.close()
+        engine.server.unsubscribe(on_frame)
+        # Any session being recorded is saved before closing
+        engine.close()
+
+    # Saving the session may take long, so statistics keep being sent meanwhile to tell the GUI how far along it is
+    closer = threading.Thread(target=close, name="EngineCloser")
+    closer.start()
+    while closer.is_alive():
+        closer.join(STATS_INTERVAL_S)
+        if gui_alive:
+            channel.send(ENGINE_MESSAGE.STATS, registry.snapshot())
+    if gui_alive:
+        channel.send(ENGINE_MESSAGE.CLOSED)
+    slots.close()
+    conn.close()
+
+
+class _RemoteServer:
+    """Stands for the server of the engine process, tracking the connected robots from its status messages"""
+
+    def __init__(self, channel: _Channel) -> None:
+        self._channel = channel
+        self._robots: List[str] = []
+        self._lock = threading.Lock()
+
+    def robots(self) -> List[str]:
+        with self._lock:
+            return list(self._robots)
+
+    def close(self, robot_id: Optional[str] = None) -> None:
+        self._channel.send(ENGINE_MESSAGE.CLOSE_CONNECTION, robot_id)
+
+    def on_status(self, message_type: str, robot_id: str) -> None:
+        """Tracks a robot connecting or disconnecting
+
+        :param message_type: Either `MESSAGE_TYPE.CONNECTED` or `MESSAGE_TYPE.DISCONNECTED`
+        :type message_type: str
+        :param robot_id: The id of the robot
+        :type robot_id: str
+        """
+        with self._lock:
+            self._robots = [robot for robot in self._robots if robot != robot_id]
+            if message_type == MESSAGE_TYPE.CONNECTED:
+                self._robots.append(robot_id)
+
+
+class _RemoteController:
+    """Stands for the controller of the engine process, which reads the keyboard"""
+
+    def __init__(self) -> None:
+        self._keys: List[str] = []
+
+    def keys(self) -> List[str]:
+        return list(self._keys)
+
+    def set_keys(self, keys: List[str]) -> None:
+        """Sets the keys of the controller, as reported by the engine process once started
+
+        :param keys: The supported keys
+        :type keys: List[str]
+        """
+        self._keys = list(keys)
+
+
+class _RemoteRecorder:
+    """Stands for the recorder of the engine process, which saves sessions"""
+
+    def __init__(self, channel: _Channel) -> None:
+        self._channel = channel
+
+    def start_recording(self, *args: Any, **kwargs: Any) -> None:
+        self._channel.send(ENGINE_MESSAGE.START_RECORDING, args, kwargs)
+
+    def stop_recording(self) -> None:
+        self._channel.send(ENGINE_MESSAGE.STOP_RECORDING)
+
+
+class EngineProcess:
+    """Runs an `Engine` in a process of its own, exposing the same interface to the GUI.
+
+    Saving a session, encoding PNGs in particular, competes with the GUI for the GIL when both run in one process,
+    which makes the GUI stutter. Here the server, the controller, the command sender and the recorder all run in a
+    child process. Camera frames are written to `FrameSlots` in shared memory, from which the latest one is copied
+    into `camera_queue`. Status messages, the controller feed and statistics come back through a pipe, through which
+    the GUI also starts and stops recording, so `server`, `controller` and `recorder` are stand-ins sending those
+    requests to the engine process.
+
+    :param engine_kwargs: The arguments of the `Engine`, e.g. `port` or `metrics_port`
+    :type engine_kwargs: Any
+    """
+
+    def __init__(self, **engine_kwargs: Any) -> None:
+        # Queues consumed by the GUI, as exposed by `Engine`
+        self.status_queue = queue.Queue()
+        self.camera_queue = Mailbox(POLICY.KEEP_LATEST)
+        self.controller_queue = Mailbox(POLICY.KEEP_LATEST, maxsize=256)
+
+        self._engine_kwargs = engine_kwargs
+        # Spawned rather than forked, as forking a process running Tk isn't safe
+        self._context = multiprocessing.get_context("spawn")
+        self._conn, self._child_conn = self._context.Pipe()
+        self._channel = _Channel(self._conn)
+        self._frame_ready = self._context.Event()
+        self._slots = FrameSlots()
+        self._process = None
+        self._remote_stats: Dict[str, Dict[str, float]] = {}
+        self._stopped = threading.Event()
+        # Set once the engine process reports it stopped, and when anything was last heard from it
+        self._closed = threading.Event()
+        self._last_message_at = time.monotonic()
+        self._receiver = threading.Thread(target=self._receive, name="EngineReceiver")
+        self._frame_reader = threading.Thread(target=self._read_frames, name="FrameReader")
+
+        self.server = _RemoteServer(self._channel)
+        self.controller = _RemoteController()
+        self.recorder = _RemoteRecorder(self._channel)
+        self.status_dispatcher = Dispatcher(self.status_queue, name="StatusDispatcher")
+        for message_type in (MESSAGE_TYPE.CONNECTED, MESSAGE_TYPE.DISCONNECTED):
+            self.status_dispatcher.subscribe(message_type, functools.partial(self.server.on_status, message_type))
+
+    def start(self) -> None:
+        """Starts the engine process, returning once it accepts M.A.R.K."""
+        self._process = self._context.Process(
+            target=_run_engine,
+            args=(
+                self._child_conn,
+                self._slots.name,
+                self._frame_ready,
+                self._engine_kwargs,
+                logging.getLogger().getEffectiveLevel(),
+            ),
+            name="Engine",
+        )
+        self._process.start()
+        # Only the child uses its end, so the pipe breaks as soon as the child exits
+        self._child_conn.close()
+
+        try:
+            if not self._conn.poll(PROCESS_TIMEOUT_S):
+                raise RuntimeError("The engine process didn't start")
+            message_type, keys = self._conn.recv()
+        except EOFError:
+            raise RuntimeError("The engine process exited while starting, see its logs") from None
+        if message_type != ENGINE_MESSAGE.READY:
+            raise RuntimeError(f"Unexpected message from the engine process: {message_type}")
+        self.controller.set_keys(keys)
+        self._last_message_at = time.monotonic()
+
+        self._receiver.start()
+        self._frame_reader.start()
+        self.status_dispatcher.start()
+
+    def close(self) -> None:
+        """Stops the engine process, saving the session being recorded if any"""
+        self.status_dispatcher.close()
+        self._channel.send(ENGINE_MESSAGE.SHUTDOWN)
+        if self._process is not None:
+            # Saving the session has no time limit, the engine process is only terminated if it stops responding
+            while not self._closed.wait(PROCESS_TIMEOUT_S) and self._process.is_alive():
+                if time.monotonic() - self._last_message_at > PROCESS_TIMEOUT_S:
+                    logging.warning("The engine process stopped responding, terminating it")
+                    self._process.terminate()
+                    break
+                pending = self._remote_stats.get("recorder.pending", {}).get("value", 0)
+                logging.info("Waiting for the engine process to save the session, %d samples left", pending)
+            self._process.join()
+
+        self._stopped.set()
+        for thread in (self._receiver, self._frame_reader):
+            if thread.is_alive():
+                thread.join()
+        self._conn.close()
+        self._slots.close()
+        self._slots.unlink()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns the latest statistics of the engine process along with the ones of this process
+
+        :return: The snapshot of each statistic, by name
+        :rtype: Dict[str, Dict[str, float]]
+        """
+        return {**registry.snapshot(), **self._remote_stats}
+
+    def _receive(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                message_type, *args = self._conn.recv()
+            except (EOFError, OSError):
+                break
+
+            self._last_message_at = time.monotonic()
+            if message_type == ENGINE_MESSAGE.STATS:
+                self._remote_stats = args[0]
+            elif message_type == MESSAGE_TYPE.CONTROLLER_FEED_RECEIVED:
+                self.controller_queue.put((message_type, args[0]))
+            elif message_type in (MESSAGE_TYPE.CONNECTED, MESSAGE_TYPE.DISCONNECTED):
+                self.status_queue.put((message_type, args[0]))
+            elif message_type == ENGINE_MESSAGE.CLOSED:
+                self._closed.set()
+            else:
+                logging.warning("Unknown engine message type: %s", message_type)
+
+    def _read_frames(self) -> None:
+        seq = 0
+        while not self._stopped.is_set():
+            if not self._frame_ready.wait(STOP_CHECK_INTERVAL_S):
+                continue
+            # Cleared before reading, so a frame written in the meantime sets it again
+            self._frame_ready.clear()
+
+            latest = self._slots.read_latest(seq)
+            if latest is not None:
+                seq, frame = latest
+                self.camera_queue.put((MESSAGE_TYPE.CAMERA_FEED_RECEIVED, frame))
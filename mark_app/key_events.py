@@ -0,0 +1,157 @@
+"""Captures every transition of the controller keys, and reconstructs the state of the keys at any time."""
+import threading
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+# Each transition holds its time, the key that changed, whether it is now pressed and the state of all keys after it,
+# as a bitmask where bit `i` is set if the key with command code `i + 1` is pressed
+KEY_EVENT_DTYPE = np.dtype([("timestamp", "<f8"), ("key", "u1"), ("pressed", "u1"), ("keys", "<u2")])
+# Key event logs start with a magic and a version
+KEY_EVENTS_MAGIC = b"MKKEYS\x00\x01"
+KEY_EVENTS_FILE = "key_events.bin"
+# Used as the key of records that hold the state of the keys at a point in time rather than a transition
+KEY_SNAPSHOT = 0xFF
+
+
+class KeyEventRing:
+    """A fixed-size ring buffer of key transitions.
+
+    Transitions are stored as fixed-width records in a preallocated array, so recording one never allocates. If the
+    ring is not drained in time the oldest transitions are overwritten, and counted as dropped.
+
+    :param capacity: The maximum number of transitions kept between drains, defaults to 65536
+    :type capacity: int
+    """
+
+    def __init__(self, capacity: int = 65536) -> None:
+        self._events = np.zeros(capacity, dtype=KEY_EVENT_DTYPE)
+        # Total number of transitions appended and drained so far
+        self._appended = 0
+        self._drained = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def append(self, timestamp: float, key: int, pressed: bool, keys: int) -> None:
+        """Appends a transition
+
+        :param timestamp: The time of the transition as given by `time.monotonic()`
+        :type timestamp: float
+        :param key: The index of the key that changed, i.e. its command code minus one
+        :type key: int
+        :param pressed: Whether the key is now pressed
+        :type pressed: bool
+        :param keys: The state of all keys after the transition, as a bitmask
+        :type keys: int
+        """
+        with self._lock:
+            self._events[self._appended % len(self._events)] = (timestamp, key, pressed, keys)
+            self._appended += 1
+
+    def drain(self) -> np.ndarray:
+        """Takes all the transitions appended since the last drain
+
+        :return: The transitions, in order, as an array of `KEY_EVENT_DTYPE`
+        :rtype: np.ndarray
+        """
+        with self._lock:
+            capacity = len(self._events)
+            if self._appended - self._drained > capacity:
+                self.dropped += self._appended - self._drained - capacity
+                self._drained = self._appended - capacity
+
+            start, end = self._drained % capacity, self._appended % capacity
+            if self._appended == self._drained:
+                events = self._events[:0].copy()
+            elif start < end:
+                events = self._events[start:end].copy()
+            else:
+                events = np.concatenate((self._events[start:], self._events[:end]))
+            self._drained = self._appended
+
+        return events
+
+
+class KeyEventLog:
+    """An append-only binary log of key transitions, written in bulk.
+
+    :param path: The path of the log
+    :type path: Union[str, Path]
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self._file = open(path, "wb")
+        self._file.write(KEY_EVENTS_MAGIC)
+
+    def write(self, events: np.ndarray, time_offset: float = 0.0) -> None:
+        """Appends transitions to the log
+
+        :param events: The transitions, as an array of `KEY_EVENT_DTYPE`
+        :type events: np.ndarray
+        :param time_offset: Subtracted from the timestamps of the transitions, e.g. the start of a session, defaults
+            to 0
+        :type time_offset: float
+        """
+        if not len(events):
+            return
+
+        if time_offset:
+            events = events.copy()
+            events["timestamp"] -= time_offset
+        self._file.write(events.tobytes())
+        self._file.flush()
+
+    def write_snapshot(self, timestamp: float, keys: int) -> None:
+        """Appends the state of the keys at a point in time, e.g. when the session starts
+
+        :param timestamp: The time of the snapshot
+        :type timestamp: float
+        :param keys: The state of all keys, as a bitmask
+        :type keys: int
+        """
+        self.write(np.array([(timestamp, KEY_SNAPSHOT, 0, keys)], dtype=KEY_EVENT_DTYPE))
+
+    def close(self) -> None:
+        """Closes the log"""
+        self._file.close()
+
+
+def read_key_events(path: Union[str, Path]) -> np.ndarray:
+    """Reads a key event log
+
+    :param path: The path of the log
+    :type path: Union[str, Path]
+    :return: The transitions, as an array of `KEY_EVENT_DTYPE`
+    :rtype: np.ndarray
+    """
+    with open(path, "rb") as f:
+        if f.read(len(KEY_EVENTS_MAGIC)) != KEY_EVENTS_MAGIC:
+            raise ValueError(f"{path} is not a key event log")
+        data = f.read()
+
+    # A log cut short by a crash is read up to its last complete transition
+    return np.frombuffer(data[: len(data) - len(data) % KEY_EVENT_DTYPE.itemsize], dtype=KEY_EVENT_DTYPE)
+
+
+def key_state_at(events: np.ndarray, timestamps: np.ndarray, initial: int = 0) -> np.ndarray:
+    """Reconstructs the state of the keys at the given times
+
+    :param events: The transitions, in order, as an array of `KEY_EVENT_DTYPE`
+    :type events: np.ndarray
+    :param timestamps: The times at which to reconstruct the state, e.g. the timestamps of frames
+    :type timestamps: np.ndarray
+    :param initial: The state of the keys before the first transition, defaults to 0 (no key pressed)
+    :type initial: int
+    :return: The state of the keys at each time, as bitmasks
+    :rtype: np.ndarray
+    """
+    timestamps = np.asarray(timestamps)
+    if not len(events):
+        return np.full(timestamps.shape, initial, dtype=np.uint16)
+
+    # The state at a time is the one left by the last transition at or before it
+    positions = np.searchsorted(events["timestamp"], timestamps, side="right") - 1
+    states = np.where(positions >= 0, events["keys"][np.maximum(positions, 0)], initial)
+
+    return states.astype(np.uint16)
@@ -0,0 +1,223 @@
+"""Defines the columnar binary log of the controller labels of a recording session."""
+import argparse
+import csv
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Union
+
+import numpy as np
+
+LABELS_FILE = "labels.bin"
+# The log starts with a magic, a version and the metadata of the session as JSON
+LABELS_MAGIC = b"MKLABELS"
+LABELS_VERSION = 1
+LABELS_HEADER = struct.Struct(">8sBI")
+# Every block starts with a magic and its number of rows, followed by one column after the other
+BLOCK_MAGIC = b"MKLB"
+BLOCK_HEADER = struct.Struct(">4sI")
+# Type of each column, in the order in which they are stored
+COLUMNS = [("timestamp", np.dtype("<f8")), ("keys", np.dtype("<u2")), ("frame", np.dtype("<u4"))]
+ROW_SIZE = sum(dtype.itemsize for _, dtype in COLUMNS)
+
+
+class Labels(NamedTuple):
+    """The labels of a session, one row per sample"""
+
+    # The keys of the controller, where key `i` is bit `i` of the bitmasks
+    keys: List[str]
+    # The image format of the session, e.g. `jpeg`
+    recording_format: str
+    # Seconds since the session started
+    timestamp: np.ndarray
+    # The keys pressed, as bitmasks
+    keys_pressed: np.ndarray
+    # The index of the image of each sample, i.e. `<frame>.<recording_format>`
+    frame: np.ndarray
+
+
+class LabelLog:
+    """Writes the labels of a session in blocks of columns.
+
+    Rows are buffered and written as a block once `block_size` rows are buffered or `flush_interval_s` seconds went
+    by, and every block is synced to disk. Blocks are written and synced by a thread of the log, so appending never
+    waits for the disk. A crash thus loses at most the blocks that were being buffered or synced.
+
+    :param path: The path of the log
+    :type path: Union[str, Path]
+    :param keys: The keys of the controller
+    :type keys: List[str]
+    :param recording_format: The image format of the session
+    :type recording_format: str
+    :param block_size: The number of rows per block, defaults to 256
+    :type block_size: int
+    :param flush_interval_s: The maximum time rows are buffered for, defaults to 5
+    :type flush_interval_s: float
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        keys: List[str],
+        recording_format: str,
+        block_size: int = 256,
+        flush_interval_s: float = 5.0,
+    ) -> None:
+        self._file = open(path, "wb")
+        self._block_size = block_size
+        self._flush_interval_s = flush_interval_s
+        self._columns = {name: np.zeros(block_size, dtype=dtype) for name, dtype in COLUMNS}
+        self._rows = 0
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        # Blocks waiting to be written, and then `None` once the log is closed
+        self._blocks: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._syncer = threading.Thread(target=self._sync_blocks, name="LabelSyncer")
+
+        metadata = json.dumps({"keys": keys, "format": recording_format}).encode("utf-8")
+        self._blocks.put(LABELS_HEADER.pack(LABELS_MAGIC, LABELS_VERSION, len(metadata)) + metadata)
+        self._syncer.start()
+
+    def append(self, timestamp: float, keys_pressed: int, frame: int) -> None:
+        """Appends a row
+
+        :param timestamp: Seconds since the session started
+        :type timestamp: float
+        :param keys_pressed: The keys pressed, as a bitmask
+        :type keys_pressed: int
+        :param frame: The index of the image of the sample
+        :type frame: int
+        """
+        with self._lock:
+            self._columns["timestamp"][self._rows] = timestamp
+            self._columns["keys"][self._rows] = keys_pressed
+            self._columns["frame"][self._rows] = frame
+            self._rows += 1
+
+            if self._rows == self._block_size or time.monotonic() - self._flushed_at >= self._flush_interval_s:
+                self._flush()
+
+    def close(self) -> None:
+        """Writes the rows left and closes the log, once every block is synced"""
+        with self._lock:
+            self._flush()
+            self._blocks.put(None)
+        self._syncer.join()
+
+    def _flush(self) -> None:
+        self._flushed_at = time.monotonic()
+        if not self._rows:
+            return
+
+        block = [BLOCK_HEADER.pack(BLOCK_MAGIC, self._rows)]
+        block.extend(self._columns[name][: self._rows].tobytes() for name, _ in COLUMNS)
+        self._blocks.put(b"".join(block))
+        self._rows = 0
+
+    def _sync_blocks(self) -> None:
+        closed = False
+        while not closed:
+            try:
+                blocks = [self._blocks.get(timeout=self._flush_interval_s)]
+            except queue.Empty:
+                # Rows are also written when no more are appended for a while
+                with self._lock:
+                    if time.monotonic() - self._flushed_at >= self._flush_interval_s:
+                        self._flush()
+                continue
+
+            # Blocks queued in the meantime are synced at once, and nothing is queued after `None`
+            while not self._blocks.empty():
+                blocks.append(self._blocks.get())
+            closed = blocks[-1] is None
+            for block in blocks:
+                if block is not None:
+                    self._file.write(block)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+        self._file.close()
+
+
+def keys_to_bitmask(values: List[int]) -> int:
+    """Converts the values of the keys of the controller to a bitmask
+
+    :param values: The value of each key, in order, where anything but 0 means pressed
+    :type values: List[int]
+    :return: A bitmask where bit `i` is set if key `i` is pressed
+    :rtype: int
+    """
+    return sum(1 << i for i, value in enumerate(values) if value)
+
+
+def read_labels(path: Union[str, Path]) -> Labels:
+    """Reads a label log
+
+    A log cut short by a crash is read up to its last complete block.
+
+    :param path: The path of the log
+    :type path: Union[str, Path]
+    :return: The labels
+    :rtype: Labels
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, version, metadata_size = LABELS_HEADER.unpack_from(data)
+    if magic != LABELS_MAGIC or version != LABELS_VERSION:
+        raise ValueError(f"{path} is not a label log")
+    metadata = json.loads(data[LABELS_HEADER.size : LABELS_HEADER.size + metadata_size])
+
+    columns = {name: [] for name, _ in COLUMNS}
+    position = LABELS_HEADER.size + metadata_size
+    while position + BLOCK_HEADER.size <= len(data):
+        block_magic, rows = BLOCK_HEADER.unpack_from(data, position)
+        if block_magic != BLOCK_MAGIC or position + BLOCK_HEADER.size + rows * ROW_SIZE > len(data):
+            break
+        position += BLOCK_HEADER.size
+        for name, dtype in COLUMNS:
+            columns[name].append(np.frombuffer(data, dtype=dtype, count=rows, offset=position))
+            position += rows * dtype.itemsize
+
+    return Labels(
+        metadata["keys"],
+        metadata["format"],
+        *(np.concatenate(columns[name]) if columns[name] else np.zeros(0, dtype) for name, dtype in COLUMNS),
+    )
+
+
+def export_csv(session_dir: Union[str, Path], output: Union[str, Path, None] = None) -> int:
+    """Exports the labels of a session to a csv file, as older versions of the recorder used to write them
+
+    :param session_dir: The directory of the session
+    :type session_dir: Union[str, Path]
+    :param output: The path of the csv file, defaults to `data.csv` in the session
+    :type output: Union[str, Path, None]
+    :return: The number of rows exported
+    :rtype: int
+    """
+    session_dir = Path(session_dir).absolute()
+    labels = read_labels(session_dir.joinpath(LABELS_FILE))
+    pressed = (labels.keys_pressed[:, None] >> np.arange(len(labels.keys), dtype=np.uint16)) & 1
+
+    with open(output or session_dir.joinpath("data.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        # Header: image location + controller keys
+        writer.writerow(["Image"] + labels.keys)
+        for frame, values in zip(labels.frame, pressed.tolist()):
+            writer.writerow([str(session_dir.joinpath(f"{frame}.{labels.recording_format}"))] + values)
+
+    return len(labels.frame)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the labels of recording sessions to csv files")
+    parser.add_argument("sessions", nargs="+", help="The directories of the sessions")
+    args = parser.parse_args()
+
+    for session in args.sessions:
+        print(f"{session}: exported {export_csv(session)} rows")
@@ -3,25 +3,50 @@ import logging
 import os
 import signal
 import socket
+import sys
 import threading
 import time
-from typing import ByteString
+from typing import List, Optional
 
 import cv2
 import numpy as np
 
+from protocol import (
+    ACK_PAYLOAD,
+    COMMAND_KIND,
+    FRAME_KIND,
+    HINT_PAYLOAD,
+    KEYS_PAYLOAD,
+    Command,
+    decode_commands,
+    encode_frame_header,
+    encode_hello,
+)
+
+# Bounds within which the hints of the server are followed
+MIN_QUALITY = 10
+MAX_QUALITY = 95
+MIN_FRAME_INTERVAL_MS = 33
+MAX_FRAME_INTERVAL_MS = 1000
+
 
 class Client(threading.Thread):
-    def __init__(self) -> None:
+    def __init__(self, robot_id: Optional[str] = None) -> None:
         super().__init__()
 
+        self._robot_id = robot_id
+
     def run(self) -> None:
         self._connect()
 
+        # Identify ourselves so that several clients can be connected to the same server
+        if self._robot_id is not None:
+            self._sock.sendall(encode_hello(self._robot_id))
+
         camera_socket = _CameraSocket(self._sock)
         camera_socket.start()
 
-        command_socket = _CommandSocket(self._sock)
+        command_socket = _CommandSocket(self._sock, camera_socket)
         command_socket.start()
 
     def _connect(self) -> None:
@@ -44,6 +69,25 @@ class _CameraSocket(threading.Thread):
         super().__init__()
 
         self._sc = sc
+        self._seq = 0
+        # Acknowledgements are sent from the command thread, and must not be interleaved with the images
+        self._send_lock = threading.Lock()
+        # Adjusted by the hints of the server
+        self._quality = 30
+        self._frame_interval_ms = 95
+
+    def send_ack(self, command: Command) -> None:
+        payload = ACK_PAYLOAD.pack(command.seq, command.timestamp_ms)
+        with self._send_lock:
+            self._sc.sendall(
+                encode_frame_header(command.seq, int(time.monotonic() * 1000), len(payload), FRAME_KIND.ACK) + payload
+            )
+
+    def apply_hint(self, quality: int, frame_interval_ms: int) -> None:
+        # Hints are only followed within our own bounds
+        self._quality = min(max(quality, MIN_QUALITY), MAX_QUALITY)
+        self._frame_interval_ms = min(max(frame_interval_ms, MIN_FRAME_INTERVAL_MS), MAX_FRAME_INTERVAL_MS)
+        logging.info("Using quality %s every %s ms", self._quality, self._frame_interval_ms)
 
     def run(self) -> None:
         capture = cv2.VideoCapture(0)
@@ -53,13 +97,17 @@ class _CameraSocket(threading.Thread):
         try:
             while capture.isOpened():
                 _, frame = capture.read()
-                send_len = self._send_image(frame)
+                timestamp_ms = int(time.monotonic() * 1000)
+                with self._send_lock:
+                    send_len = self._send_image(frame, timestamp_ms)
 
                 if send_len == 0:
                     logging.info("Video feed transmission failed")
                     break
 
-                time.sleep(0.095)
+                # Wait for the rest of the frame interval
+                elapsed_ms = time.monotonic() * 1000 - timestamp_ms
+                time.sleep(max(self._frame_interval_ms - elapsed_ms, 0) / 1000.0)
 
             self._sc.close()
             os._exit(0)
@@ -68,38 +116,38 @@ class _CameraSocket(threading.Thread):
             self._sc.close()
             os._exit(0)
 
-    def _send_image(self, frame):
+    def _send_image(self, frame, timestamp_ms):
         resize_frame = cv2.resize(frame, dsize=(500, 450), interpolation=cv2.INTER_AREA)
 
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 30]
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self._quality]
         _, imgencode = cv2.imencode(".jpg", resize_frame, encode_param)
         data = np.array(imgencode)
 
-        # Sends data to the given socket in chunks of `buf_size`
-        block = int(len(data) / 2048)
-        send_len = 0
-
-        for i in range(block):
-            send_len += self._sc.send(data[i * 2048 : (i + 1) * 2048])
+        # Prefix the image with its header, as M.A.R.K. does
+        self._sc.sendall(encode_frame_header(self._seq, timestamp_ms, len(data)))
+        self._seq += 1
 
-        # Always send the last block in cases where `data` can't be divided exactly by `buf_size`
-        send_len += self._sc.send(data[block * 2048 :])
+        self._sc.sendall(data)
 
-        return send_len
+        return len(data)
 
 
 class _CommandSocket(threading.Thread):
-    def __init__(self, sc: socket.socket) -> None:
+    def __init__(self, sc: socket.socket, camera_socket: _CameraSocket) -> None:
         super().__init__()
 
         self._sc = sc
+        self._camera_socket = camera_socket
+        self._buffer = bytearray()
+        self._keys = 0
 
     def run(self) -> None:
         while True:
             try:
-                data = self._sc.recv(1)
+                data = self._sc.recv(4096)
                 if data:
-                    self._handle_command(data)
+                    self._buffer += data
+                    self._handle_commands(decode_commands(self._buffer))
                 else:
                     logging.info("Server disconnected")
                     self._sc.close()
@@ -109,35 +157,44 @@ class _CommandSocket(threading.Thread):
                 self._sc.close()
                 os._exit(0)
 
-    def _handle_command(self, command: ByteString) -> None:
-        if command == b"\x00":
-            logging.info("KeepAlive")
-        if command == b"\x01":
-            logging.info("Move forward")
-        if command == b"\x02":
-            logging.info("Turn left")
-        if command == b"\x03":
-            logging.info("Move backward")
-        if command == b"\x04":
-            logging.info("Turn right")
-        if command == b"\x05":
-            logging.info("Tilt up")
-        if command == b"\x06":
-            logging.info("Tilt down")
-        if command == b"\x07":
-            logging.info("Pan left")
-        if command == b"\x08":
-            logging.info("Pan right")
-        if command == b"\x09":
-            logging.info("Open gripper")
-        if command == b"\x0A":
-            logging.info("Close gripper")
+    def _handle_commands(self, commands: List[Command]) -> None:
+        for command in commands:
+            if command.kind == COMMAND_KIND.HINT:
+                self._camera_socket.apply_hint(*HINT_PAYLOAD.unpack(command.payload))
+
+        # Every command carries the full state of the keys, so only the latest one matters
+        keys = [command for command in commands if command.kind == COMMAND_KIND.KEYS]
+        if not keys:
+            return
+
+        self._camera_socket.send_ack(keys[-1])
+        (state,) = KEYS_PAYLOAD.unpack(keys[-1].payload)
+        if state != self._keys:
+            self._keys = state
+            pressed = [name for bit, name in enumerate(_KEY_ACTIONS) if state & (1 << bit)]
+            logging.info("Keys: %s", ", ".join(pressed) if pressed else "none")
+
+
+# Actions of each key, in command code order
+_KEY_ACTIONS = [
+    "Move forward",
+    "Turn left",
+    "Move backward",
+    "Turn right",
+    "Tilt up",
+    "Tilt down",
+    "Pan left",
+    "Pan right",
+    "Open gripper",
+    "Close gripper",
+]
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
 
-    client = Client()
+    # Optionally, the id of the simulated robot can be given as the first argument
+    client = Client(robot_id=sys.argv[1] if len(sys.argv) > 1 else None)
     client.start()
 
     def sig_handler(_, __):
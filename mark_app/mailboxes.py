@@ -0,0 +1,138 @@
+"""Defines a bounded mailbox to pass messages between threads."""
+import queue
+import threading
+from collections import deque
+from typing import Any, Optional
+
+
+class POLICY:
+    """Defines what a mailbox does when a message is put while it is full"""
+
+    # Drop the oldest message, so the mailbox always holds the latest ones
+    KEEP_LATEST = "KEEP_LATEST"
+    # Drop the new message, so the messages already in the mailbox are kept in order
+    FIFO = "FIFO"
+    # Block until there is room for the new message
+    BLOCK = "BLOCK"
+
+
+class Mailbox:
+    """A bounded, thread-safe mailbox.
+
+    It follows the interface of `queue.Queue`, so it can be used as a drop-in replacement for it, but it never grows
+    beyond `maxsize` messages. What happens to messages that don't fit is decided by its policy, and the number of
+    dropped messages is kept in `dropped`.
+
+    :param policy: What to do with messages put while the mailbox is full, defaults to `POLICY.KEEP_LATEST`
+    :type policy: str
+    :param maxsize: The maximum number of messages held by the mailbox, defaults to 1
+    :type maxsize: int
+    """
+
+    def __init__(self, policy: str = POLICY.KEEP_LATEST, maxsize: int = 1) -> None:
+        if policy not in (POLICY.KEEP_LATEST, POLICY.FIFO, POLICY.BLOCK):
+            raise ValueError(f"Unknown mailbox policy: {policy}")
+        if maxsize < 1:
+            raise ValueError("The size of a mailbox must be at least 1")
+
+        self.policy = policy
+        self.maxsize = maxsize
+        # Number of messages ever put in the mailbox, and how many of them were dropped
+        self.received = 0
+        self.dropped = 0
+        self._messages = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def put(self, message: Any, block: bool = True, timeout: Optional[float] = None) -> None:
+        """Puts a message in the mailbox
+
+        :param message: The message
+        :type message: Any
+        :param block: Whether to wait for room in the mailbox, only used by `POLICY.BLOCK`, defaults to True
+        :type block: bool
+        :param timeout: The maximum time to wait in seconds, only used by `POLICY.BLOCK`, defaults to no limit
+        :type timeout: Optional[float]
+        :raises queue.Full: If the mailbox uses `POLICY.BLOCK` and is still full after waiting
+        """
+        with self._not_full:
+            self.received += 1
+
+            if len(self._messages) >= self.maxsize:
+                if self.policy == POLICY.KEEP_LATEST:
+                    self._messages.popleft()
+                    self.dropped += 1
+                elif self.policy == POLICY.FIFO:
+                    self.dropped += 1
+                    return
+                elif not block or not self._not_full.wait_for(lambda: len(self._messages) < self.maxsize, timeout):
+                    self.dropped += 1
+                    raise queue.Full
+
+            self._messages.append(message)
+            self._not_empty.notify()
+
+    def put_nowait(self, message: Any) -> None:
+        """Puts a message in the mailbox without blocking
+
+        :param message: The message
+        :type message: Any
+        """
+        self.put(message, block=False)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        """Removes and returns the oldest message in the mailbox
+
+        :param block: Whether to wait for a message if the mailbox is empty, defaults to True
+        :type block: bool
+        :param timeout: The maximum time to wait in seconds, defaults to no limit
+        :type timeout: Optional[float]
+        :raises queue.Empty: If there is no message after waiting
+        :return: The message
+        :rtype: Any
+        """
+        with self._not_empty:
+            if not self._messages and (not block or not self._not_empty.wait_for(lambda: self._messages, timeout)):
+                raise queue.Empty
+
+            message = self._messages.popleft()
+            self._not_full.notify()
+
+            return message
+
+    def get_nowait(self) -> Any:
+        """Removes and returns the oldest message in the mailbox without blocking
+
+        :raises queue.Empty: If the mailbox is empty
+        :return: The message
+        :rtype: Any
+        """
+        return self.get(block=False)
+
+    def peek(self) -> Any:
+        """Returns the latest message in the mailbox without removing it
+
+        :return: The message, or `None` if the mailbox is empty
+        :rtype: Any
+        """
+        with self._lock:
+            return self._messages[-1] if self._messages else None
+
+    def empty(self) -> bool:
+        """Returns whether the mailbox is empty
+
+        :return: True if there are no messages
+        :rtype: bool
+        """
+        with self._lock:
+            return not self._messages
+
+    def qsize(self) -> int:
+        """Returns the number of messages in the mailbox
+
+        :return: The number of messages
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._messages)
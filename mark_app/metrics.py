@@ -0,0 +1,105 @@
+"""Exposes the statistics of the app over HTTP in the Prometheus text format."""
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from stats import Counter, Gauge, Histogram, StatsRegistry, registry
+
+# Prefix of every exported metric
+METRIC_PREFIX = "mark_"
+
+
+class MetricsServer(threading.Thread):
+    """A minimal HTTP server that publishes a statistics registry on `/metrics`.
+
+    Metrics are only rendered when scraped, so the server costs nothing beyond an idle thread otherwise.
+
+    :param port: The port of the server
+    :type port: int
+    :param host: The address to listen on, defaults to all interfaces
+    :type host: str
+    :param stats: The statistics to publish, defaults to the registry of the app
+    :type stats: StatsRegistry
+    """
+
+    def __init__(self, port: int, host: str = "", stats: StatsRegistry = registry) -> None:
+        super().__init__()
+
+        self._httpd = ThreadingHTTPServer((host, port), _make_handler(stats))
+        self._httpd.daemon_threads = True
+
+    def run(self) -> None:
+        logging.info("Serving metrics on port %s", self._httpd.server_address[1])
+        self._httpd.serve_forever()
+
+    def close(self) -> None:
+        """Stops the server"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def render(stats: StatsRegistry) -> str:
+    """Renders statistics in the Prometheus text exposition format
+
+    Counters are exported as `<name>_total`, histograms as summaries with their quantiles and count, and gauges as is.
+    Names are prefixed with `METRIC_PREFIX` and dots are replaced by underscores.
+
+    :param stats: The statistics to render
+    :type stats: StatsRegistry
+    :return: The rendered metrics
+    :rtype: str
+    """
+    lines = []
+
+    for name, snapshot in stats.snapshot().items():
+        metric = METRIC_PREFIX + name.replace(".", "_").replace("-", "_")
+        stat = stats.get(name)
+
+        if isinstance(stat, Counter):
+            lines.append(f"# TYPE {metric}_total counter")
+            lines.append(f"{metric}_total {_format(snapshot['total'])}")
+        elif isinstance(stat, Histogram):
+            lines.append(f"# TYPE {metric} summary")
+            lines.extend(_render_quantiles(metric, snapshot))
+            lines.append(f"{metric}_count {_format(snapshot['count'])}")
+        elif isinstance(stat, Gauge):
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {_format(snapshot['value'])}")
+
+    return "\n".join(lines) + "\n"
+
+
+def _render_quantiles(metric: str, snapshot: Dict[str, float]) -> List[str]:
+    return [
+        f'{metric}{{quantile="{quantile}"}} {_format(snapshot[key])}'
+        for key, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99"))
+    ]
+
+
+def _format(value: float) -> str:
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    return repr(value) if isinstance(value, float) else str(int(value))
+
+
+def _make_handler(stats: StatsRegistry) -> type:
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = render(stats).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            # Scrapes are too frequent to be logged as info
+            logging.debug("Metrics request: " + format, *args)
+
+    return _MetricsHandler
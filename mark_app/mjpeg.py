@@ -0,0 +1,271 @@
+"""Exports the JPEGs of a recording session to a playable MJPEG stream, with an index to seek to any frame."""
+import argparse
+import io
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import ByteString, Iterator, List, NamedTuple, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from labels import LABELS_FILE, read_labels
+from shards import METADATA_FILE, ShardReader
+
+MJPEG_FILE = "session.avi"
+# The index lives next to the stream, and starts with a magic and a version
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"MKMJPG\x00\x01"
+# Each record holds the offset and length of a JPEG in the stream, and the time of the frame
+INDEX_RECORD = struct.Struct(">QId")
+INDEX_DTYPE = np.dtype([("offset", ">u8"), ("length", ">u4"), ("timestamp", ">f8")])
+# Layouts of the AVI headers, which are written again with the final counts once the stream is closed
+AVI_MAIN_HEADER = struct.Struct("<14I")
+AVI_STREAM_HEADER = struct.Struct("<4s4sIHHIIIIIIII4h")
+BITMAP_INFO_HEADER = struct.Struct("<IiiHH4sIiiII")
+# The frame rate assumed until the timestamps of the frames are known
+DEFAULT_FPS = 10.0
+
+
+class Frame(NamedTuple):
+    """A frame read from a stream"""
+
+    # The JPEG, as received from M.A.R.K.
+    data: bytes
+    # Seconds since the session started
+    timestamp: float
+
+
+class MjpegWriter:
+    """Writes JPEGs one after the other to an MJPEG AVI file, without re-encoding them.
+
+    The AVI can be played by common video players at the average frame rate of the frames. The exact time of every
+    frame, along with where it is in the file, is written to an index next to it, which is flushed after every frame
+    so the stream can be read while it is being written. AVI files are limited to 4 GiB.
+
+    :param path: The path of the stream
+    :type path: Union[str, Path]
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self._path = Path(path)
+        self._file = open(self._path, "wb")
+        self._index_file = open(str(self._path) + INDEX_SUFFIX, "wb")
+        self._index_file.write(INDEX_MAGIC)
+        # Offset, relative to the start of the `movi` list, and size of every frame, for the index of the AVI itself
+        self._chunks: List[Tuple[int, int]] = []
+        self._first_timestamp = None
+        self._last_timestamp = None
+        self._size = (0, 0)
+        self._max_frame_bytes = 0
+        self._lock = threading.Lock()
+        self.count = 0
+
+        self._file.write(self._header())
+        # Position of the `movi` fourcc, which the offsets in the index of the AVI are relative to
+        self._movi_offset = self._file.tell() - 4
+
+    def append(self, data: ByteString, timestamp: float) -> int:
+        """Appends a frame
+
+        :param data: The JPEG
+        :type data: ByteString
+        :param timestamp: Seconds since the session started
+        :type timestamp: float
+        :return: The index of the frame in the stream
+        :rtype: int
+        """
+        with self._lock:
+            if not self._chunks:
+                # Only the header of the first JPEG is parsed, to get the size of the video
+                self._size = Image.open(io.BytesIO(data)).size
+                self._first_timestamp = timestamp
+            self._last_timestamp = timestamp
+
+            offset = self._file.tell()
+            # Chunks are padded to an even size
+            chunk = struct.pack("<4sI", b"00dc", len(data)) + bytes(data) + b"\x00" * (len(data) % 2)
+            if offset + len(chunk) + 16 * (len(self._chunks) + 1) >= 2**32:
+                raise ValueError(f"{self._path} is full")
+            self._file.write(chunk)
+            self._file.flush()
+            self._index_file.write(INDEX_RECORD.pack(offset + 8, len(data), timestamp))
+            self._index_file.flush()
+
+            self._chunks.append((offset - self._movi_offset, len(data)))
+            self._max_frame_bytes = max(self._max_frame_bytes, len(data))
+            self.count += 1
+            return self.count - 1
+
+    def close(self) -> None:
+        """Writes the index of the AVI and its final headers, and closes the stream"""
+        with self._lock:
+            movi_size = self._file.tell() - self._movi_offset
+            # Every frame is a key frame
+            index = b"".join(struct.pack("<4sIII", b"00dc", 0x10, offset, size) for offset, size in self._chunks)
+            self._file.write(struct.pack("<4sI", b"idx1", len(index)) + index)
+            riff_size = self._file.tell() - 8
+
+            self._file.seek(0)
+            self._file.write(self._header(riff_size, movi_size))
+            for f in (self._file, self._index_file):
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+    def _header(self, riff_size: int = 0, movi_size: int = 4) -> bytes:
+        frames = len(self._chunks)
+        fps = DEFAULT_FPS
+        if frames > 1 and self._last_timestamp > self._first_timestamp:
+            fps = (frames - 1) / (self._last_timestamp - self._first_timestamp)
+        width, height = self._size
+
+        main_header = AVI_MAIN_HEADER.pack(
+            round(1e6 / fps), 0, 0, 0x10, frames, 0, 1, self._max_frame_bytes, width, height, 0, 0, 0, 0
+        )
+        # The rate of the stream is given as a fraction, in thousandths of frames per second
+        rate = round(fps * 1000)
+        stream_header = AVI_STREAM_HEADER.pack(
+            b"vids", b"MJPG", 0, 0, 0, 0, 1000, rate, 0, frames, self._max_frame_bytes, 0, 0, 0, 0, width, height
+        )
+        bitmap_header = BITMAP_INFO_HEADER.pack(
+            BITMAP_INFO_HEADER.size, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0
+        )
+        stream_list = b"strl" + _chunk(b"strh", stream_header) + _chunk(b"strf", bitmap_header)
+        header_list = b"hdrl" + _chunk(b"avih", main_header) + _chunk(b"LIST", stream_list)
+
+        return (
+            struct.pack("<4sI4s", b"RIFF", riff_size, b"AVI ")
+            + _chunk(b"LIST", header_list)
+            + struct.pack("<4sI4s", b"LIST", movi_size, b"movi")
+        )
+
+
+class MjpegReader:
+    """Reads the frames of an MJPEG stream by index, including streams that are still being written.
+
+    Every frame is found through the index of the stream, so seeking to any frame takes a single read.
+
+    :param path: The path of the stream
+    :type path: Union[str, Path]
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self._file = open(path, "rb")
+        self._index_file = open(str(path) + INDEX_SUFFIX, "rb")
+        if self._index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"{path} has no valid index")
+        # Files are shared by every caller, so seeking and reading must not interleave
+        self._lock = threading.Lock()
+        self._count = 0
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Picks up the frames appended since the stream was opened or last refreshed
+
+        :return: The number of frames in the stream
+        :rtype: int
+        """
+        # A record is only complete if the whole record and its JPEG made it to disk
+        count = (os.fstat(self._index_file.fileno()).st_size - len(INDEX_MAGIC)) // INDEX_RECORD.size
+        data_size = os.fstat(self._file.fileno()).st_size
+        while count > self._count:
+            offset, length, _ = self._read_record(count - 1)
+            if offset + length <= data_size:
+                break
+            count -= 1
+        self._count = count
+
+        return count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> Frame:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Frame {index} out of range")
+
+        offset, length, timestamp = self._read_record(index)
+        with self._lock:
+            self._file.seek(offset)
+            return Frame(self._file.read(length), timestamp)
+
+    def __iter__(self) -> Iterator[Frame]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def timestamps(self) -> np.ndarray:
+        """Reads the time of every frame, e.g. to find the frame closest to a point in time
+
+        :return: Seconds since the session started, of each frame
+        :rtype: np.ndarray
+        """
+        with self._lock:
+            self._index_file.seek(len(INDEX_MAGIC))
+            records = np.frombuffer(self._index_file.read(self._count * INDEX_RECORD.size), dtype=INDEX_DTYPE)
+
+        return records["timestamp"].astype(np.float64)
+
+    def close(self) -> None:
+        """Closes the stream"""
+        self._file.close()
+        self._index_file.close()
+
+    def _read_record(self, index: int) -> Tuple[int, int, float]:
+        with self._lock:
+            self._index_file.seek(len(INDEX_MAGIC) + index * INDEX_RECORD.size)
+            return INDEX_RECORD.unpack(self._index_file.read(INDEX_RECORD.size))
+
+
+def export_session(session_dir: Union[str, Path], output: Union[str, Path, None] = None) -> int:
+    """Exports the frames of a session recorded as JPEGs to an MJPEG stream
+
+    :param session_dir: The directory of the session, either sharded or with loose images
+    :type session_dir: Union[str, Path]
+    :param output: The path of the stream, defaults to `MJPEG_FILE` in the session
+    :type output: Union[str, Path, None]
+    :return: The number of frames exported
+    :rtype: int
+    """
+    session_dir = Path(session_dir)
+
+    if session_dir.joinpath(METADATA_FILE).exists():
+        reader = ShardReader(session_dir)
+        _check_format(session_dir, reader.recording_format)
+        writer = MjpegWriter(output or session_dir.joinpath(MJPEG_FILE))
+        for index in range(len(reader)):
+            sample = reader[index]
+            writer.append(sample.data, sample.timestamp)
+        reader.close()
+    else:
+        labels = read_labels(session_dir.joinpath(LABELS_FILE))
+        _check_format(session_dir, labels.recording_format)
+        writer = MjpegWriter(output or session_dir.joinpath(MJPEG_FILE))
+        for frame, timestamp in zip(labels.frame, labels.timestamp):
+            with open(session_dir.joinpath(f"{frame}.{labels.recording_format}"), "rb") as f:
+                writer.append(f.read(), float(timestamp))
+
+    writer.close()
+    return writer.count
+
+
+def _check_format(session_dir: Path, recording_format: str) -> None:
+    # Frames are copied as is, which only makes sense for the JPEGs received from M.A.R.K.
+    if recording_format != "jpeg":
+        raise ValueError(f"{session_dir} was recorded as {recording_format}, not as JPEGs")
+
+
+def _chunk(fourcc: bytes, data: bytes) -> bytes:
+    return struct.pack("<4sI", fourcc, len(data)) + data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports recording sessions to MJPEG streams")
+    parser.add_argument("sessions", nargs="+", help="The directories of the sessions")
+    args = parser.parse_args()
+
+    for session in args.sessions:
+        print(f"{session}: exported {export_session(session)} frames")
@@ -0,0 +1,205 @@
+"""Turns recorded sessions into training-ready shards, processing several sessions in parallel."""
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from dataset import DEFAULT_FRAME_SIZE, decode_frame, is_session, open_session, session_mtime
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def find_sessions(roots: List[str]) -> List[Path]:
+    """Finds the recording sessions under the given directories
+
+    :param roots: The directories to search, recursively
+    :type roots: List[str]
+    :return: The directories of the sessions, sorted
+    :rtype: List[Path]
+    """
+    sessions = set()
+    for root in roots:
+        for directory, subdirectories, _ in os.walk(root):
+            if is_session(directory):
+                sessions.add(Path(directory).absolute())
+                # Sessions don't contain other sessions, only their cache
+                subdirectories.clear()
+
+    return sorted(sessions)
+
+
+def process_session(session_dir: Path, output_dir: Path, frame_size: Tuple[int, int], shard_size: int) -> dict:
+    """Processes a session into shards of `shard_size` samples
+
+    Every shard is a `.npz` file with `frames`, a `float16` array of shape (samples, height, width, 3) with values
+    in [0, 1], and `labels`, a `uint8` array of shape (samples, keys). Corrupt frames, and frames that are identical
+    to the previous one, are dropped.
+
+    :param session_dir: The directory of the session
+    :type session_dir: Path
+    :param output_dir: The directory where the shards of the session are written to
+    :type output_dir: Path
+    :param frame_size: The size to which frames are resized, as (width, height)
+    :type frame_size: Tuple[int, int]
+    :param shard_size: The number of samples per shard
+    :type shard_size: int
+    :return: The shards written, and the number of samples, duplicates and corrupt frames and bytes processed
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for stale in output_dir.glob("shard-*.npz"):
+        stale.unlink()
+
+    keys, read_image, labels, close = open_session(session_dir)
+    frames = np.zeros((shard_size, frame_size[1], frame_size[0], 3), dtype=np.float16)
+    shard_labels = np.zeros((shard_size, len(keys)), dtype=np.uint8)
+    shards = []
+    stats = {"samples": 0, "duplicates": 0, "corrupt": 0, "bytes": 0}
+    previous_digest = None
+    buffered = 0
+
+    for index in range(len(labels)):
+        try:
+            image = read_image(index)
+            data = image.read_bytes() if isinstance(image, Path) else image
+            stats["bytes"] += len(data)
+            # The recorder saves the latest frame on every tick, so frames repeat whenever none arrived in between
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            if digest == previous_digest:
+                stats["duplicates"] += 1
+                continue
+            previous_digest = digest
+            frame = decode_frame(data, frame_size)
+        except Exception:
+            stats["corrupt"] += 1
+            continue
+
+        np.multiply(frame, 1.0 / 255.0, out=frames[buffered], casting="unsafe")
+        shard_labels[buffered] = labels[index]
+        buffered += 1
+        stats["samples"] += 1
+
+        if buffered == shard_size:
+            shards.append(_write_shard(output_dir, len(shards), frames, shard_labels, buffered))
+            buffered = 0
+
+    close()
+    if buffered:
+        shards.append(_write_shard(output_dir, len(shards), frames, shard_labels, buffered))
+
+    return {**stats, "keys": keys, "shards": shards, "seconds": time.perf_counter() - start}
+
+
+def _write_shard(output_dir: Path, shard: int, frames: np.ndarray, labels: np.ndarray, samples: int) -> str:
+    name = f"shard-{shard:05d}.npz"
+    # Shards are written under a temporary name, so a shard cut short is never mistaken for a complete one
+    with open(output_dir.joinpath(name + ".tmp"), "wb") as f:
+        np.savez(f, frames=frames[:samples], labels=labels[:samples])
+    os.replace(output_dir.joinpath(name + ".tmp"), output_dir.joinpath(name))
+
+    return name
+
+
+def main(roots: List[str], output: str, frame_size: Tuple[int, int], shard_size: int, workers: int) -> None:
+    """Processes the sessions under `roots` that are new or changed since they were last processed
+
+    :param roots: The directories to search for sessions
+    :type roots: List[str]
+    :param output: The directory where the shards and the manifest are written to
+    :type output: str
+    :param frame_size: The size to which frames are resized, as (width, height)
+    :type frame_size: Tuple[int, int]
+    :param shard_size: The number of samples per shard
+    :type shard_size: int
+    :param workers: The number of processes
+    :type workers: int
+    """
+    output_dir = Path(output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_dir.joinpath(MANIFEST_FILE)
+    settings = {"version": MANIFEST_VERSION, "frame_size": list(frame_size), "shard_size": shard_size}
+
+    manifest = {**settings, "sessions": {}}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        # Changing how frames are processed invalidates every session processed so far
+        if all(previous.get(name) == value for name, value in settings.items()):
+            manifest = previous
+
+    sessions = find_sessions(roots)
+    # Sessions are only processed again if they changed since, e.g. when they were still being recorded
+    mtimes = {session: session_mtime(session) for session in sessions}
+    todo = [
+        session
+        for session in sessions
+        if manifest["sessions"].get(str(session), {}).get("source_mtime", -1) < mtimes[session]
+    ]
+    print(f"Found {len(sessions)} sessions, {len(todo)} new or changed, using {workers} processes")
+
+    start = time.perf_counter()
+    totals = {"samples": 0, "duplicates": 0, "corrupt": 0, "bytes": 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                process_session, session, output_dir.joinpath(_output_name(session)), frame_size, shard_size
+            ): session
+            for session in todo
+        }
+        for future in as_completed(futures):
+            session = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"{session}: failed, {e}")
+                continue
+
+            manifest["sessions"][str(session)] = {
+                "source_mtime": mtimes[session],
+                "output": _output_name(session),
+                **result,
+            }
+            # The manifest is saved after every session, so an interrupted run doesn't redo the finished ones
+            with open(str(manifest_path) + ".tmp", "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(str(manifest_path) + ".tmp", manifest_path)
+
+            for name in totals:
+                totals[name] += result[name]
+            print(
+                f"{session}: {result['samples']} samples in {len(result['shards'])} shards, dropped "
+                f"{result['duplicates']} duplicates and {result['corrupt']} corrupt, "
+                f"{result['samples'] / max(result['seconds'], 1e-9):.0f} samples/s"
+            )
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Processed {totals['samples']} samples from {len(todo)} sessions in {elapsed:.1f} s: "
+        f"{totals['samples'] / max(elapsed, 1e-9):.0f} samples/s, {totals['bytes'] / max(elapsed, 1e-9) / 1e6:.1f} MB/s"
+        f" read, dropped {totals['duplicates']} duplicates and {totals['corrupt']} corrupt"
+    )
+
+
+def _output_name(session_dir: Path) -> str:
+    # Session directories are named after the time they started, which may clash across recording directories
+    return f"{session_dir.name}_{hashlib.blake2b(str(session_dir).encode('utf-8'), digest_size=4).hexdigest()}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("roots", nargs="+", help="Directories to search for recording sessions")
+    parser.add_argument("--output", required=True, help="Directory where the shards and the manifest are written to")
+    parser.add_argument("--size", type=int, nargs=2, default=DEFAULT_FRAME_SIZE, help="Width and height of frames")
+    parser.add_argument("--shard-size", type=int, default=1024, help="Number of samples per shard")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes")
+    args = parser.parse_args()
+
+    main(args.roots, args.output, tuple(args.size), args.shard_size, args.workers)
@@ -0,0 +1,77 @@
+"""Defines a bounded in-memory buffer of the most recent frames, to record what happened before recording started."""
+import threading
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple
+
+from protocol import Frame
+
+
+class BufferedSample(NamedTuple):
+    """A frame held in memory along with the controller values at the time"""
+
+    # The frame, as received from M.A.R.K., so its JPEG is held by reference rather than copied or decoded
+    frame: Frame
+    # The value of each key of the controller
+    controller: Dict[str, int]
+    # When the sample was taken, in seconds
+    timestamp: float
+
+
+class PrerollBuffer:
+    """A ring of the most recent samples, bounded both in time and in memory.
+
+    Once a sample is appended, the oldest samples are evicted until the samples left span at most `max_seconds` and
+    their images take at most `max_bytes`, so memory stays bounded no matter the frame rate or the size of frames.
+
+    :param max_seconds: The maximum time between the oldest and the newest sample
+    :type max_seconds: float
+    :param max_bytes: The maximum size of the images of all samples
+    :type max_bytes: int
+    """
+
+    def __init__(self, max_seconds: float, max_bytes: int) -> None:
+        self._max_seconds = max_seconds
+        self._max_bytes = max_bytes
+        self._samples: Deque[BufferedSample] = deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def append(self, frame: Frame, controller: Dict[str, int], timestamp: float) -> None:
+        """Appends a sample, evicting the oldest ones if needed
+
+        :param frame: The frame
+        :type frame: Frame
+        :param controller: The value of each key of the controller
+        :type controller: Dict[str, int]
+        :param timestamp: When the sample was taken, in seconds
+        :type timestamp: float
+        """
+        with self._lock:
+            self._samples.append(BufferedSample(frame, controller, timestamp))
+            self._bytes += len(frame.data)
+
+            while self._samples and (
+                self._bytes > self._max_bytes or timestamp - self._samples[0].timestamp > self._max_seconds
+            ):
+                self._bytes -= len(self._samples.popleft().frame.data)
+
+    def drain(self) -> List[BufferedSample]:
+        """Takes all the samples in the buffer, leaving it empty
+
+        :return: The samples, oldest first
+        :rtype: List[BufferedSample]
+        """
+        with self._lock:
+            samples = list(self._samples)
+            self._samples.clear()
+            self._bytes = 0
+
+        return samples
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    @property
+    def size(self) -> int:
+        """The size of the images of all samples, in bytes"""
+        return self._bytes
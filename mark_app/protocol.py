@@ -0,0 +1,410 @@
+"""Defines the binary protocol used to stream camera frames from M.A.R.K. and to send it commands."""
+import logging
+import struct
+import time
+from typing import ByteString, List, NamedTuple, Optional
+
+# Every framed message sent by M.A.R.K. starts with a fixed-size header:
+#   magic (2 bytes) | version (1 byte) | kind (1 byte) | sequence number (4 bytes)
+#   | capture timestamp in ms (4 bytes) | payload length (4 bytes)
+# All fields are big-endian. The magic can never be confused with the start of a JPEG (`FF D8`), which is what
+# allows the server to automatically tell framed streams apart from legacy ones
+FRAME_MAGIC = b"MK"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct(">2sBBIII")
+
+# Every command sent to M.A.R.K. starts with a fixed-size header:
+#   magic (2 bytes) | version (1 byte) | kind (1 byte) | sequence number (4 bytes)
+#   | send timestamp in ms (4 bytes) | payload length (2 bytes)
+COMMAND_MAGIC = b"MC"
+COMMAND_VERSION = 1
+COMMAND_HEADER = struct.Struct(">2sBBIIH")
+# Payload of a `COMMAND_KIND.KEYS` command: bitmask of the pressed keys, bit `i` being the key with command code `i + 1`
+KEYS_PAYLOAD = struct.Struct(">H")
+# Payload of a `COMMAND_KIND.HINT` command: JPEG quality and interval between frames in ms
+HINT_PAYLOAD = struct.Struct(">BH")
+
+# Payload of a `FRAME_KIND.ACK` frame: sequence number and timestamp of the command applied by M.A.R.K., as sent
+ACK_PAYLOAD = struct.Struct(">II")
+
+# Upper bound for a single payload, anything bigger is considered a corrupted header
+MAX_PAYLOAD_SIZE = 4 * 1024 * 1024
+
+# Default maximum number of bytes received from the socket at once
+DEFAULT_RECV_SIZE = 64 * 1024
+
+# Markers used to find the edges of a JPEG in legacy (unframed) streams
+JPEG_START = b"\xFF\xD8"
+JPEG_END = b"\xFF\xD9"
+
+
+class FRAME_KIND:
+    """Defines the kinds of payloads that can be carried by a frame"""
+
+    JPEG = 0
+    # Sent once by a robot right after connecting, carrying its id as a UTF-8 string
+    HELLO = 1
+    # Sent by a robot when it applies a command, see `ACK_PAYLOAD`
+    ACK = 2
+
+
+class COMMAND_KIND:
+    """Defines the kinds of commands that can be sent to M.A.R.K."""
+
+    # The full state of the controller keys
+    KEYS = 0
+    # The quality and frame interval the camera feed should use
+    HINT = 1
+
+
+class STREAM_MODE:
+    """Defines the modes in which a stream from M.A.R.K. can be decoded"""
+
+    UNKNOWN = "UNKNOWN"
+    FRAMED = "FRAMED"
+    LEGACY = "LEGACY"
+
+
+class Frame(NamedTuple):
+    """A complete frame received from M.A.R.K.
+
+    Frames decoded from legacy streams carry no sequence number nor capture timestamp. The id of the robot that sent
+    the frame is only known to the server, which sets it once the frame is reassembled. The times at which the frame
+    started and finished being received are given by `time.monotonic()`.
+    """
+
+    kind: int
+    seq: Optional[int]
+    timestamp_ms: Optional[int]
+    data: bytearray
+    robot_id: Optional[str] = None
+    started_at: Optional[float] = None
+    received_at: Optional[float] = None
+
+
+class Command(NamedTuple):
+    """A command sent to M.A.R.K."""
+
+    kind: int
+    seq: int
+    timestamp_ms: int
+    payload: bytes
+
+
+def encode_frame_header(seq: int, timestamp_ms: int, length: int, kind: int = FRAME_KIND.JPEG) -> bytes:
+    """Encodes the header that must precede a payload in a framed stream
+
+    :param seq: The sequence number of the frame
+    :type seq: int
+    :param timestamp_ms: The time at which the payload was captured in milliseconds
+    :type timestamp_ms: int
+    :param length: The length of the payload in bytes
+    :type length: int
+    :param kind: The kind of payload, defaults to `FRAME_KIND.JPEG`
+    :type kind: int
+    :return: The encoded header
+    :rtype: bytes
+    """
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, kind, seq & 0xFFFFFFFF, timestamp_ms & 0xFFFFFFFF, length)
+
+
+def encode_hello(robot_id: str) -> bytes:
+    """Encodes the hello frame a robot sends right after connecting to identify itself
+
+    :param robot_id: The id of the robot
+    :type robot_id: str
+    :return: The encoded frame, header included
+    :rtype: bytes
+    """
+    payload = robot_id.encode("utf-8")
+    return encode_frame_header(0, 0, len(payload), kind=FRAME_KIND.HELLO) + payload
+
+
+def encode_keys_command(seq: int, timestamp_ms: int, keys: int) -> bytes:
+    """Encodes a command carrying the state of the controller keys
+
+    :param seq: The sequence number of the command
+    :type seq: int
+    :param timestamp_ms: The time at which the command was sent in milliseconds
+    :type timestamp_ms: int
+    :param keys: The bitmask of the pressed keys
+    :type keys: int
+    :return: The encoded command
+    :rtype: bytes
+    """
+    header = COMMAND_HEADER.pack(
+        COMMAND_MAGIC,
+        COMMAND_VERSION,
+        COMMAND_KIND.KEYS,
+        seq & 0xFFFFFFFF,
+        timestamp_ms & 0xFFFFFFFF,
+        KEYS_PAYLOAD.size,
+    )
+    return header + KEYS_PAYLOAD.pack(keys)
+
+
+def encode_legacy_keys_command(keys: int) -> bytes:
+    """Encodes keys the way older versions of `remote.py` expect them, with one byte per key holding its command code
+
+    :param keys: The bitmask of the keys to send, where bit `i` is the key with command code `i + 1`
+    :type keys: int
+    :return: The encoded command, empty if no key is set
+    :rtype: bytes
+    """
+    return bytes(i + 1 for i in range(keys.bit_length()) if keys >> i & 1)
+
+
+def encode_hint_command(seq: int, timestamp_ms: int, quality: int, frame_interval_ms: int) -> bytes:
+    """Encodes a command hinting the quality and frame interval the camera feed should use
+
+    :param seq: The sequence number of the command
+    :type seq: int
+    :param timestamp_ms: The time at which the command was sent in milliseconds
+    :type timestamp_ms: int
+    :param quality: The JPEG quality, from 0 to 100
+    :type quality: int
+    :param frame_interval_ms: The minimum interval between frames in milliseconds
+    :type frame_interval_ms: int
+    :return: The encoded command
+    :rtype: bytes
+    """
+    header = COMMAND_HEADER.pack(
+        COMMAND_MAGIC,
+        COMMAND_VERSION,
+        COMMAND_KIND.HINT,
+        seq & 0xFFFFFFFF,
+        timestamp_ms & 0xFFFFFFFF,
+        HINT_PAYLOAD.size,
+    )
+    return header + HINT_PAYLOAD.pack(quality, frame_interval_ms)
+
+
+def decode_commands(buffer: bytearray) -> List[Command]:
+    """Decodes the complete commands at the start of a buffer, removing them from it
+
+    Bytes that don't belong to a command are skipped, and incomplete commands are left in the buffer.
+
+    :param buffer: The received bytes
+    :type buffer: bytearray
+    :return: The decoded commands, in the order in which they were sent
+    :rtype: List[Command]
+    """
+    commands = []
+    offset = 0
+
+    while len(buffer) - offset >= COMMAND_HEADER.size:
+        magic, version, kind, seq, timestamp_ms, length = COMMAND_HEADER.unpack_from(buffer, offset)
+
+        if magic != COMMAND_MAGIC or version != COMMAND_VERSION:
+            offset += 1
+            continue
+
+        end = offset + COMMAND_HEADER.size + length
+        if len(buffer) < end:
+            break
+
+        commands.append(Command(kind, seq, timestamp_ms, bytes(buffer[offset + COMMAND_HEADER.size : end])))
+        offset = end
+
+    del buffer[:offset]
+
+    return commands
+
+
+class FrameParser:
+    """Incrementally reassembles frames from the raw bytes received from M.A.R.K.
+
+    The mode of the stream is detected from its first bytes: streams starting with `FRAME_MAGIC` are decoded using
+    the frame headers, anything else falls back to scanning for the JPEG start and end markers.
+
+    Bytes are received directly into the parser's memory: callers ask for a `writable()` view, receive into it (e.g.
+    with `socket.recv_into`) and `commit()` the number of bytes written. Headers and legacy streams are received into
+    a preallocated buffer that is reused across frames, while the payload of a framed message is received straight
+    into the buffer that is eventually handed out with the `Frame`, so it is never copied.
+
+    :param recv_size: The maximum number of bytes to receive at once, defaults to `DEFAULT_RECV_SIZE`
+    :type recv_size: int
+    """
+
+    def __init__(self, recv_size: int = DEFAULT_RECV_SIZE) -> None:
+        self.mode = STREAM_MODE.UNKNOWN
+        self.errors = 0
+        self._recv_size = recv_size
+        # Received bytes that haven't been consumed yet live in `_buffer[_start:_end]`
+        self._buffer = bytearray(2 * recv_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        # Position up to which the buffer has already been scanned for a JPEG end marker (legacy mode only)
+        self._scan_pos = 0
+        self._in_image = False
+        self._image_started_at = None
+        # Header, payload buffer and number of payload bytes received for the frame in progress (framed mode only)
+        self._pending_header = None
+        self._pending_payload = None
+        self._pending_size = 0
+
+    def writable(self) -> memoryview:
+        """Returns the view where the next bytes from M.A.R.K. should be received into
+
+        The view is only valid until the next call to `commit()`.
+
+        :return: A writable view of at most `recv_size` bytes
+        :rtype: memoryview
+        """
+        if self._pending_payload is not None:
+            return memoryview(self._pending_payload)[self._pending_size : self._pending_size + self._recv_size]
+
+        self._reserve(self._recv_size)
+        return self._view[self._end : self._end + self._recv_size]
+
+    def commit(self, nbytes: int) -> List[Frame]:
+        """Processes the bytes that were written to the last view returned by `writable()`
+
+        :param nbytes: The number of bytes written
+        :type nbytes: int
+        :return: The frames completed by these bytes, if any
+        :rtype: List[Frame]
+        """
+        frames = []
+
+        if self._pending_payload is not None:
+            self._pending_size += nbytes
+            if self._pending_size < len(self._pending_payload):
+                return frames
+            frames.append(self._complete_pending())
+        else:
+            self._end += nbytes
+
+        if self.mode == STREAM_MODE.UNKNOWN:
+            if self._end - self._start < len(FRAME_MAGIC):
+                return frames
+            is_framed = self._view[self._start : self._start + len(FRAME_MAGIC)] == FRAME_MAGIC
+            self.mode = STREAM_MODE.FRAMED if is_framed else STREAM_MODE.LEGACY
+            logging.info("Detected %s stream from M.A.R.K.", self.mode.lower())
+
+        if self.mode == STREAM_MODE.FRAMED:
+            self._parse_framed(frames)
+        else:
+            self._parse_legacy(frames)
+
+        return frames
+
+    def feed(self, data: ByteString) -> List[Frame]:
+        """Copies already received bytes into the parser and processes them
+
+        :param data: The received bytes
+        :type data: ByteString
+        :return: The frames completed by these bytes, if any
+        :rtype: List[Frame]
+        """
+        frames = []
+        data = memoryview(data)
+
+        while data:
+            view = self.writable()
+            nbytes = min(len(view), len(data))
+            view[:nbytes] = data[:nbytes]
+            frames += self.commit(nbytes)
+            data = data[nbytes:]
+
+        return frames
+
+    def _reserve(self, nbytes: int) -> None:
+        # Make sure there is room for `nbytes` after the unconsumed bytes, by first moving them to the start of the
+        # buffer and then growing it if that is not enough (e.g. legacy frames bigger than the buffer)
+        if len(self._buffer) - self._end >= nbytes:
+            return
+
+        size = self._end - self._start
+        if self._start > 0:
+            self._view[:size] = self._view[self._start : self._end]
+            self._scan_pos -= self._start
+            self._start, self._end = 0, size
+
+        if len(self._buffer) - self._end < nbytes:
+            buffer = bytearray(len(self._buffer) + max(len(self._buffer), nbytes))
+            buffer[:size] = self._view[:size]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+
+    def _complete_pending(self) -> Frame:
+        kind, seq, timestamp_ms, started_at = self._pending_header
+        frame = Frame(
+            kind, seq, timestamp_ms, self._pending_payload, started_at=started_at, received_at=time.monotonic()
+        )
+        self._pending_header = None
+        self._pending_payload = None
+        self._pending_size = 0
+
+        return frame
+
+    def _parse_framed(self, frames: List[Frame]) -> None:
+        while self._end - self._start >= FRAME_HEADER.size:
+            magic, version, kind, seq, timestamp_ms, length = FRAME_HEADER.unpack_from(self._buffer, self._start)
+
+            if magic != FRAME_MAGIC or version != FRAME_VERSION or length > MAX_PAYLOAD_SIZE:
+                # The stream is out of sync, skip ahead to the next candidate header
+                self.errors += 1
+                next_magic = self._buffer.find(FRAME_MAGIC, self._start + 1, self._end)
+                self._start = self._end - 1 if next_magic == -1 else next_magic
+                continue
+
+            self._start += FRAME_HEADER.size
+            # Move whatever part of the payload was already received to its own buffer, the rest of it will be
+            # received directly into that buffer
+            received = min(length, self._end - self._start)
+            self._pending_header = (kind, seq, timestamp_ms, time.monotonic())
+            self._pending_payload = bytearray(length)
+            self._pending_payload[:received] = self._view[self._start : self._start + received]
+            self._pending_size = received
+            self._start += received
+
+            if received < length:
+                break
+
+            frames.append(self._complete_pending())
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _parse_legacy(self, frames: List[Frame]) -> None:
+        # Handling of camera feed modified from:
+        # https://github.com/codeandrobots/codeandrobots-app/blob/master/App/Services/Socket/index.js#L185
+        while True:
+            if not self._in_image:
+                # Look for the starting bytes of a JPEG, discarding anything that comes before them
+                start_index = self._buffer.find(JPEG_START, self._start, self._end)
+                if start_index == -1:
+                    # Keep the last byte around in case the marker was split across chunks
+                    self._start = max(self._end - 1, self._start)
+                    break
+
+                self._start = start_index
+                self._in_image = True
+                self._scan_pos = start_index + len(JPEG_START)
+                self._image_started_at = time.monotonic()
+
+            # Look for the ending bytes of a JPEG to determine if we are done reading the image
+            end_index = self._buffer.find(JPEG_END, self._scan_pos, self._end)
+            if end_index == -1:
+                # Resume the scan where we left off, minus one byte in case the marker was split across chunks
+                self._scan_pos = max(self._end - 1, self._start + len(JPEG_START))
+                break
+
+            # We add the length of the marker to actually include the ending bytes, and copy the image out of the
+            # receive buffer since it will be reused
+            end = end_index + len(JPEG_END)
+            image = bytearray(self._view[self._start : end])
+            frames.append(
+                Frame(
+                    FRAME_KIND.JPEG,
+                    None,
+                    None,
+                    image,
+                    started_at=self._image_started_at,
+                    received_at=time.monotonic(),
+                )
+            )
+            self._start = end
+            self._in_image = False
@@ -1,95 +1,536 @@
-import csv
 import io
+import logging
+import queue
 import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import ByteString, Callable, Deque, Dict, List, Optional, Tuple
 
-import PIL
+import numpy as np
+from PIL import Image
 
 from controller import KeyboardController
+from dispatcher import STOP_CHECK_INTERVAL_S
+from key_events import KEY_EVENTS_FILE, KeyEventLog, KeyEventRing
+from labels import LABELS_FILE, LabelLog, keys_to_bitmask
+from preroll import BufferedSample, PrerollBuffer
+from protocol import Frame
 from server import Server
+from shards import ShardWriter
+from stats import registry
+
+# How often the transitions of the keys are written to the session
+KEY_EVENTS_FLUSH_INTERVAL_S = 1.0
+# Memory used to keep samples in memory, either before recording starts or while keeping only the last minutes
+DEFAULT_PREROLL_BYTES = 64 * 1024 * 1024
+DEFAULT_ROLLING_BYTES = 512 * 1024 * 1024
+
+
+class RECORDING_FORMAT:
+    """Defines the formats in which camera images can be recorded"""
+
+    # The JPEG received from M.A.R.K. as is, without decoding it
+    JPEG = "jpeg"
+    # The decoded image, re-encoded losslessly
+    PNG = "png"
+    # The decoded image as a raw `uint8` array of shape (height, width, channels)
+    NPY = "npy"
+
+
+class RECORDING_MODE:
+    """Defines when samples are recorded"""
+
+    # On every tick of the sample rate, with whatever frame was the latest one
+    TIMER = "timer"
+    # On every new frame, as soon as it is received
+    FRAMES = "frames"
 
 
 class Recorder(threading.Thread):
     """A class that asynchronously records camera images and controller values
 
+    Sampling is decoupled from saving: samples are taken on exact ticks of a monotonic clock, and handed over to a
+    bounded pool of writers. When the writers fall behind and too many samples are pending, new samples are dropped
+    instead of delaying the ticks, so the recorded samples stay evenly spaced no matter how slow the disk is.
+
+    Alternatively, samples can be recorded as frames arrive from M.A.R.K., so that every frame is recorded exactly once
+    along with the controller values at the time it arrived.
+
+    While not recording, the latest frames are kept in memory along with the controller values, and are saved at the
+    start of the next session, so that sessions include the seconds before recording started. Sessions can also keep
+    only their last minutes, in which case samples are kept in memory and only saved once recording stops.
+
     :param server: The server instance
     :type server: Server
     :param controller: The keyboard controller instance
     :type controller: KeyboardController
     :param sample_rate_ms: The rate at which to sample and record data in milliseconds
     :type sample_rate_ms: int
+    :param writers: The number of threads saving samples, defaults to 2
+    :type writers: int
+    :param max_pending: The maximum number of samples waiting to be saved before new ones are dropped, defaults to 32
+    :type max_pending: int
+    :param preroll_s: How many seconds before recording starts are saved to the session, defaults to 10
+    :type preroll_s: float
+    :param preroll_bytes: The maximum size of the frames kept before recording starts, defaults to
+        `DEFAULT_PREROLL_BYTES`
+    :type preroll_bytes: int
+    :param rolling_bytes: The maximum size of the frames kept when keeping only the last minutes of a session,
+        defaults to `DEFAULT_ROLLING_BYTES`
+    :type rolling_bytes: int
     """
 
-    def __init__(self, server: Server, controller: KeyboardController, sample_rate_ms: int) -> None:
+    def __init__(
+        self,
+        server: Server,
+        controller: KeyboardController,
+        sample_rate_ms: int,
+        writers: int = 2,
+        max_pending: int = 32,
+        preroll_s: float = 10.0,
+        preroll_bytes: int = DEFAULT_PREROLL_BYTES,
+        rolling_bytes: int = DEFAULT_ROLLING_BYTES,
+    ) -> None:
         super().__init__()
 
         self._server = server
         self._controller = controller
         self._sample_rate_ms = sample_rate_ms
         self._should_run = threading.Event()
-        self._img_dir = None
-        self._img_count = 0
-        self._csv_file = None
-        self._csv_writer = None
+        self._stopped = threading.Event()
+        # The session being recorded, if any, and the sessions still being saved once stopped
+        self._session: Optional[_SessionWriter] = None
+        self._closing: List[_SessionWriter] = []
+        self._mode = RECORDING_MODE.TIMER
+        self._every_nth_frame = 1
+        self._frame_count = 0
+        self._writers = ThreadPoolExecutor(max_workers=writers, thread_name_prefix="RecorderWriter")
+        self._max_pending = max_pending
+        # Guards the session, which is started and stopped from other threads
+        self._lock = threading.Lock()
+        self._preroll = PrerollBuffer(preroll_s, preroll_bytes)
+        self._rolling_bytes = rolling_bytes
+        # Samples of the session kept in memory until it stops, when only its last minutes are kept
+        self._rolling: Optional[PrerollBuffer] = None
+        # Counts the samples of the sessions still being saved once stopped too
+        registry.gauge(
+            "recorder.pending",
+            lambda: sum(writer.pending for writer in [self._session, *self._closing] if writer is not None),
+        )
+        registry.gauge("recorder.preroll_bytes", lambda: self._preroll.size)
+
+        if preroll_s > 0:
+            self._server.subscribe(self._buffer_frame)
 
-    def start_recording(self, output_dir: str) -> None:
+    def start_recording(
+        self,
+        output_dir: str,
+        recording_format: str = RECORDING_FORMAT.JPEG,
+        sharded: bool = False,
+        mode: str = RECORDING_MODE.TIMER,
+        every_nth_frame: int = 1,
+        keep_last_s: Optional[float] = None,
+    ) -> None:
         """Starts recording
 
+        The frames received in the seconds before are saved first, with negative timestamps.
+
         :param output_dir: The dictory where the data will be saved to. A child directory with the timestamp will be created.
         :type output_dir: str
+        :param recording_format: The format in which camera images are saved, one of `RECORDING_FORMAT`, defaults to
+            `RECORDING_FORMAT.JPEG`
+        :type recording_format: str
+        :param sharded: Whether to save samples to a few large shards (see `shards.py`) instead of one file per image
+            plus a label log, defaults to False
+        :type sharded: bool
+        :param mode: When samples are recorded, one of `RECORDING_MODE`, defaults to `RECORDING_MODE.TIMER`
+        :type mode: str
+        :param every_nth_frame: When recording on frames, only every Nth frame is recorded, defaults to 1
+        :type every_nth_frame: int
+        :param keep_last_s: If given, only the samples of the last `keep_last_s` seconds of the session are saved,
+            once recording stops, defaults to None
+        :type keep_last_s: Optional[float]
         """
-        # Prepare image directory
-        self._img_dir = Path(output_dir).joinpath(datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
-        self._img_dir.mkdir(parents=True, exist_ok=False)
-        self._img_count = 0
+        if recording_format not in _IMAGE_ENCODERS:
+            raise ValueError(f"Unknown recording format: {recording_format}")
+
+        with self._lock:
+            self._mode = mode
+            self._every_nth_frame = max(every_nth_frame, 1)
+            self._frame_count = 0
+
+            # Prepare image directory
+            img_dir = Path(output_dir).joinpath(datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+            img_dir.mkdir(parents=True, exist_ok=False)
+            start = time.monotonic()
 
-        # Prepare csv file to store the data
-        self._csv_file = open(self._img_dir.joinpath("data.csv"), "w", newline="")
-        self._csv_writer = csv.writer(self._csv_file)
-        # Write header: image location + controller keys
-        self._csv_writer.writerow(["Image"] + self._controller.keys())
+            preroll = self._preroll.drain()
+            # Every transition of the keys is logged next to the samples, starting from their state at the first sample
+            events = self._controller.events.drain()
+            key_events = KeyEventLog(img_dir.joinpath(KEY_EVENTS_FILE))
+            if preroll:
+                key_events.write_snapshot(preroll[0].timestamp - start, self._to_bitmask(preroll[0].controller))
+                key_events.write(events[events["timestamp"] > preroll[0].timestamp], start)
+            key_events.write_snapshot(0.0, self._controller.read_bitmask())
 
-        # Set the run event so the thread starts working
-        self._should_run.set()
+            labels, shards = None, None
+            if sharded:
+                # Images and controller values are appended to the shards instead
+                shards = ShardWriter(img_dir, self._controller.keys(), recording_format)
+            else:
+                # Prepare the log of the labels, which can be exported to csv with `labels.py`
+                labels = LabelLog(img_dir.joinpath(LABELS_FILE), self._controller.keys(), recording_format)
+            self._session = _SessionWriter(
+                img_dir,
+                recording_format,
+                start,
+                labels,
+                shards,
+                key_events,
+                self._controller.events,
+                self._writers,
+                self._max_pending,
+            )
+            self._session.start()
+
+            if keep_last_s is not None:
+                self._rolling = PrerollBuffer(keep_last_s, self._rolling_bytes)
+            self._save_preroll(preroll)
+
+            if mode == RECORDING_MODE.FRAMES:
+                self._server.subscribe(self._on_frame)
+            else:
+                # Set the run event so the thread starts working
+                self._should_run.set()
 
     def stop_recording(self) -> None:
         """Stops recording
 
-        Data is only saved when the recording is stopped
+        Returns right away, while the session writer saves the pending samples and then closes the labels or the shards
         """
-        # Unset the run event to the thread stops working
-        self._should_run.clear()
-        self._csv_file.close()
+        with self._lock:
+            # Unset the run event to the thread stops working
+            self._should_run.clear()
+            if self._mode == RECORDING_MODE.FRAMES:
+                self._server.unsubscribe(self._on_frame)
+            if self._rolling is not None:
+                # Only now are the last minutes of the session saved
+                rolling, self._rolling = self._rolling, None
+                for sample in rolling.drain():
+                    self._record(sample.frame, sample.controller, sample.timestamp, drop=False)
+            session, self._session = self._session, None
+            session.close()
+            self._closing = [writer for writer in self._closing if writer.is_alive()] + [session]
+
+    def close(self) -> None:
+        """Stops recording if needed, and stops the thread once the pending samples are saved"""
+        self._server.unsubscribe(self._buffer_frame)
+        if self._session is not None:
+            self.stop_recording()
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        # Session writers wait for the images encoded by the pool, so they are stopped first
+        for writer in self._closing:
+            writer.join()
+        self._writers.shutdown(wait=True)
 
     def run(self) -> None:
-        while True:
-            # Wait for the run event to be set
-            self._should_run.wait()
+        period = self._sample_rate_ms / 1000.0
+
+        while not self._stopped.is_set():
+            # Wait for the run event to be set, checking once in a while whether the recorder is closed
+            if not self._should_run.wait(STOP_CHECK_INTERVAL_S):
+                continue
+            next_tick = time.monotonic()
+
+            while self._should_run.is_set():
+                # How late the tick is, which is what makes samples unevenly spaced
+                registry.histogram("recorder.tick_lag_ms").observe((time.monotonic() - next_tick) * 1000.0)
+                with self._lock:
+                    if self._should_run.is_set():
+                        self._sample()
+
+                # Schedule ticks from the previous one instead of from now, so the samples don't drift
+                next_tick += period
+                now = time.monotonic()
+                if now > next_tick:
+                    # Ticks that were missed entirely are skipped rather than sampled in a burst
+                    missed = int((now - next_tick) / period)
+                    if missed:
+                        registry.counter("recorder.missed_ticks").inc(missed)
+                        next_tick += missed * period
+                time.sleep(max(next_tick - now, 0))
+
+    def _sample(self) -> None:
+        # Poll for the latest controller key and values, and the latest camera image
+        controller_data = self._controller.read()
+        frame = self._server.read_frame()
+
+        if frame is not None:
+            self._record(frame, controller_data, time.monotonic() - self._session.started_at)
+
+    def _on_frame(self, frame: Frame) -> None:
+        # Runs on the thread receiving frames from M.A.R.K., so it only picks the frame and queues it to be saved
+        with self._lock:
+            if self._mode != RECORDING_MODE.FRAMES or self._session is None:
+                return
+
+            # Only the most recently connected robot is recorded, as when sampling on a timer
+            robots = self._server.robots()
+            if robots and frame.robot_id != robots[-1]:
+                return
+
+            self._frame_count += 1
+            if (self._frame_count - 1) % self._every_nth_frame:
+                return
+
+            self._record(frame, self._controller.read(), frame.received_at - self._session.started_at)
+
+    def _buffer_frame(self, frame: Frame) -> None:
+        # Runs on the thread receiving frames from M.A.R.K. for every frame, so it must stay cheap: frames are only
+        # buffered by reference, and not at all while recording
+        if self._session is not None:
+            return
+
+        robots = self._server.robots()
+        if robots and frame.robot_id != robots[-1]:
+            return
+
+        self._preroll.append(frame, self._controller.read(), frame.received_at)
 
-            # Poll for the latest controller key and values
-            controller_data = self._controller.read()
-            # Poll the server for the latest camera image and save it to the output directory
-            image_location = self._poll_camera_image()
+    def _save_preroll(self, preroll: List[BufferedSample]) -> None:
+        if self._mode == RECORDING_MODE.TIMER:
+            # Frames are thinned out to the sample rate, so that samples stay evenly spaced
+            samples, next_sample = [], float("-inf")
+            for sample in preroll:
+                if sample.timestamp >= next_sample:
+                    samples.append(sample)
+                    next_sample = sample.timestamp + self._sample_rate_ms / 1000.0
+            preroll = samples
+        else:
+            preroll = preroll[:: self._every_nth_frame]
 
-            # Write a record to the csv file with the image location + controller data
-            if image_location is not None:
-                self._csv_writer.writerow([image_location] + list(controller_data.values()))
+        for sample in preroll:
+            self._record(sample.frame, sample.controller, sample.timestamp - self._session.started_at, drop=False)
 
-            time.sleep(self._sample_rate_ms / 1000.0)
+    def _to_bitmask(self, controller_data: Dict[str, int]) -> int:
+        # Same bitmask as `KeyboardController.read_bitmask`
+        return sum(1 << (self._controller.key_to_command(key) - 1) for key, value in controller_data.items() if value)
 
-    def _poll_camera_image(self) -> Optional[str]:
-        image = self._server.read_cam_image()
+    def _record(self, frame: Frame, controller_data: Dict[str, int], timestamp: float, drop: bool = True) -> None:
+        if self._rolling is not None:
+            self._rolling.append(frame, controller_data, timestamp)
+            return
 
-        if image is None:
-            return None
+        if drop and self._session.pending >= self._max_pending:
+            # Backpressure: the writers can't keep up, so the sample is dropped instead of delaying the next ones
+            registry.counter("recorder.dropped").inc()
+            return
 
-        cam_image = PIL.Image.open(io.BytesIO(image))
-        image_location = str(self._img_dir.joinpath(f"{self._img_count}.png"))
-        cam_image.save(image_location)
+        # Samples that were kept in memory are queued no matter what, and are saved as the writers catch up
+        self._session.put(frame, list(controller_data.values()), timestamp)
 
+
+class _SessionWriter(threading.Thread):
+    """Writes the samples of a session to its labels or shards in sampling order, and closes its files once stopped
+
+    Samples are queued by the threads taking them, without ever waiting. This thread hands their images to the writer
+    pool of the recorder, which encodes and saves up to `max_pending` of them in parallel, and waits for each of them
+    in turn to append its row, so that no disk I/O happens on the threads taking samples.
+
+    :param img_dir: The directory of the session
+    :type img_dir: Path
+    :param recording_format: The format in which camera images are saved, one of `RECORDING_FORMAT`
+    :type recording_format: str
+    :param started_at: When the session started, as given by `time.monotonic()`
+    :type started_at: float
+    :param labels: The log of the labels, unless the session is sharded
+    :type labels: Optional[LabelLog]
+    :param shards: The shards of the session, if it is sharded
+    :type shards: Optional[ShardWriter]
+    :param key_events: The log of the transitions of the keys
+    :type key_events: KeyEventLog
+    :param events: The transitions of the keys of the controller, drained into the log while the session is recorded
+    :type events: KeyEventRing
+    :param writers: The threads saving images
+    :type writers: ThreadPoolExecutor
+    :param max_pending: The maximum number of images being saved at once
+    :type max_pending: int
+    """
+
+    def __init__(
+        self,
+        img_dir: Path,
+        recording_format: str,
+        started_at: float,
+        labels: Optional[LabelLog],
+        shards: Optional[ShardWriter],
+        key_events: KeyEventLog,
+        events: KeyEventRing,
+        writers: ThreadPoolExecutor,
+        max_pending: int,
+    ) -> None:
+        super().__init__(name="SessionWriter")
+
+        self.img_dir = img_dir
+        self.recording_format = recording_format
+        self.started_at = started_at
+        self.labels = labels
+        self.shards = shards
+        self.key_events = key_events
+        self._writers = writers
+        self._max_pending = max_pending
+        # Samples waiting to be saved, in sampling order, along with their controller values and time, and then `None`
+        # once the session is stopped
+        self._samples: "queue.Queue[Optional[Tuple[Frame, List[int], float]]]" = queue.Queue()
+        # Samples whose images are being saved, in sampling order, along with their image index
+        self._saving: Deque[Tuple[Future, int, List[int], float]] = deque()
+        self._img_count = 0
+        self._events = events
+        self._key_events_flushed_at = started_at
+        # Draining stops once the session is closed, so that later transitions are left to the next session
+        self._events_lock = threading.Lock()
+        self._closing = False
+        self._final_events = None
+
+    @property
+    def pending(self) -> int:
+        """The number of samples not written yet"""
+        return self._samples.qsize() + len(self._saving)
+
+    def put(self, frame: Frame, controller_values: List[int], timestamp: float) -> None:
+        """Queues a sample, to be saved in the background
+
+        :param frame: The camera image
+        :type frame: Frame
+        :param controller_values: The value of each key of the controller
+        :type controller_values: List[int]
+        :param timestamp: Seconds since the session started
+        :type timestamp: float
+        """
+        self._samples.put((frame, controller_values, timestamp))
+
+    def run(self) -> None:
+        stopped = False
+        while not stopped or self._saving:
+            self._flush_key_events()
+            if not stopped and len(self._saving) < self._max_pending:
+                try:
+                    # Only waits for new samples when no image is being saved
+                    sample = self._samples.get(block=not self._saving, timeout=KEY_EVENTS_FLUSH_INTERVAL_S)
+                except queue.Empty:
+                    if not self._saving:
+                        continue
+                else:
+                    if sample is None:
+                        stopped = True
+                    else:
+                        self._save(*sample)
+                    continue
+            self._write_row(*self._saving.popleft())
+
+        try:
+            self._write_key_events(self._final_events)
+            self.key_events.close()
+            if self.shards is not None:
+                self.shards.close()
+            else:
+                self.labels.close()
+        except Exception:
+            logging.exception("Failed to close the session %s", self.img_dir)
+
+    def _write_key_events(self, events: np.ndarray) -> None:
+        # Times are made relative to the start of the session
+        self.key_events.write(events, time_offset=self.started_at)
+
+    def close(self) -> None:
+        """Stops the session, closing its files once the samples queued so far are written"""
+        with self._events_lock:
+            # Transitions from now on belong to the next session, which starts from a snapshot of the keys
+            self._closing = True
+            self._final_events = self._events.drain()
+        self._samples.put(None)
+
+    def _flush_key_events(self) -> None:
+        # Transitions are few, so they are written in bulk once in a while rather than one by one
+        now = time.monotonic()
+        if now - self._key_events_flushed_at < KEY_EVENTS_FLUSH_INTERVAL_S:
+            return
+        with self._events_lock:
+            if self._closing:
+                return
+            events = self._events.drain()
+        try:
+            self._write_key_events(events)
+        except Exception as e:
+            logging.error("Failed to save the key events of the session %s: %s", self.img_dir, e)
+        self._key_events_flushed_at = now
+
+    def _save(self, frame: Frame, controller_values: List[int], timestamp: float) -> None:
+        # Images that go to shards are only encoded by the writers, since shards must be appended in order
+        image_location = None
+        if self.shards is None:
+            image_location = str(self.img_dir.joinpath(f"{self._img_count}.{self.recording_format}"))
+        future = self._writers.submit(_save_image, frame, image_location, self.recording_format)
+        self._saving.append((future, self._img_count, controller_values, timestamp))
         self._img_count += 1
 
-        return image_location
+    def _write_row(self, future: Future, index: int, controller_values: List[int], timestamp: float) -> None:
+        try:
+            # Waits for the image, so that rows are written in sampling order
+            data = future.result()
+            if self.shards is not None:
+                self.shards.append(data, timestamp, controller_values)
+        except Exception as e:
+            # The sample is skipped so that the labels only reference images that exist
+            logging.error("Failed to save sample %s: %s", index, e)
+            registry.counter("recorder.errors").inc()
+            return
+
+        if self.shards is None:
+            self.labels.append(timestamp, keys_to_bitmask(controller_values), index)
+        registry.counter("recorder.samples").inc()
+
+
+def _save_image(frame: Frame, image_location: Optional[str], recording_format: str) -> ByteString:
+    start = time.monotonic()
+    data = _IMAGE_ENCODERS[recording_format](frame)
+    if image_location is not None:
+        with open(image_location, "wb") as f:
+            f.write(data)
+
+    now = time.monotonic()
+    registry.histogram("recorder.save_ms").observe((now - start) * 1000.0)
+    # How old the frame was by the time it was saved
+    registry.histogram("recorder.frame_age_ms").observe((now - frame.received_at) * 1000.0)
+
+    return data
+
+
+def _encode_jpeg(frame: Frame) -> ByteString:
+    # M.A.R.K. already sends JPEGs, so the bytes are saved as received
+    return frame.data
+
+
+def _encode_png(frame: Frame) -> ByteString:
+    output = io.BytesIO()
+    Image.open(io.BytesIO(frame.data)).save(output, format="PNG")
+    return output.getbuffer()
+
+
+def _encode_npy(frame: Frame) -> ByteString:
+    output = io.BytesIO()
+    np.save(output, np.asarray(Image.open(io.BytesIO(frame.data))))
+    return output.getbuffer()
+
+
+# Encodes a camera image in each recording format
+_IMAGE_ENCODERS: Dict[str, Callable[[Frame], ByteString]] = {
+    RECORDING_FORMAT.JPEG: _encode_jpeg,
+    RECORDING_FORMAT.PNG: _encode_png,
+    RECORDING_FORMAT.NPY: _encode_npy,
+}
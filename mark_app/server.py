@@ -1,24 +1,55 @@
+import abc
 import logging
 import queue
+import selectors
 import socket
 import threading
-from typing import ByteString, Optional
+import time
+from typing import ByteString, Callable, Dict, List, Optional
 
+from bitrate import BitrateConfig, BitrateController
+from capture import CaptureWriter
 from common import MESSAGE_TYPE
+from mailboxes import POLICY, Mailbox
+from protocol import ACK_PAYLOAD, DEFAULT_RECV_SIZE, FRAME_KIND, STREAM_MODE, Frame, FrameParser, encode_hint_command
+from stats import registry
+
+# Offset changes bigger than this are considered a jump of the clock of M.A.R.K. (e.g. a reboot), in milliseconds
+CLOCK_JUMP_MS = 10_000
 
 
 class Server(threading.Thread):
-    """A server that listens for messages from M.A.R.K.
+    """A server that listens for messages from one or more M.A.R.K. robots.
+
+    Each robot keeps its own connection, identified by the id sent in its `FRAME_KIND.HELLO` frame or, for robots
+    that don't send one, by its IP address. A robot reconnecting with the same id replaces its previous connection.
+    Status messages carry the id of the robot as data, while camera feed messages carry a `Frame` tagged with it.
 
     :param port: The port of the server
     :type port: int
     :param status_queue: The queue to put status messages from M.A.R.K.
     :type status_queue: queue.Queue
-    :param camera_queue: The queue to put camera feed messages from M.A.R.K.
+    :param camera_queue: The queue to put camera feed messages from M.A.R.K., a `Mailbox` keeps it bounded
     :type camera_queue: queue.Queue
+    :param recv_size: The maximum number of bytes to receive from M.A.R.K. at once, defaults to `DEFAULT_RECV_SIZE`
+    :type recv_size: int
+    :param bitrate_config: Enables adapting the quality and frame rate of framed camera feeds to the link, defaults
+        to None (disabled)
+    :type bitrate_config: Optional[BitrateConfig]
+    :param capture_dir: If given, the raw stream received from each robot is captured to a file in this directory,
+        defaults to None
+    :type capture_dir: Optional[str]
     """
 
-    def __init__(self, port: int, status_queue: queue.Queue, camera_queue: queue.Queue) -> None:
+    def __init__(
+        self,
+        port: int,
+        status_queue: queue.Queue,
+        camera_queue: queue.Queue,
+        recv_size: int = DEFAULT_RECV_SIZE,
+        bitrate_config: Optional[BitrateConfig] = None,
+        capture_dir: Optional[str] = None,
+    ) -> None:
         super().__init__()
 
         # Automatically discover the IP address of the host
@@ -27,82 +58,513 @@ class Server(threading.Thread):
         self._port = port
         self._status_queue = status_queue
         self._camera_queue = camera_queue
-        self._connection = None
+        self._recv_size = recv_size
+        self._bitrate_config = bitrate_config
+        self._capture_dir = capture_dir
+        # Connections of identified robots, by robot id, in the order in which they connected
+        self._connections: Dict[str, _Connection] = {}
+        # Connections that haven't sent their first frame yet
+        self._pending = set()
+        # Called with every camera image as soon as it is complete
+        self._subscribers: List[Callable[[Frame], None]] = []
+        self._lock = threading.Lock()
+        # Connection state, as published by the statistics
+        registry.gauge("server.robots", lambda: len(self._connections))
 
     def run(self) -> None:
         """Runs the server asynchronously"""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((self._host, self._port))
+        sock = self._listen()
 
-        sock.listen(1)
-        logging.info("Server listening on %s:%s", self._host, self._port)
+        if self._bitrate_config is not None:
+            # Accepting times out once in a while to check the links, as a stalled feed doesn't deliver frames
+            sock.settimeout(self._bitrate_config.window_s)
 
         while True:
-            sc, _ = sock.accept()
+            try:
+                sc, _ = sock.accept()
+            except socket.timeout:
+                self._check_links()
+                continue
             logging.info("M.A.R.K. connected from %s:%s", sc.getpeername(), sc.getsockname())
 
-            server_socket = _ServerSocket(sc, self._status_queue, self._camera_queue)
+            server_socket = _ServerSocket(
+                sc,
+                self._camera_queue,
+                self._recv_size,
+                self._bitrate_config,
+                self._on_identified,
+                self._on_disconnected,
+                self._on_frame,
+                self._open_capture(sc),
+            )
+            with self._lock:
+                self._pending.add(server_socket)
             server_socket.start()
-            self._connection = server_socket
 
-            logging.info("Ready to receive messages from M.A.R.K.")
-            self._status_queue.put((MESSAGE_TYPE.CONNECTED, None))
+    def robots(self) -> List[str]:
+        """Returns the ids of the connected robots
 
-    def send_to_mark(self, data: ByteString) -> None:
+        :return: The robot ids, in the order in which they connected
+        :rtype: List[str]
+        """
+        with self._lock:
+            return list(self._connections.keys())
+
+    def send_to_mark(self, data: ByteString, robot_id: Optional[str] = None) -> None:
         """Sends data to M.A.R.K.
 
         :param data: The data to send
         :type data: ByteString
+        :param robot_id: The robot to send the data to, defaults to all connected robots
+        :type robot_id: Optional[str]
+        """
+        for connection in self._select(robot_id):
+            connection.send_to_mark(data)
+
+    def send_command(self, command: ByteString, legacy_command: ByteString = b"") -> None:
+        """Sends a command to every robot, encoded the way each one understands it
+
+        Robots sending legacy streams run older versions of `remote.py`, which read commands one byte at a time and
+        would take every byte of a framed command as a command of its own, so they are sent `legacy_command` instead.
+
+        :param command: The framed command
+        :type command: ByteString
+        :param legacy_command: The same command for robots sending legacy streams, nothing is sent to them if empty
+        :type legacy_command: ByteString
         """
-        if self._connection is not None:
-            self._connection.send_to_mark(data)
+        for connection in self._select(None):
+            data = command if connection.is_framed else legacy_command
+            if data:
+                connection.send_to_mark(data)
 
-    def read_cam_image(self) -> bytearray:
+    def read_cam_image(self, robot_id: Optional[str] = None) -> Optional[bytearray]:
         """Reads the latest camera image received from M.A.R.K.
 
-        :return: An image as an array of bytes
-        :rtype: bytearray
+        :param robot_id: The robot to read the image from, defaults to the most recently connected robot
+        :type robot_id: Optional[str]
+        :return: An image as an array of bytes, or `None` if no image has been received
+        :rtype: Optional[bytearray]
         """
-        if self._connection is not None:
-            return self._connection.cam_image
+        frame = self.read_frame(robot_id)
+        return None if frame is None else frame.data
 
-    def close(self) -> None:
-        """Closes the connection to M.A.R.K."""
-        if self._connection is not None:
-            self._connection.close()
+    def read_frame(self, robot_id: Optional[str] = None) -> Optional[Frame]:
+        """Reads the latest frame received from M.A.R.K., along with its metadata
 
+        :param robot_id: The robot to read the frame from, defaults to the most recently connected robot
+        :type robot_id: Optional[str]
+        :return: The frame, or `None` if no frame has been received
+        :rtype: Optional[Frame]
+        """
+        with self._lock:
+            if robot_id is None and self._connections:
+                robot_id = list(self._connections.keys())[-1]
+            connection = self._connections.get(robot_id)
 
-class _ServerSocket(threading.Thread):
-    """A socket that supports the asynchronous communication with M.A.R.K.
+        if connection is not None:
+            return connection.latest_frame.peek()
 
-    :param sc: The socket connection to M.A.R.K.
-    :type sc: socket
+        return None
+
+    def subscribe(self, callback: Callable[[Frame], None]) -> None:
+        """Subscribes to camera images, which are passed to `callback` as soon as they are complete
+
+        The callback runs on the thread receiving the images, so it must be quick and must not block.
+
+        :param callback: Called with every camera image received from any robot
+        :type callback: Callable[[Frame], None]
+        """
+        with self._lock:
+            # Subscribers are copied on write, so frames can be dispatched without holding the lock
+            self._subscribers = self._subscribers + [callback]
+
+    def unsubscribe(self, callback: Callable[[Frame], None]) -> None:
+        """Unsubscribes from camera images
+
+        :param callback: The callback given to `subscribe`
+        :type callback: Callable[[Frame], None]
+        """
+        with self._lock:
+            self._subscribers = [subscriber for subscriber in self._subscribers if subscriber != callback]
+
+    def close(self, robot_id: Optional[str] = None) -> None:
+        """Closes the connection to M.A.R.K.
+
+        :param robot_id: The robot to disconnect, defaults to all robots
+        :type robot_id: Optional[str]
+        """
+        connections = self._select(robot_id)
+        if robot_id is None:
+            with self._lock:
+                connections += list(self._pending)
+
+        for connection in connections:
+            connection.close()
+
+    def _listen(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self._host, self._port))
+
+        sock.listen()
+        logging.info("Server listening on %s:%s", self._host, self._port)
+
+        return sock
+
+    def _open_capture(self, sc: socket.socket) -> Optional[CaptureWriter]:
+        if self._capture_dir is None:
+            return None
+
+        capture = CaptureWriter.for_connection(self._capture_dir, sc.getpeername()[0])
+        logging.info("Capturing the stream of M.A.R.K. to %s", capture.path)
+
+        return capture
+
+    def _select(self, robot_id: Optional[str]) -> List["_Connection"]:
+        with self._lock:
+            if robot_id is None:
+                return list(self._connections.values())
+            connection = self._connections.get(robot_id)
+
+        return [] if connection is None else [connection]
+
+    def _check_links(self) -> None:
+        # Links are evaluated for every frame, but also on a timer so that a stalled feed is noticed while it lasts
+        for connection in self._select(None):
+            connection.check_link()
+
+    def _on_identified(self, connection: "_Connection") -> None:
+        with self._lock:
+            self._pending.discard(connection)
+            previous = self._connections.pop(connection.robot_id, None)
+            self._connections[connection.robot_id] = connection
+
+        if previous is not None:
+            logging.info("M.A.R.K. %s reconnected, dropping its previous connection", connection.robot_id)
+            previous.close()
+
+        logging.info("Ready to receive messages from M.A.R.K. %s", connection.robot_id)
+        self._status_queue.put((MESSAGE_TYPE.CONNECTED, connection.robot_id))
+
+    def _on_frame(self, frame: Frame) -> None:
+        for subscriber in self._subscribers:
+            try:
+                subscriber(frame)
+            except Exception:
+                logging.exception("Subscriber failed to handle a frame from M.A.R.K. %s", frame.robot_id)
+
+    def _on_disconnected(self, connection: "_Connection") -> None:
+        with self._lock:
+            self._pending.discard(connection)
+            # The robot may have already reconnected, in which case its new connection must be kept
+            if self._connections.get(connection.robot_id) is not connection:
+                return
+            del self._connections[connection.robot_id]
+
+        self._status_queue.put((MESSAGE_TYPE.DISCONNECTED, connection.robot_id))
+
+
+class SelectorServer(Server):
+    """A server that handles all connections to M.A.R.K. from a single thread, using an event loop.
+
+    It has the same interface as `Server`, but instead of one thread per connection all sockets are multiplexed with
+    `selectors`, which scales better with many robots and leaves more room for the rest of the app to run. Sending
+    data and closing connections are thread safe: they are handed over to the event loop, which performs them.
+
+    :param port: The port of the server
+    :type port: int
     :param status_queue: The queue to put status messages from M.A.R.K.
     :type status_queue: queue.Queue
     :param camera_queue: The queue to put camera feed messages from M.A.R.K.
     :type camera_queue: queue.Queue
+    :param recv_size: The maximum number of bytes to receive from M.A.R.K. at once, defaults to `DEFAULT_RECV_SIZE`
+    :type recv_size: int
+    :param bitrate_config: Enables adapting the quality and frame rate of framed camera feeds to the link, defaults
+        to None (disabled)
+    :type bitrate_config: Optional[BitrateConfig]
+    :param capture_dir: If given, the raw stream received from each robot is captured to a file in this directory,
+        defaults to None
+    :type capture_dir: Optional[str]
     """
 
-    def __init__(self, sc: socket, status_queue: queue.Queue, camera_queue: queue.Queue) -> None:
-        super().__init__()
+    def __init__(
+        self,
+        port: int,
+        status_queue: queue.Queue,
+        camera_queue: queue.Queue,
+        recv_size: int = DEFAULT_RECV_SIZE,
+        bitrate_config: Optional[BitrateConfig] = None,
+        capture_dir: Optional[str] = None,
+    ) -> None:
+        super().__init__(port, status_queue, camera_queue, recv_size, bitrate_config, capture_dir)
+
+        self._selector = selectors.DefaultSelector()
+        # Calls to be run by the event loop on behalf of other threads, which wake it up through a socket pair
+        self._calls = queue.SimpleQueue()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        # Neither end ever blocks, so a full socket pair only drops redundant wake ups instead of stalling a thread
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+    def run(self) -> None:
+        """Runs the event loop asynchronously"""
+        sock = self._listen()
+        sock.setblocking(False)
+        self._selector.register(sock, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+
+        # Links are also checked on a timer, as a stalled feed doesn't deliver frames
+        check_interval_s = None if self._bitrate_config is None else self._bitrate_config.window_s
+        next_check = time.monotonic()
+
+        while True:
+            for key, events in self._selector.select(check_interval_s):
+                if key.fileobj is sock:
+                    self._accept(sock)
+                elif key.fileobj is self._wakeup_reader:
+                    self._run_calls()
+                else:
+                    key.data.handle_events(events)
+
+            # Other robots may keep the loop busy, so the time is checked rather than waiting for a timeout
+            if check_interval_s is not None and time.monotonic() >= next_check:
+                self._check_links()
+                next_check = time.monotonic() + check_interval_s
 
-        self.cam_image = None
+    def _accept(self, sock: socket.socket) -> None:
+        try:
+            sc, _ = sock.accept()
+        except BlockingIOError:
+            return
+        logging.info("M.A.R.K. connected from %s:%s", sc.getpeername(), sc.getsockname())
+
+        connection = _SelectorConnection(
+            sc,
+            self._camera_queue,
+            self._recv_size,
+            self._bitrate_config,
+            self._on_identified,
+            self._on_disconnected,
+            self._on_frame,
+            self._open_capture(sc),
+            self._selector,
+            self._call_soon,
+        )
+        with self._lock:
+            self._pending.add(connection)
+
+    def _call_soon(self, call: Callable[[], None]) -> None:
+        self._calls.put(call)
+        try:
+            self._wakeup_writer.send(b"\x00")
+        except BlockingIOError:
+            # The event loop already has pending wake ups
+            pass
+
+    def _run_calls(self) -> None:
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while True:
+            try:
+                call = self._calls.get_nowait()
+            except queue.Empty:
+                break
+            call()
+
+
+class _Connection(abc.ABC):
+    """A connection to M.A.R.K. that reassembles the camera feed and identifies the robot.
+
+    Subclasses drive the socket, receiving with `_receive` until it returns False, and implement sending and closing.
+
+    :param sc: The socket connection to M.A.R.K.
+    :type sc: socket
+    :param camera_queue: The queue to put camera feed messages from M.A.R.K.
+    :type camera_queue: queue.Queue
+    :param recv_size: The maximum number of bytes to receive from M.A.R.K. at once
+    :type recv_size: int
+    :param bitrate_config: The configuration of the adaptive bitrate, or None to disable it
+    :type bitrate_config: Optional[BitrateConfig]
+    :param on_identified: Called with this connection once the id of the robot is known, i.e. after its first frame
+    :type on_identified: Callable
+    :param on_disconnected: Called with this connection once the robot disconnects
+    :type on_disconnected: Callable
+    :param on_frame: Called with every camera image as soon as it is complete
+    :type on_frame: Callable
+    :param capture: If given, every chunk received is written to this capture, defaults to None
+    :type capture: Optional[CaptureWriter]
+    """
+
+    def __init__(
+        self,
+        sc: socket,
+        camera_queue: queue.Queue,
+        recv_size: int,
+        bitrate_config: Optional[BitrateConfig],
+        on_identified: Callable[["_Connection"], None],
+        on_disconnected: Callable[["_Connection"], None],
+        on_frame: Callable[[Frame], None],
+        capture: Optional[CaptureWriter] = None,
+    ) -> None:
+        self.robot_id = None
+        # Only the latest complete frame is kept around
+        self.latest_frame = Mailbox(POLICY.KEEP_LATEST)
         self._sc = sc
-        self._status_queue = status_queue
+        self._peer_host = sc.getpeername()[0]
         self._camera_queue = camera_queue
+        # The parser owns the receive buffers, so bytes are received in place instead of being allocated per chunk
+        self._parser = FrameParser(recv_size)
+        self._bitrate = None if bitrate_config is None else BitrateController(bitrate_config)
+        self._hint_seq = 0
+        # The link is measured on the receiving thread and also checked on a timer from the server
+        self._bitrate_lock = threading.Lock()
+        # Reassembly errors already counted, and smallest offset between the clocks of M.A.R.K. and ours
+        self._errors = 0
+        self._min_offset = None
+        self._on_identified = on_identified
+        self._on_disconnected = on_disconnected
+        self._on_frame = on_frame
+        self._capture = capture
+
+    @property
+    def is_framed(self) -> bool:
+        """Whether the robot sends a framed stream, and thus understands framed commands"""
+        return self._parser.mode == STREAM_MODE.FRAMED
+
+    @abc.abstractmethod
+    def send_to_mark(self, data: ByteString) -> None:
+        """Sends data to M.A.R.K., from any thread
 
-    def run(self) -> None:
-        is_image_start = False
-        image = None
+        :param data: The data to send
+        :type data: ByteString
+        """
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        """Closes the connection, from any thread"""
+
+    def _receive(self) -> bool:
+        # Receives the next chunk of the camera feed, returning whether the connection is still open
+        buffer = self._parser.writable()
+        nbytes = self._sc.recv_into(buffer)
+        if not nbytes:
+            return False
+
+        if self._capture is not None:
+            self._capture.write(buffer[:nbytes])
+
+        logging.debug("Received %s bytes from M.A.R.K.", nbytes)
+        self._handle_camera_feed(self._parser.commit(nbytes))
+
+        return True
+
+    def _handle_camera_feed(self, frames: List[Frame]) -> None:
+        # The parser takes care of detecting whether M.A.R.K. sends framed or legacy (raw JPEG) streams
+        for frame in frames:
+            if self.robot_id is None:
+                self._identify(frame)
+
+            if frame.kind == FRAME_KIND.ACK:
+                self._handle_ack(frame)
+            if frame.kind != FRAME_KIND.JPEG:
+                continue
+
+            frame = frame._replace(robot_id=self.robot_id)
+            self._measure(frame)
+            # Send the image to the message queue
+            self._camera_queue.put((MESSAGE_TYPE.CAMERA_FEED_RECEIVED, frame))
+            self.latest_frame.put(frame)
+            self._on_frame(frame)
+
+            # Robots sending legacy streams don't understand hints either
+            if self._bitrate is not None and self.is_framed:
+                self._adapt_bitrate(frame)
+
+    def _measure(self, frame: Frame) -> None:
+        registry.counter("camera.frames").inc()
+        registry.counter("camera.bytes").inc(len(frame.data))
+        registry.histogram("camera.reassembly_ms").observe((frame.received_at - frame.started_at) * 1000.0)
+        if self._parser.errors > self._errors:
+            registry.counter("camera.reassembly_errors").inc(self._parser.errors - self._errors)
+            self._errors = self._parser.errors
+
+        if frame.timestamp_ms is None:
+            return
+
+        # The clocks of M.A.R.K. and the server are not synchronized, so the transport latency is measured as the
+        # delay in excess of the smallest one seen so far, which is assumed to be the offset between both clocks
+        offset = (int(frame.received_at * 1000) - frame.timestamp_ms) & 0xFFFFFFFF
+        if self._min_offset is None or offset < self._min_offset or offset - self._min_offset > CLOCK_JUMP_MS:
+            self._min_offset = offset
+        registry.histogram("camera.transport_ms").observe(offset - self._min_offset)
+
+    def _handle_ack(self, frame: Frame) -> None:
+        # M.A.R.K. echoes the timestamp of the command it applied, which was taken with our own clock
+        _, timestamp_ms = ACK_PAYLOAD.unpack(frame.data)
+        registry.histogram("commands.rtt_ms").observe((int(time.monotonic() * 1000) - timestamp_ms) & 0xFFFFFFFF)
+
+    def check_link(self) -> None:
+        """Evaluates the link, hinting M.A.R.K. to change its quality or frame interval if needed
+
+        Called for every frame and on a timer by the server, from different threads.
+        """
+        # Either adapting is disabled, or the robot sends a legacy stream and doesn't understand hints
+        if self._bitrate is None or not self.is_framed:
+            return
+
+        with self._bitrate_lock:
+            hint = self._bitrate.update()
+            if hint is None:
+                return
+            seq = self._hint_seq
+            self._hint_seq += 1
+
+        quality, frame_interval_ms = hint
+        logging.info("Hinting M.A.R.K. %s to use quality %s every %s ms", self.robot_id, quality, frame_interval_ms)
+        self.send_to_mark(encode_hint_command(seq, int(time.monotonic() * 1000), quality, frame_interval_ms))
+
+    def _adapt_bitrate(self, frame: Frame) -> None:
+        with self._bitrate_lock:
+            self._bitrate.on_frame(frame.seq, len(frame.data), self._parser.errors)
+        self.check_link()
+
+    def _identify(self, frame: Frame) -> None:
+        # Robots introduce themselves with a hello frame, otherwise we fall back to their IP address
+        if frame.kind == FRAME_KIND.HELLO:
+            self.robot_id = bytes(frame.data).decode("utf-8", errors="replace")
+        else:
+            self.robot_id = self._peer_host
+        self._on_identified(self)
+
+    def _mark_disconnected(self) -> None:
+        logging.info("M.A.R.K. %s disconnected.", self.robot_id or self._peer_host)
+        self._sc.close()
+        if self._capture is not None:
+            self._capture.close()
+        self._on_disconnected(self)
 
+
+class _ServerSocket(_Connection, threading.Thread):
+    """A socket that supports the asynchronous communication with M.A.R.K. from its own thread.
+
+    See `_Connection` for the parameters.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        _Connection.__init__(self, *args, **kwargs)
+        threading.Thread.__init__(self)
+
+        # Commands and hints are sent from different threads, so they must not interleave
+        self._send_lock = threading.Lock()
+
+    def run(self) -> None:
         while True:
             try:
-                bytes = self._sc.recv(2048)
-                if bytes:
-                    logging.debug("Received %s bytes from M.A.R.K.", len(bytes))
-                    image, is_image_start = self._handle_camera_feed(bytes, image, is_image_start)
-                else:
+                if not self._receive():
                     self._mark_disconnected()
                     break
             except:
@@ -111,54 +573,108 @@ class _ServerSocket(threading.Thread):
 
     def send_to_mark(self, data: ByteString) -> None:
         try:
-            self._sc.send(data)
+            with self._send_lock:
+                self._sc.sendall(data)
             logging.debug("Sent %s bytes to M.A.R.K.", len(data))
         except:
             pass
 
     def close(self) -> None:
+        try:
+            # Shutting down the socket wakes up the thread blocked receiving from it
+            self._sc.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._sc.close()
 
-    def _handle_camera_feed(self, bytes: bytearray, image: bytearray, is_image_start: bool) -> None:
-        # Handling of camera feed modified from:
-        # https://github.com/codeandrobots/codeandrobots-app/blob/master/App/Services/Socket/index.js#L185
-
-        # Look for the starting bytes of a JPEG
-        start_index = _find_bytes(bytes, b"\xFF\xD8")
-
-        if start_index is not None:
-            is_image_start = True
-            image = bytes[start_index:]
-            return image, is_image_start
-
-        # Are we still reading an image?
-        if is_image_start:
-            # Look for the ending bytes of a JPEG to determine if we are done reading the image
-            end_index = _find_bytes(bytes, b"\xFF\xD9")
-
-            if end_index is not None:
-                is_image_start = False
-                # Finalize reconstructing the image bytes
-                # We add a 2 to actually include the ending bytes
-                image += bytes[: end_index + 2]
-                # Send the image to the message queue
-                self._camera_queue.put((MESSAGE_TYPE.CAMERA_FEED_RECEIVED, image))
-                # Only save the latest complete image
-                self.cam_image = image
-            else:
-                # Continue reconstructing the image bytes
-                image += bytes
-
-        return image, is_image_start
 
-    def _mark_disconnected(self) -> None:
-        logging.info("M.A.R.K. disconnected.")
-        self._sc.close()
-        self._status_queue.put((MESSAGE_TYPE.DISCONNECTED, None))
+class _SelectorConnection(_Connection):
+    """A non-blocking connection to M.A.R.K. driven by the event loop of a `SelectorServer`.
 
+    See `_Connection` for the rest of the parameters.
 
-def _find_bytes(bytes: bytearray, to_find: ByteString) -> Optional[int]:
-    try:
-        return bytes.index(to_find)
-    except ValueError:
-        return None
+    :param selector: The selector of the event loop
+    :type selector: selectors.BaseSelector
+    :param call_soon: Schedules a call to be run by the event loop
+    :type call_soon: Callable
+    """
+
+    def __init__(
+        self,
+        sc: socket,
+        camera_queue: queue.Queue,
+        recv_size: int,
+        bitrate_config: Optional[BitrateConfig],
+        on_identified: Callable[[_Connection], None],
+        on_disconnected: Callable[[_Connection], None],
+        on_frame: Callable[[Frame], None],
+        capture: Optional[CaptureWriter],
+        selector: selectors.BaseSelector,
+        call_soon: Callable[[Callable[[], None]], None],
+    ) -> None:
+        super().__init__(sc, camera_queue, recv_size, bitrate_config, on_identified, on_disconnected, on_frame, capture)
+
+        self._selector = selector
+        self._call_soon = call_soon
+        # Data that couldn't be sent yet because the socket buffer was full
+        self._outgoing = bytearray()
+        self._is_writing = False
+        self._closed = False
+
+        self._sc.setblocking(False)
+        self._selector.register(self._sc, selectors.EVENT_READ, data=self)
+
+    def send_to_mark(self, data: ByteString) -> None:
+        # Copy the data since it is sent later on, from the event loop
+        self._call_soon(lambda: self._send(bytes(data)))
+
+    def close(self) -> None:
+        self._call_soon(self._disconnect)
+
+    def handle_events(self, events: int) -> None:
+        """Handles the events reported by the selector for this connection
+
+        :param events: A bitmask of `selectors.EVENT_READ` and `selectors.EVENT_WRITE`
+        :type events: int
+        """
+        try:
+            if events & selectors.EVENT_WRITE:
+                self._flush()
+            if events & selectors.EVENT_READ and not self._receive():
+                self._disconnect()
+        except BlockingIOError:
+            pass
+        except:
+            self._disconnect()
+
+    def _send(self, data: bytes) -> None:
+        if self._closed:
+            return
+        self._outgoing += data
+        try:
+            self._flush()
+            logging.debug("Sent %s bytes to M.A.R.K.", len(data))
+        except:
+            self._disconnect()
+
+    def _flush(self) -> None:
+        try:
+            while self._outgoing:
+                sent = self._sc.send(self._outgoing)
+                del self._outgoing[:sent]
+        except BlockingIOError:
+            pass
+
+        # Only wait for the socket to be writable while there is data left to send
+        is_writing = bool(self._outgoing)
+        if is_writing != self._is_writing:
+            self._is_writing = is_writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if is_writing else 0)
+            self._selector.modify(self._sc, events, data=self)
+
+    def _disconnect(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._selector.unregister(self._sc)
+        self._mark_disconnected()
@@ -0,0 +1,292 @@
+"""Defines an append-only container that stores the samples of a recording session in a few large shards."""
+import argparse
+import json
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import BinaryIO, ByteString, Dict, List, NamedTuple, Tuple, Union
+
+SHARDS_VERSION = 1
+METADATA_FILE = "metadata.json"
+# Shards are made of a file with the concatenated images and another one with a fixed-width record per image
+DATA_SUFFIX = ".bin"
+INDEX_SUFFIX = ".idx"
+# Each record holds the offset and length of the image, its CRC32, the sampling time and then one byte per key
+RECORD_HEADER = ">QIId"
+DEFAULT_MAX_SHARD_BYTES = 256 * 1024 * 1024
+
+
+class Sample(NamedTuple):
+    """A sample read from a session"""
+
+    # The encoded image
+    data: bytes
+    # Seconds since the session started
+    timestamp: float
+    # The value of each key of the controller
+    controller: Dict[str, int]
+
+
+class ShardWriter:
+    """Appends samples to the shards of a session, rolling over to a new shard once the current one is full.
+
+    Every image is written before its record, and both are flushed right away, so readers only ever see complete
+    samples, even while the session is being recorded or if the app crashes in the middle of it.
+
+    :param session_dir: The directory of the session, which must be empty or not exist
+    :type session_dir: Union[str, Path]
+    :param keys: The keys of the controller
+    :type keys: List[str]
+    :param recording_format: The format of the images, e.g. `jpeg`
+    :type recording_format: str
+    :param max_shard_bytes: The size after which a new shard is started, defaults to `DEFAULT_MAX_SHARD_BYTES`
+    :type max_shard_bytes: int
+    """
+
+    def __init__(
+        self,
+        session_dir: Union[str, Path],
+        keys: List[str],
+        recording_format: str,
+        max_shard_bytes: int = DEFAULT_MAX_SHARD_BYTES,
+    ) -> None:
+        self._session_dir = Path(session_dir)
+        self._session_dir.mkdir(parents=True, exist_ok=True)
+        self._keys = keys
+        self._record = _record_struct(len(keys))
+        self._max_shard_bytes = max_shard_bytes
+        self._shard = -1
+        self._data_file = None
+        self._index_file = None
+        self._offset = 0
+        self._lock = threading.Lock()
+        self.count = 0
+
+        metadata = {
+            "version": SHARDS_VERSION,
+            "keys": keys,
+            "format": recording_format,
+            "max_shard_bytes": max_shard_bytes,
+        }
+        with open(self._session_dir.joinpath(METADATA_FILE), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+        self._roll_over()
+
+    def append(self, data: ByteString, timestamp: float, controller: List[int]) -> int:
+        """Appends a sample
+
+        :param data: The encoded image
+        :type data: ByteString
+        :param timestamp: Seconds since the session started
+        :type timestamp: float
+        :param controller: The value of each key of the controller, in the order of the keys of the session
+        :type controller: List[int]
+        :return: The index of the sample in the session
+        :rtype: int
+        """
+        with self._lock:
+            if self._offset and self._offset + len(data) > self._max_shard_bytes:
+                self._roll_over()
+
+            self._data_file.write(data)
+            self._data_file.flush()
+            self._index_file.write(self._record.pack(self._offset, len(data), zlib.crc32(data), timestamp, *controller))
+            self._index_file.flush()
+
+            self._offset += len(data)
+            self.count += 1
+            return self.count - 1
+
+    def close(self) -> None:
+        """Closes the current shard, making sure it is on disk"""
+        with self._lock:
+            self._close_shard()
+
+    def _roll_over(self) -> None:
+        self._close_shard()
+        self._shard += 1
+        self._data_file = open(_shard_path(self._session_dir, self._shard, DATA_SUFFIX), "xb")
+        self._index_file = open(_shard_path(self._session_dir, self._shard, INDEX_SUFFIX), "xb")
+        self._offset = 0
+
+    def _close_shard(self) -> None:
+        for f in (self._data_file, self._index_file):
+            if f is not None and not f.closed:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+
+class ShardReader:
+    """Reads the samples of a session by index, including sessions that are still being recorded.
+
+    :param session_dir: The directory of the session
+    :type session_dir: Union[str, Path]
+    """
+
+    def __init__(self, session_dir: Union[str, Path]) -> None:
+        self._session_dir = Path(session_dir)
+        with open(self._session_dir.joinpath(METADATA_FILE)) as f:
+            metadata = json.load(f)
+        if metadata["version"] != SHARDS_VERSION:
+            raise ValueError(f"Unsupported version of shards: {metadata['version']}")
+
+        self.keys: List[str] = metadata["keys"]
+        self.recording_format: str = metadata["format"]
+        self._record = _record_struct(len(self.keys))
+        # Number of valid samples in each shard, and the open files of each shard
+        self._counts: List[int] = []
+        self._files: List[Tuple[BinaryIO, BinaryIO]] = []
+        # Files are shared by every caller, so seeking and reading must not interleave
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Picks up the samples appended since the session was opened or last refreshed
+
+        :return: The number of samples in the session
+        :rtype: int
+        """
+        shard = max(len(self._counts) - 1, 0)
+        while _shard_path(self._session_dir, shard, INDEX_SUFFIX).exists():
+            if shard == len(self._counts):
+                self._counts.append(0)
+                self._files.append(
+                    (
+                        open(_shard_path(self._session_dir, shard, DATA_SUFFIX), "rb"),
+                        open(_shard_path(self._session_dir, shard, INDEX_SUFFIX), "rb"),
+                    )
+                )
+            self._counts[shard] = self._valid_records(shard)
+            shard += 1
+
+        return len(self)
+
+    def __len__(self) -> int:
+        return sum(self._counts)
+
+    @property
+    def record_size(self) -> int:
+        """The size in bytes of a record in the index of a shard"""
+        return self._record.size
+
+    @property
+    def shard_counts(self) -> List[int]:
+        """The number of valid samples in each shard"""
+        return list(self._counts)
+
+    def data_size(self, shard: int) -> int:
+        """Returns the size of the data of a shard up to the end of its last valid sample
+
+        :param shard: The index of the shard
+        :type shard: int
+        :return: The size in bytes
+        :rtype: int
+        """
+        if not self._counts[shard]:
+            return 0
+        offset, length, *_ = self._read_record(shard, self._counts[shard] - 1)
+        return offset + length
+
+    def __getitem__(self, index: int) -> Sample:
+        shard, index = self._locate(index)
+        offset, length, _, timestamp, *controller = self._read_record(shard, index)
+        data = self._read(self._files[shard][0], offset, length)
+
+        return Sample(data, timestamp, dict(zip(self.keys, controller)))
+
+    def controller(self, index: int) -> Dict[str, int]:
+        """Reads the controller values of a sample, without reading its image
+
+        :param index: The index of the sample
+        :type index: int
+        :return: The value of each key of the controller
+        :rtype: Dict[str, int]
+        """
+        shard, index = self._locate(index)
+        _, _, _, _, *controller = self._read_record(shard, index)
+
+        return dict(zip(self.keys, controller))
+
+    def close(self) -> None:
+        """Closes the files of the session"""
+        for data_file, index_file in self._files:
+            data_file.close()
+            index_file.close()
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        # Returns the shard of a sample and its index within the shard
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Sample {index} out of range")
+
+        shard = 0
+        while index >= self._counts[shard]:
+            index -= self._counts[shard]
+            shard += 1
+
+        return shard, index
+
+    def _read(self, f: BinaryIO, offset: int, length: int) -> bytes:
+        with self._lock:
+            f.seek(offset)
+            return f.read(length)
+
+    def _read_record(self, shard: int, index: int) -> tuple:
+        return self._record.unpack(self._read(self._files[shard][1], index * self._record.size, self._record.size))
+
+    def _valid_records(self, shard: int) -> int:
+        # Records are only complete if the whole record and its image made it to disk, which may not be the case at
+        # the end of a shard being written or cut short by a crash
+        count = os.fstat(self._files[shard][1].fileno()).st_size // self._record.size
+        data_size = os.fstat(self._files[shard][0].fileno()).st_size
+
+        while count > self._counts[shard]:
+            offset, length, crc, *_ = self._read_record(shard, count - 1)
+            if offset + length <= data_size and zlib.crc32(self._read(self._files[shard][0], offset, length)) == crc:
+                break
+            count -= 1
+
+        return count
+
+
+def recover_session(session_dir: Union[str, Path]) -> int:
+    """Truncates the shards of a session that was cut short by a crash to their last complete sample
+
+    :param session_dir: The directory of the session
+    :type session_dir: Union[str, Path]
+    :return: The number of samples in the session
+    :rtype: int
+    """
+    reader = ShardReader(session_dir)
+
+    for shard, count in enumerate(reader.shard_counts):
+        os.truncate(_shard_path(Path(session_dir), shard, INDEX_SUFFIX), count * reader.record_size)
+        os.truncate(_shard_path(Path(session_dir), shard, DATA_SUFFIX), reader.data_size(shard))
+
+    reader.close()
+    return len(reader)
+
+
+def _record_struct(num_keys: int) -> struct.Struct:
+    return struct.Struct(RECORD_HEADER + "B" * num_keys)
+
+
+def _shard_path(session_dir: Path, shard: int, suffix: str) -> Path:
+    return session_dir.joinpath(f"shard-{shard:05d}{suffix}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks, and optionally recovers, a sharded recording session")
+    parser.add_argument("session", help="The directory of the session")
+    parser.add_argument("--recover", action="store_true", help="Truncate shards to their last complete sample")
+    args = parser.parse_args()
+
+    if args.recover:
+        print(f"Recovered {recover_session(args.session)} samples")
+    else:
+        print(f"{len(ShardReader(args.session))} samples")
@@ -0,0 +1,215 @@
+"""Defines lightweight, thread-safe statistics to measure the app at runtime."""
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional, Union
+
+
+class Histogram:
+    """A rolling histogram over the latest observed values.
+
+    Observing a value is constant time, percentiles are only computed when read.
+
+    :param window: The number of latest values to keep, defaults to 1024
+    :type window: int
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.count = 0
+        self._values = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        """Observes a value
+
+        :param value: The value
+        :type value: float
+        """
+        self.count += 1
+        self._values.append(value)
+
+    def percentiles(self) -> Dict[str, float]:
+        """Computes the percentiles of the latest values
+
+        :return: The p50, p95 and p99 of the latest values, all of them NaN if there are none
+        :rtype: Dict[str, float]
+        """
+        values = sorted(list(self._values))
+        if not values:
+            return {"p50": math.nan, "p95": math.nan, "p99": math.nan}
+
+        return {f"p{p}": values[min(int(len(values) * p / 100.0), len(values) - 1)] for p in (50, 95, 99)}
+
+    def snapshot(self) -> Dict[str, float]:
+        """Returns the current state of the histogram
+
+        :return: The number of observed values and the percentiles of the latest ones
+        :rtype: Dict[str, float]
+        """
+        return {"count": self.count, **self.percentiles()}
+
+
+class Counter:
+    """A monotonic counter that also tracks its rate over the latest seconds.
+
+    :param window_s: The number of seconds over which the rate is computed, defaults to 5
+    :type window_s: int
+    """
+
+    def __init__(self, window_s: int = 5) -> None:
+        self.total = 0
+        self._window_s = window_s
+        # Increments per whole second, for the latest `window_s` seconds
+        self._buckets = deque()
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        """Increments the counter
+
+        :param amount: The amount to increment by, defaults to 1
+        :type amount: int
+        """
+        second = int(time.monotonic())
+
+        with self._lock:
+            self.total += amount
+            if self._buckets and self._buckets[-1][0] == second:
+                self._buckets[-1][1] += amount
+            else:
+                self._buckets.append([second, amount])
+            self._expire(second)
+
+    def rate(self) -> float:
+        """Computes the rate of the counter
+
+        :return: The average increments per second over the latest seconds
+        :rtype: float
+        """
+        with self._lock:
+            self._expire(int(time.monotonic()))
+            return sum(amount for _, amount in self._buckets) / float(self._window_s)
+
+    def snapshot(self) -> Dict[str, float]:
+        """Returns the current state of the counter
+
+        :return: The total and the rate of the counter
+        :rtype: Dict[str, float]
+        """
+        return {"total": self.total, "rate": self.rate()}
+
+    def _expire(self, second: int) -> None:
+        while self._buckets and self._buckets[0][0] <= second - self._window_s:
+            self._buckets.popleft()
+
+
+class Gauge:
+    """A value that can go up and down, e.g. the size of a queue.
+
+    :param read: Reads the value of the gauge whenever it is needed instead of it being set, defaults to None
+    :type read: Optional[Callable[[], float]]
+    """
+
+    def __init__(self, read: Optional[Callable[[], float]] = None) -> None:
+        self._value = 0.0
+        self._read = read
+
+    @property
+    def value(self) -> float:
+        """The value of the gauge"""
+        return self._value if self._read is None else self._read()
+
+    def set(self, value: float) -> None:
+        """Sets the value of the gauge
+
+        :param value: The value
+        :type value: float
+        """
+        self._value = value
+
+    def snapshot(self) -> Dict[str, float]:
+        """Returns the current state of the gauge
+
+        :return: The value of the gauge
+        :rtype: Dict[str, float]
+        """
+        return {"value": self.value}
+
+
+class StatsRegistry:
+    """A registry of named statistics, created on first use."""
+
+    def __init__(self) -> None:
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        """Returns the histogram with the given name
+
+        :param name: The name of the histogram, e.g. `camera.decode_ms`
+        :type name: str
+        :return: The histogram
+        :rtype: Histogram
+        """
+        return self._get(name, Histogram)
+
+    def counter(self, name: str) -> Counter:
+        """Returns the counter with the given name
+
+        :param name: The name of the counter, e.g. `camera.frames`
+        :type name: str
+        :return: The counter
+        :rtype: Counter
+        """
+        return self._get(name, Counter)
+
+    def gauge(self, name: str, read: Optional[Callable[[], float]] = None) -> Gauge:
+        """Returns the gauge with the given name
+
+        :param name: The name of the gauge, e.g. `queue.camera`
+        :type name: str
+        :param read: If given, replaces the gauge with one that reads its value from this function, defaults to None
+        :type read: Optional[Callable[[], float]]
+        :return: The gauge
+        :rtype: Gauge
+        """
+        if read is not None:
+            with self._lock:
+                self._stats[name] = Gauge(read)
+
+        return self._get(name, Gauge)
+
+    def get(self, name: str) -> Optional[Union[Histogram, Counter, Gauge]]:
+        """Returns the statistic with the given name, if it exists
+
+        :param name: The name of the statistic
+        :type name: str
+        :return: The statistic, or `None` if nothing was recorded under that name yet
+        :rtype: Optional[Union[Histogram, Counter, Gauge]]
+        """
+        return self._stats.get(name)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Returns the current state of all statistics
+
+        :return: The snapshot of each statistic, by name
+        :rtype: Dict[str, Dict[str, float]]
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        return {name: stat.snapshot() for name, stat in sorted(stats.items())}
+
+    def _get(self, name: str, stat_type: type) -> Union[Histogram, Counter, Gauge]:
+        stat = self._stats.get(name)
+        if stat is None:
+            with self._lock:
+                stat = self._stats.setdefault(name, stat_type())
+
+        if not isinstance(stat, stat_type):
+            raise ValueError(f"Statistic {name} is a {type(stat).__name__}, not a {stat_type.__name__}")
+
+        return stat
+
+
+# Statistics of the whole app
+registry = StatsRegistry()
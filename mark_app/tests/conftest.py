@@ -0,0 +1,11 @@
+import socket
+
+import pytest
+
+
+@pytest.fixture
+def port() -> int:
+    # A free port for a server to listen on, on the address the server listens on
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((socket.gethostbyname(socket.gethostname()), 0))
+        return sock.getsockname()[1]
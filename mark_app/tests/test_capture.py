@@ -0,0 +1,81 @@
+import queue
+import socket
+import time
+from pathlib import Path
+
+import pytest
+
+from benchmark import SERVER_BACKENDS, run_replay_test
+from capture import CAPTURE_SUFFIX, CaptureWriter, read_capture
+from protocol import encode_frame_header, encode_hello
+from server import Server
+
+PAYLOADS = [b"\xFF\xD8" + bytes([i]) * (100 * i) + b"\xFF\xD9" for i in range(1, 21)]
+STREAM = encode_hello("robot-a") + b"".join(
+    encode_frame_header(seq, seq, len(payload)) + payload for seq, payload in enumerate(PAYLOADS)
+)
+
+
+def _write_capture(path: Path, chunk_size: int) -> int:
+    # Chunks of an odd size, so that headers and payloads are split across them as they are in the field
+    writer = CaptureWriter(path)
+    chunks = [STREAM[i : i + chunk_size] for i in range(0, len(STREAM), chunk_size)]
+    for i, chunk in enumerate(chunks):
+        writer.write(chunk, now=i * 0.001)
+    writer.close()
+    return len(chunks)
+
+
+def test_reads_chunks_as_written(tmp_path: Path) -> None:
+    path = tmp_path.joinpath(f"robot{CAPTURE_SUFFIX}")
+    num_chunks = _write_capture(path, 37)
+
+    chunks = list(read_capture(path))
+
+    assert len(chunks) == num_chunks
+    assert b"".join(data for _, data in chunks) == STREAM
+    assert [offset for offset, _ in chunks[:3]] == pytest.approx([0.0, 0.001, 0.002])
+
+
+def test_reads_truncated_capture_up_to_its_last_complete_chunk(tmp_path: Path) -> None:
+    path = tmp_path.joinpath(f"robot{CAPTURE_SUFFIX}")
+    num_chunks = _write_capture(path, 100)
+    # Cut in the middle of the last chunk, as if the app crashed while writing it
+    data = path.read_bytes()
+    path.write_bytes(data[:-10])
+
+    chunks = list(read_capture(path))
+
+    assert len(chunks) == num_chunks - 1
+    assert b"".join(data for _, data in chunks) == STREAM[: len(chunks) * 100]
+
+
+@pytest.mark.parametrize("server_class", SERVER_BACKENDS.values(), ids=SERVER_BACKENDS.keys())
+def test_replay_reassembles_every_frame(tmp_path: Path, port: int, server_class: type) -> None:
+    path = tmp_path.joinpath(f"robot{CAPTURE_SUFFIX}")
+    num_chunks = _write_capture(path, 37)
+
+    result = run_replay_test(str(path), port, server_class)
+
+    assert result["chunks"] == num_chunks
+    assert result["frames"] == len(PAYLOADS)
+    assert result["errors"] == 0
+
+
+def test_server_captures_the_stream_it_receives(tmp_path: Path, port: int) -> None:
+    camera_queue = queue.Queue()
+    server = Server(port=port, status_queue=queue.Queue(), camera_queue=camera_queue, capture_dir=str(tmp_path))
+    server.daemon = True
+    server.start()
+    # Give the server some time to start listening
+    time.sleep(0.2)
+
+    sock = socket.create_connection((socket.gethostbyname(socket.gethostname()), port))
+    sock.sendall(STREAM)
+    frames = [camera_queue.get(timeout=5)[1] for _ in PAYLOADS]
+    server.close()
+    sock.close()
+
+    assert [bytes(frame.data) for frame in frames] == PAYLOADS
+    (path,) = tmp_path.glob(f"*{CAPTURE_SUFFIX}")
+    assert b"".join(data for _, data in read_capture(path)) == STREAM
@@ -0,0 +1,74 @@
+import csv
+from pathlib import Path
+
+import numpy as np
+
+from labels import LABELS_FILE, LabelLog, export_csv, keys_to_bitmask, read_labels
+
+KEYS = ["KEY_W", "KEY_A", "KEY_S"]
+
+
+def _write_log(path: Path, count: int, block_size: int = 4) -> None:
+    log = LabelLog(path, KEYS, "jpeg", block_size=block_size)
+    for i in range(count):
+        log.append(i * 0.1, i % 8, i)
+    log.close()
+
+
+def test_keys_to_bitmask() -> None:
+    assert keys_to_bitmask([0, 0, 0]) == 0
+    assert keys_to_bitmask([1, 0, 1]) == 0b101
+    assert keys_to_bitmask([0, 255, 0]) == 0b010
+
+
+def test_reads_rows_back(tmp_path: Path) -> None:
+    # 10 rows in blocks of 4, so the last block is only partially filled when the log is closed
+    _write_log(tmp_path.joinpath(LABELS_FILE), 10)
+
+    labels = read_labels(tmp_path.joinpath(LABELS_FILE))
+    assert labels.keys == KEYS
+    assert labels.recording_format == "jpeg"
+    np.testing.assert_allclose(labels.timestamp, np.arange(10) * 0.1)
+    np.testing.assert_array_equal(labels.keys_pressed, np.arange(10) % 8)
+    np.testing.assert_array_equal(labels.frame, np.arange(10))
+
+
+def test_reads_empty_log(tmp_path: Path) -> None:
+    _write_log(tmp_path.joinpath(LABELS_FILE), 0)
+
+    labels = read_labels(tmp_path.joinpath(LABELS_FILE))
+    assert labels.keys == KEYS
+    assert len(labels.timestamp) == len(labels.keys_pressed) == len(labels.frame) == 0
+
+
+def test_truncated_log_is_read_up_to_last_complete_block(tmp_path: Path) -> None:
+    path = tmp_path.joinpath(LABELS_FILE)
+    _write_log(path, 12)
+    # Cut the last block of 4 rows in the middle of its columns, as a crash while writing it would
+    data = path.read_bytes()
+    path.write_bytes(data[:-20])
+
+    labels = read_labels(path)
+    np.testing.assert_array_equal(labels.frame, np.arange(8))
+    np.testing.assert_allclose(labels.timestamp, np.arange(8) * 0.1)
+
+
+def test_log_truncated_in_block_header_is_read(tmp_path: Path) -> None:
+    path = tmp_path.joinpath(LABELS_FILE)
+    _write_log(path, 8)
+    path.write_bytes(path.read_bytes() + b"MKL")
+
+    labels = read_labels(path)
+    np.testing.assert_array_equal(labels.frame, np.arange(8))
+
+
+def test_exports_csv(tmp_path: Path) -> None:
+    _write_log(tmp_path.joinpath(LABELS_FILE), 5)
+
+    assert export_csv(tmp_path) == 5
+    with open(tmp_path.joinpath("data.csv"), newline="") as f:
+        rows = list(csv.reader(f))
+
+    assert rows[0] == ["Image"] + KEYS
+    assert rows[1] == [str(tmp_path.absolute().joinpath("0.jpeg")), "0", "0", "0"]
+    assert rows[4] == [str(tmp_path.absolute().joinpath("3.jpeg")), "1", "1", "0"]
@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from mailboxes import POLICY, Mailbox
+
+
+def _drain(mailbox: Mailbox) -> list:
+    messages = []
+    while not mailbox.empty():
+        messages.append(mailbox.get_nowait())
+    return messages
+
+
+def test_keep_latest_drops_the_oldest_messages() -> None:
+    mailbox = Mailbox(POLICY.KEEP_LATEST, maxsize=2)
+    for message in range(5):
+        mailbox.put(message)
+
+    assert mailbox.qsize() == 2
+    assert mailbox.peek() == 4
+    assert _drain(mailbox) == [3, 4]
+    assert (mailbox.received, mailbox.dropped) == (5, 3)
+
+
+def test_fifo_drops_the_new_messages() -> None:
+    mailbox = Mailbox(POLICY.FIFO, maxsize=2)
+    for message in range(5):
+        mailbox.put(message)
+
+    assert _drain(mailbox) == [0, 1]
+    assert (mailbox.received, mailbox.dropped) == (5, 3)
+
+
+def test_block_waits_for_room() -> None:
+    mailbox = Mailbox(POLICY.BLOCK, maxsize=1)
+    mailbox.put(0)
+    put = threading.Thread(target=mailbox.put, args=(1,))
+    put.start()
+
+    # The second message is only put once the first one is taken
+    time.sleep(0.1)
+    assert put.is_alive()
+    assert mailbox.get(timeout=1) == 0
+    put.join(timeout=1)
+    assert not put.is_alive()
+    assert _drain(mailbox) == [1]
+    assert mailbox.dropped == 0
+
+
+def test_block_raises_full_after_waiting() -> None:
+    mailbox = Mailbox(POLICY.BLOCK, maxsize=1)
+    mailbox.put(0)
+
+    with pytest.raises(queue.Full):
+        mailbox.put(1, timeout=0.05)
+    with pytest.raises(queue.Full):
+        mailbox.put_nowait(2)
+    assert _drain(mailbox) == [0]
+    assert mailbox.dropped == 2
+
+
+def test_get_waits_for_a_message() -> None:
+    mailbox = Mailbox()
+    threading.Timer(0.05, mailbox.put, args=("message",)).start()
+
+    assert mailbox.get(timeout=1) == "message"
+    with pytest.raises(queue.Empty):
+        mailbox.get(timeout=0.05)
+    with pytest.raises(queue.Empty):
+        mailbox.get_nowait()
+    assert mailbox.peek() is None
+
+
+@pytest.mark.parametrize("policy, maxsize", [("UNKNOWN", 1), (POLICY.FIFO, 0)])
+def test_rejects_invalid_settings(policy: str, maxsize: int) -> None:
+    with pytest.raises(ValueError):
+        Mailbox(policy, maxsize)
@@ -0,0 +1,90 @@
+import io
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from postprocess import MANIFEST_FILE, find_sessions, main, process_session
+from shards import ShardWriter
+
+KEYS = ["KEY_W", "KEY_A"]
+FRAME_SIZE = (16, 12)
+# Samples repeating the previous frame, and corrupt ones, as in a session saved under load
+DUPLICATES = {4, 9, 15}
+CORRUPT = {6, 12}
+
+
+def _jpeg(value: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 24), (value, 255 - value, 0)).save(buffer, format="jpeg")
+    return buffer.getvalue()
+
+
+def _record(session_dir: Path, count: int) -> None:
+    writer = ShardWriter(session_dir, KEYS, "jpeg")
+    for i in range(count):
+        if i in CORRUPT:
+            data = b"\xff\xd8 not a jpeg"
+        else:
+            data = _jpeg(10 * (i - 1 if i in DUPLICATES else i))
+        writer.append(data, i * 0.1, [i % 2, 2 if i % 3 == 0 else 0])
+    writer.close()
+
+
+def test_drops_duplicate_and_corrupt_frames(tmp_path: Path) -> None:
+    _record(tmp_path.joinpath("session"), 20)
+
+    result = process_session(tmp_path.joinpath("session"), tmp_path.joinpath("output"), FRAME_SIZE, shard_size=8)
+
+    assert result["duplicates"] == 3
+    assert result["corrupt"] == 2
+    assert result["samples"] == 15
+    assert result["keys"] == KEYS
+    assert result["shards"] == ["shard-00000.npz", "shard-00001.npz"]
+
+    kept = [i for i in range(20) if i not in DUPLICATES | CORRUPT]
+    shards = [np.load(tmp_path.joinpath("output", name)) for name in result["shards"]]
+    frames = np.concatenate([shard["frames"] for shard in shards])
+    labels = np.concatenate([shard["labels"] for shard in shards])
+    assert frames.shape == (15, FRAME_SIZE[1], FRAME_SIZE[0], 3)
+    assert frames.dtype == np.float16
+    assert 0 <= frames.min() and frames.max() <= 1
+    np.testing.assert_array_equal(labels, [[i % 2, int(i % 3 == 0)] for i in kept])
+
+
+def test_processes_sessions_in_parallel_and_incrementally(tmp_path: Path, capsys: pytest.CaptureFixture) -> None:
+    recordings = tmp_path.joinpath("recordings")
+    for i, count in enumerate((20, 10, 5)):
+        _record(recordings.joinpath(f"session-{i}"), count)
+    output = tmp_path.joinpath("training")
+    assert len(find_sessions([str(recordings)])) == 3
+
+    main([str(recordings)], str(output), FRAME_SIZE, shard_size=8, workers=2)
+    with open(output.joinpath(MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+
+    assert len(manifest["sessions"]) == 3
+    for entry in manifest["sessions"].values():
+        assert all(output.joinpath(entry["output"], name).exists() for name in entry["shards"])
+    assert sum(entry["samples"] for entry in manifest["sessions"].values()) == 15 + 7 + 4
+
+    # Nothing changed, so nothing is processed again
+    capsys.readouterr()
+    main([str(recordings)], str(output), FRAME_SIZE, shard_size=8, workers=2)
+    assert "3 sessions, 0 new or changed" in capsys.readouterr().out
+
+    # Only the session that changed since is processed again
+    changed = recordings.joinpath("session-1")
+    mtime = os.stat(changed.joinpath("metadata.json")).st_mtime + 10
+    os.utime(changed.joinpath("metadata.json"), (mtime, mtime))
+    main([str(recordings)], str(output), FRAME_SIZE, shard_size=8, workers=2)
+    assert "3 sessions, 1 new or changed" in capsys.readouterr().out
+    with open(output.joinpath(MANIFEST_FILE)) as f:
+        assert json.load(f)["sessions"][str(changed.absolute())]["source_mtime"] == mtime
+
+    # Changing how frames are processed invalidates every session
+    main([str(recordings)], str(output), (8, 6), shard_size=8, workers=2)
+    assert "3 sessions, 3 new or changed" in capsys.readouterr().out
@@ -0,0 +1,132 @@
+from typing import List
+
+import pytest
+
+from protocol import (
+    COMMAND_KIND,
+    FRAME_KIND,
+    HINT_PAYLOAD,
+    KEYS_PAYLOAD,
+    STREAM_MODE,
+    Frame,
+    FrameParser,
+    decode_commands,
+    encode_frame_header,
+    encode_hello,
+    encode_hint_command,
+    encode_keys_command,
+    encode_legacy_keys_command,
+)
+
+
+def _feed_in_chunks(parser: FrameParser, data: bytes, chunk_size: int) -> List[Frame]:
+    # Received the way the server does, straight into the parser's memory
+    frames = []
+    while data:
+        view = parser.writable()
+        nbytes = min(len(view), chunk_size, len(data))
+        view[:nbytes] = data[:nbytes]
+        frames += parser.commit(nbytes)
+        data = data[nbytes:]
+    return frames
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 16, 1000])
+def test_reassembles_framed_messages_split_across_chunks(chunk_size: int) -> None:
+    payloads = [b"\xFF\xD8first\xFF\xD9", b"", b"\xFF\xD8" + bytes(range(256)) * 4 + b"\xFF\xD9"]
+    stream = encode_hello("robot-a") + b"".join(
+        encode_frame_header(seq, 1000 + seq, len(payload)) + payload for seq, payload in enumerate(payloads)
+    )
+
+    parser = FrameParser(recv_size=16)
+    frames = _feed_in_chunks(parser, stream, chunk_size)
+
+    assert parser.mode == STREAM_MODE.FRAMED
+    assert parser.errors == 0
+    assert [(frame.kind, frame.seq, frame.timestamp_ms) for frame in frames] == [
+        (FRAME_KIND.HELLO, 0, 0),
+        (FRAME_KIND.JPEG, 0, 1000),
+        (FRAME_KIND.JPEG, 1, 1001),
+        (FRAME_KIND.JPEG, 2, 1002),
+    ]
+    assert [bytes(frame.data) for frame in frames] == [b"robot-a"] + payloads
+    assert all(frame.started_at <= frame.received_at for frame in frames)
+
+
+def test_resyncs_framed_stream_after_garbage() -> None:
+    parser = FrameParser(recv_size=16)
+    first = encode_frame_header(0, 0, 3) + b"abc"
+    second = encode_frame_header(1, 0, 3) + b"def"
+    # Garbage that looks like the start of a header, but isn't one
+    frames = _feed_in_chunks(parser, first + b"MKxx\x00garbage" + second, 5)
+
+    assert [bytes(frame.data) for frame in frames] == [b"abc", b"def"]
+    assert parser.errors > 0
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 64])
+def test_reassembles_legacy_jpegs_split_across_chunks(chunk_size: int) -> None:
+    images = [b"\xFF\xD8" + bytes([i]) * (10 * i + 1) + b"\xFF\xD9" for i in range(1, 6)]
+    # Legacy streams may have anything between images, which is discarded
+    stream = b"noise" + b"\x00\xFF".join(images)
+
+    parser = FrameParser(recv_size=4)
+    frames = _feed_in_chunks(parser, stream, chunk_size)
+
+    assert parser.mode == STREAM_MODE.LEGACY
+    assert [bytes(frame.data) for frame in frames] == images
+    assert all(frame.seq is None and frame.timestamp_ms is None for frame in frames)
+
+
+def test_legacy_markers_split_at_every_offset() -> None:
+    image = b"\xFF\xD8" + b"payload" + b"\xFF\xD9"
+    stream = b"\x00" + image + image
+
+    for split in range(1, len(stream)):
+        parser = FrameParser(recv_size=64)
+        frames = parser.feed(stream[:split]) + parser.feed(stream[split:])
+        assert [bytes(frame.data) for frame in frames] == [image, image], f"split at {split}"
+
+
+def test_legacy_image_larger_than_the_buffer() -> None:
+    image = b"\xFF\xD8" + bytes(range(256)) * 64 + b"\xFF\xD9"
+
+    parser = FrameParser(recv_size=8)
+    frames = _feed_in_chunks(parser, b"\x00" + image, 8)
+
+    assert [bytes(frame.data) for frame in frames] == [image]
+
+
+def test_decodes_commands_and_keeps_incomplete_ones() -> None:
+    keys = encode_keys_command(1, 1000, 0b1000000101)
+    hint = encode_hint_command(2, 1001, 40, 100)
+    buffer = bytearray(keys + hint + keys[:5])
+
+    commands = decode_commands(buffer)
+
+    assert [(command.kind, command.seq, command.timestamp_ms) for command in commands] == [
+        (COMMAND_KIND.KEYS, 1, 1000),
+        (COMMAND_KIND.HINT, 2, 1001),
+    ]
+    assert KEYS_PAYLOAD.unpack(commands[0].payload) == (0b1000000101,)
+    assert HINT_PAYLOAD.unpack(commands[1].payload) == (40, 100)
+    # The incomplete command is kept until the rest of it is received
+    assert buffer == keys[:5]
+    buffer += keys[5:]
+    assert [command.seq for command in decode_commands(buffer)] == [1]
+    assert buffer == b""
+
+
+def test_decode_commands_resyncs_after_garbage() -> None:
+    garbage = b"\x00MC\xFF" + b"garbage" * 3
+    buffer = bytearray(garbage + encode_keys_command(1, 0, 1) + garbage + encode_keys_command(2, 0, 2))
+
+    commands = decode_commands(buffer)
+
+    assert [(command.seq, KEYS_PAYLOAD.unpack(command.payload)[0]) for command in commands] == [(1, 1), (2, 2)]
+    assert buffer == b""
+
+
+def test_encodes_legacy_keys_one_byte_per_key() -> None:
+    assert encode_legacy_keys_command(0) == b""
+    assert encode_legacy_keys_command(0b1000000101) == bytes([1, 3, 10])
@@ -0,0 +1,88 @@
+import queue
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import pytest
+
+from controller import KeyboardController
+from protocol import FRAME_KIND, Frame
+from recorder import RECORDING_FORMAT, RECORDING_MODE, Recorder
+from shards import ShardReader
+
+
+class _FakeServer:
+    # Only what the recorder uses of `Server`, with frames delivered by the test instead of robots
+    def __init__(self, robots: List[str]) -> None:
+        self._robots = robots
+        self._subscribers: List[Callable[[Frame], None]] = []
+
+    def subscribe(self, callback: Callable[[Frame], None]) -> None:
+        self._subscribers = self._subscribers + [callback]
+
+    def unsubscribe(self, callback: Callable[[Frame], None]) -> None:
+        self._subscribers = [subscriber for subscriber in self._subscribers if subscriber != callback]
+
+    def robots(self) -> List[str]:
+        return list(self._robots)
+
+    def read_frame(self, robot_id: Optional[str] = None) -> Optional[Frame]:
+        return None
+
+    def deliver(self, frame: Frame) -> None:
+        for subscriber in self._subscribers:
+            subscriber(frame)
+
+
+def _frame(seq: int, robot_id: str = "robot-a") -> Frame:
+    data = bytearray(b"\xFF\xD8" + bytes([seq]) * 100 + b"\xFF\xD9")
+    return Frame(FRAME_KIND.JPEG, seq, seq, data, robot_id)
+
+
+def _record_frames(session_root: Path, server: _FakeServer, frames: List[Frame], every_nth_frame: int) -> ShardReader:
+    recorder = Recorder(server, KeyboardController(message_queue=queue.Queue()), sample_rate_ms=200, preroll_s=0)
+    recorder.start()
+    recorder.start_recording(
+        str(session_root),
+        RECORDING_FORMAT.JPEG,
+        sharded=True,
+        mode=RECORDING_MODE.FRAMES,
+        every_nth_frame=every_nth_frame,
+    )
+    for i, frame in enumerate(frames):
+        # Frames arrive once recording started
+        frames[i] = frame._replace(received_at=time.monotonic())
+        server.deliver(frames[i])
+    recorder.stop_recording()
+    # Frames delivered once recording stopped aren't recorded
+    server.deliver(_frame(255)._replace(received_at=time.monotonic()))
+    recorder.close()
+
+    (session_dir,) = session_root.iterdir()
+    return ShardReader(session_dir)
+
+
+@pytest.mark.parametrize("every_nth_frame", [1, 3])
+def test_records_every_nth_frame_once(tmp_path: Path, every_nth_frame: int) -> None:
+    frames = [_frame(seq) for seq in range(20)]
+
+    reader = _record_frames(tmp_path, _FakeServer(["robot-a"]), frames, every_nth_frame)
+
+    assert [sample.data for sample in reader] == [bytes(frame.data) for frame in frames[::every_nth_frame]]
+    timestamps = [sample.timestamp for sample in reader]
+    # Samples are timed by the arrival of their frame, relative to the start of the session
+    assert timestamps == sorted(timestamps)
+    assert timestamps[0] >= 0
+    assert timestamps[-1] - timestamps[0] == pytest.approx(
+        frames[::every_nth_frame][-1].received_at - frames[0].received_at
+    )
+    reader.close()
+
+
+def test_records_only_the_latest_robot(tmp_path: Path) -> None:
+    frames = [_frame(seq, robot_id) for seq in range(10) for robot_id in ("robot-a", "robot-b")]
+
+    reader = _record_frames(tmp_path, _FakeServer(["robot-a", "robot-b"]), frames, 1)
+
+    assert [sample.data for sample in reader] == [bytes(frame.data) for frame in frames if frame.robot_id == "robot-b"]
+    reader.close()
@@ -0,0 +1,97 @@
+import queue
+import socket
+import time
+from typing import Dict, Iterator, Tuple
+
+import pytest
+
+from benchmark import SERVER_BACKENDS, run_scale_test
+from common import MESSAGE_TYPE
+from protocol import encode_frame_header, encode_hello
+from server import Server
+
+
+@pytest.fixture(params=SERVER_BACKENDS.values(), ids=SERVER_BACKENDS.keys())
+def server(request: pytest.FixtureRequest, port: int) -> Iterator[Tuple[Server, queue.Queue, queue.Queue]]:
+    status_queue = queue.Queue()
+    camera_queue = queue.Queue()
+    server = request.param(port=port, status_queue=status_queue, camera_queue=camera_queue)
+    server.daemon = True
+    server.start()
+    # Give the server some time to start listening
+    time.sleep(0.2)
+
+    yield server, status_queue, camera_queue
+
+    server.close()
+
+
+def _connect(port: int, robot_id: str) -> socket.socket:
+    sock = socket.create_connection((socket.gethostbyname(socket.gethostname()), port))
+    sock.sendall(encode_hello(robot_id))
+    return sock
+
+
+def _wait_for_status(status_queue: queue.Queue, message_type: str, count: int) -> Dict[str, int]:
+    robots = {}
+    while sum(robots.values()) < count:
+        received_type, robot_id = status_queue.get(timeout=5)
+        if received_type == message_type:
+            robots[robot_id] = robots.get(robot_id, 0) + 1
+    return robots
+
+
+@pytest.mark.parametrize("server_class", SERVER_BACKENDS.values(), ids=SERVER_BACKENDS.keys())
+def test_scale(port: int, server_class: type) -> None:
+    # Every frame of every robot comes out of the server tagged with its robot, which `run_scale_test` asserts
+    result = run_scale_test(num_clients=8, num_frames=50, frame_size=20_000, port=port, server_class=server_class)
+
+    assert result["clients"] == 8
+    assert result["fps"] > 0
+
+
+def test_keeps_one_connection_per_robot(server: Tuple[Server, queue.Queue, queue.Queue], port: int) -> None:
+    server, status_queue, camera_queue = server
+    first = _connect(port, "robot-a")
+    second = _connect(port, "robot-b")
+    assert _wait_for_status(status_queue, MESSAGE_TYPE.CONNECTED, 2) == {"robot-a": 1, "robot-b": 1}
+
+    first.sendall(encode_frame_header(1, 0, 3) + b"aaa")
+    second.sendall(encode_frame_header(1, 0, 3) + b"bbb")
+    frames = {}
+    for _ in range(2):
+        _, frame = camera_queue.get(timeout=5)
+        frames[frame.robot_id] = bytes(frame.data)
+
+    assert frames == {"robot-a": b"aaa", "robot-b": b"bbb"}
+    assert sorted(server.robots()) == ["robot-a", "robot-b"]
+    assert bytes(server.read_frame("robot-a").data) == b"aaa"
+    assert bytes(server.read_frame("robot-b").data) == b"bbb"
+
+    # Commands only go to the robot they are meant for
+    server.send_to_mark(b"x", robot_id="robot-b")
+    assert second.recv(1) == b"x"
+    first.settimeout(0.2)
+    with pytest.raises(socket.timeout):
+        first.recv(1)
+
+    first.close()
+    second.close()
+
+
+def test_reconnecting_robot_replaces_its_connection(server: Tuple[Server, queue.Queue, queue.Queue], port: int) -> None:
+    server, status_queue, _ = server
+    old = _connect(port, "robot-a")
+    _wait_for_status(status_queue, MESSAGE_TYPE.CONNECTED, 1)
+    new = _connect(port, "robot-a")
+    _wait_for_status(status_queue, MESSAGE_TYPE.CONNECTED, 1)
+
+    assert server.robots() == ["robot-a"]
+    # The previous connection is closed by the server
+    old.settimeout(5)
+    assert old.recv(1) == b""
+    server.send_to_mark(b"x", robot_id="robot-a")
+    assert new.recv(1) == b"x"
+
+    old.close()
+    new.close()
@@ -0,0 +1,104 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from shards import DATA_SUFFIX, INDEX_SUFFIX, ShardReader, ShardWriter, recover_session
+
+KEYS = ["KEY_W", "KEY_A"]
+
+
+def _image(i: int) -> bytes:
+    return bytes([i]) * (100 + i)
+
+
+def _record(session_dir: Path, count: int, max_shard_bytes: int = 1024) -> ShardWriter:
+    writer = ShardWriter(session_dir, KEYS, "jpeg", max_shard_bytes=max_shard_bytes)
+    for i in range(count):
+        assert writer.append(_image(i), i * 0.1, [i % 2, 1]) == i
+    return writer
+
+
+def _last_shard(session_dir: Path, suffix: str) -> Path:
+    return sorted(session_dir.glob(f"*{suffix}"))[-1]
+
+
+def test_reads_samples_by_index_across_shards(tmp_path: Path) -> None:
+    _record(tmp_path, 30).close()
+
+    reader = ShardReader(tmp_path)
+
+    assert len(reader) == 30
+    assert len(reader.shard_counts) > 1
+    assert (reader.keys, reader.recording_format) == (KEYS, "jpeg")
+    for i in (0, 9, 10, 17, 29):
+        sample = reader[i]
+        assert sample.data == _image(i)
+        assert sample.timestamp == pytest.approx(i * 0.1)
+        assert sample.controller == {"KEY_W": i % 2, "KEY_A": 1}
+    assert reader[-1].data == _image(29)
+    assert reader.controller(3) == {"KEY_W": 1, "KEY_A": 1}
+    with pytest.raises(IndexError):
+        reader[30]
+    reader.close()
+
+
+def test_reads_session_while_it_is_recorded(tmp_path: Path) -> None:
+    writer = _record(tmp_path, 5)
+    reader = ShardReader(tmp_path)
+    assert len(reader) == 5
+
+    for i in range(5, 25):
+        writer.append(_image(i), i * 0.1, [0, 0])
+
+    assert reader.refresh() == 25
+    assert reader[24].data == _image(24)
+    writer.close()
+    reader.close()
+
+
+def test_ignores_sample_cut_in_the_middle_of_its_image(tmp_path: Path) -> None:
+    _record(tmp_path, 5, max_shard_bytes=1024 * 1024).close()
+    data_path = _last_shard(tmp_path, DATA_SUFFIX)
+    # As if the app crashed while the last image was being written, after its record was
+    os.truncate(data_path, data_path.stat().st_size - 50)
+
+    reader = ShardReader(tmp_path)
+
+    assert len(reader) == 4
+    assert reader[3].data == _image(3)
+    reader.close()
+
+
+def test_ignores_sample_whose_image_is_corrupted(tmp_path: Path) -> None:
+    _record(tmp_path, 5, max_shard_bytes=1024 * 1024).close()
+    data_path = _last_shard(tmp_path, DATA_SUFFIX)
+    with open(data_path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"\xFF")
+
+    reader = ShardReader(tmp_path)
+
+    assert len(reader) == 4
+    reader.close()
+
+
+def test_recovers_session_cut_short(tmp_path: Path) -> None:
+    _record(tmp_path, 30).close()
+    data_path = _last_shard(tmp_path, DATA_SUFFIX)
+    index_path = _last_shard(tmp_path, INDEX_SUFFIX)
+    # The last image is cut in the middle, and so is a record written after it
+    os.truncate(data_path, data_path.stat().st_size - 50)
+    with open(index_path, "ab") as f:
+        f.write(b"\x00" * 7)
+
+    assert recover_session(tmp_path) == 29
+
+    reader = ShardReader(tmp_path)
+    assert len(reader) == 29
+    assert reader[28].data == _image(28)
+    assert index_path.stat().st_size == reader.shard_counts[-1] * reader.record_size
+    assert data_path.stat().st_size == reader.data_size(len(reader.shard_counts) - 1)
+    reader.close()
+    # Recovering again changes nothing
+    assert recover_session(tmp_path) == 29